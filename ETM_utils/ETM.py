@@ -24,8 +24,12 @@ import json
 import sqlite3
 import argparse
 import contextlib
+from copy import deepcopy
 
 from .process_sql import get_schema, Schema,get_sql, get_sql_equivalencies
+from .lexical import same_query
+from .sqlnodes import freeze, thaw
+from .tables_index import load_entries, LazyMap
 # from .esmp_orig import get_sql as get_sql_orig
 # from .exec_eval import eval_exec_match
 
@@ -105,6 +109,28 @@ def get_scores(count, pred_total, label_total):
     return 0,0,0
 
 
+def count_matches(pred_units, label_units):
+    # number of pred units paired with an equal label unit, each label unit used once
+    if not pred_units or not label_units:
+        return 0
+    if len(pred_units) == 1 and len(label_units) == 1:
+        return int(pred_units[0] == label_units[0])
+    try:
+        hash((tuple(pred_units), tuple(label_units)))
+    except TypeError:
+        pred_units = [freeze(unit) for unit in pred_units]
+        label_units = [freeze(unit) for unit in label_units]
+    remaining = {}
+    for unit in label_units:
+        remaining[unit] = remaining.get(unit, 0) + 1
+    cnt = 0
+    for unit in pred_units:
+        if remaining.get(unit, 0) > 0:
+            remaining[unit] -= 1
+            cnt += 1
+    return cnt
+
+
 def eval_sel(pred, label, DISABLE_DISTINCT):
     if not DISABLE_DISTINCT:
         pred_distinct = pred['select'][0]
@@ -114,94 +140,62 @@ def eval_sel(pred, label, DISABLE_DISTINCT):
 
     pred_sel = pred['select'][1]
     label_sel = label['select'][1]
-    label_wo_agg = [unit[1] for unit in label_sel]
     pred_total = len(pred_sel)
     label_total = len(label_sel)
-    cnt = 0
-    cnt_wo_agg = 0
-
-    for unit in pred_sel:
-        if unit in label_sel:
-            cnt += 1
-            label_sel.remove(unit)
-        if unit[1] in label_wo_agg:
-            cnt_wo_agg += 1
-            label_wo_agg.remove(unit[1])
+    cnt = count_matches(pred_sel, label_sel)
+    cnt_wo_agg = count_matches([unit[1] for unit in pred_sel], [unit[1] for unit in label_sel])
 
     return label_total, pred_total, cnt, cnt_wo_agg
 
 
-def eval_where(pred, label):
-    pred_conds = [unit for unit in pred['where'][::2]]
-    label_conds = [unit for unit in label['where'][::2]]
-    for l in range(len(label_conds)):
-        not_op, op_id, val_unit, val1, val2 = label_conds[l]
+def where_units(conds):
+    # conditions with the tables of a subquery value sorted, without changing the subquery
+    units = []
+    for unit in conds[::2]:
+        not_op, op_id, val_unit, val1, val2 = unit
         if type(val1) == dict:
             val1tabunits = val1['from']['table_units']
             val1tabunits = [x for x in val1tabunits if type(x) == tuple]
             val1tabunits = sorted(val1tabunits, key=lambda x: x[1])
-            val1['from']['table_units'] = val1tabunits
-            label_conds[l] = (not_op, op_id, val_unit, val1, val2)
-    for p in range(len(pred_conds)):
-        not_op, op_id, val_unit, val1, val2 = pred_conds[p]
-        if type(val1) == dict:
-            val1tabunits = val1['from']['table_units']
-            val1tabunits = [x for x in val1tabunits if type(x) == tuple]
-            val1tabunits = sorted(val1tabunits, key=lambda x: x[1])
-            val1['from']['table_units'] = val1tabunits
-            pred_conds[p] = (not_op, op_id, val_unit, val1, val2)
+            val1 = dict(val1, **{'from': dict(val1['from'], table_units=val1tabunits)})
+            unit = (not_op, op_id, val_unit, val1, val2)
+        units.append(unit)
+    return units
+
 
-    label_wo_agg = [unit[2] for unit in label_conds]
+def eval_where(pred, label):
+    pred_conds = where_units(pred['where'])
+    label_conds = where_units(label['where'])
     pred_total = len(pred_conds)
     label_total = len(label_conds)
-    cnt = 0
-    cnt_wo_agg = 0
-
-    for unit in pred_conds:
-        if unit in label_conds:
-            cnt += 1
-            label_conds.remove(unit)
-        if unit[2] in label_wo_agg:
-            cnt_wo_agg += 1
-            label_wo_agg.remove(unit[2])
+    cnt = count_matches(pred_conds, label_conds)
+    cnt_wo_agg = count_matches([unit[2] for unit in pred_conds], [unit[2] for unit in label_conds])
 
     return label_total, pred_total, cnt, cnt_wo_agg
 
 
-def eval_from_where(pred, label):
-    pred_conds = [unit for unit in pred['from']['conds'][::2]]
-    label_conds = [unit for unit in label['from']['conds'][::2]]
-    for l in range(len(label_conds)):
-        label = label_conds[l]
-        not_op, op_id, val_unit, val1, val2 = label
+def join_units(conds):
+    # join conditions with the lower column first
+    units = []
+    for unit in conds[::2]:
+        not_op, op_id, val_unit, val1, val2 = unit
         if op_id == 2:
             value1 = val_unit[1][1]
             if val1:
                 value2 = val1[1][1]
                 if value1 > value2:
-                    label_conds[l] = (not_op, 2, val1, val_unit, val2)
-    for p in range(len(pred_conds)):
-        pred = pred_conds[p]
-        not_op, op_id, val_unit, val1, val2 = pred
-        if op_id == 2:
-            value1 = val_unit[1][1]
-            if val1:
-                value2 = val1[1][1]
-                if value1 > value2:
-                    pred_conds[p] = (not_op, 2, val1, val_unit, val2)
-    label_wo_agg = [unit[2] for unit in label_conds]
+                    unit = (not_op, 2, val1, val_unit, val2)
+        units.append(unit)
+    return units
+
+
+def eval_from_where(pred, label):
+    pred_conds = join_units(pred['from']['conds'])
+    label_conds = join_units(label['from']['conds'])
     pred_total = len(pred_conds)
     label_total = len(label_conds)
-    cnt = 0
-    cnt_wo_agg = 0
-
-    for unit in pred_conds:
-        if unit in label_conds:
-            cnt += 1
-            label_conds.remove(unit)
-        if unit[2] in label_wo_agg:
-            cnt_wo_agg += 1
-            label_wo_agg.remove(unit[2])
+    cnt = count_matches(pred_conds, label_conds)
+    cnt_wo_agg = count_matches([unit[2] for unit in pred_conds], [unit[2] for unit in label_conds])
 
     return label_total, pred_total, cnt, cnt_wo_agg
 
@@ -211,13 +205,9 @@ def eval_group(pred, label):
     label_cols = [unit[1] for unit in label['groupBy']]
     pred_total = len(pred_cols)
     label_total = len(label_cols)
-    cnt = 0
     pred_cols = [pred.split(".")[1] if "." in pred else pred for pred in pred_cols]
     label_cols = [label.split(".")[1] if "." in label else label for label in label_cols]
-    for col in pred_cols:
-        if col in label_cols:
-            cnt += 1
-            label_cols.remove(col)
+    cnt = count_matches(pred_cols, label_cols)
     return label_total, pred_total, cnt
 
 
@@ -286,7 +276,7 @@ def eval_nested(pred, label,DISABLE_DISTINCT):
     if label is not None:
         label_total += 1
     if pred is not None and label is not None:
-        cnt += Evaluator().eval_exact_match(pred, label,DISABLE_DISTINCT)
+        cnt += Evaluator().exact_match(pred, label,DISABLE_DISTINCT)
     return label_total, pred_total, cnt
 
 
@@ -314,91 +304,114 @@ def eval_limit(pred, label):
 
 
 def get_keywords(sql):
-    res = set()
-    if len(sql['where']) > 0:
-        res.add('where')
-    if len(sql['groupBy']) > 0:
-        res.add('group')
-    if len(sql['having']) > 0:
-        res.add('having')
-    if len(sql['orderBy']) > 0:
-        res.add(sql['orderBy'][0])
-        res.add('order')
-    if sql['limit'] is not None:
-        res.add('limit')
-    if sql['except'] is not None:
-        res.add('except')
-    if sql['union'] is not None:
-        res.add('union')
-    if sql['intersect'] is not None:
-        res.add('intersect')
-
-    # or keyword
-    ao = sql['from']['conds'][1::2] + sql['where'][1::2] + sql['having'][1::2]
-    if len([token for token in ao if token == 'or']) > 0:
-        res.add('or')
+    return set(sql_features(sql).keywords)
 
-    cond_units = sql['from']['conds'][::2] + sql['where'][::2] + sql['having'][::2]
-    # not keyword
-    if len([cond_unit for cond_unit in cond_units if cond_unit[0]]) > 0:
-        res.add('not')
 
-    # in keyword
-    if len([cond_unit for cond_unit in cond_units if cond_unit[1] == WHERE_OPS.index('in')]) > 0:
-        res.add('in')
+def eval_keywords(pred, label, pred_features=None, label_features=None):
+    # the SQLFeatures of either query are computed here unless the caller already has them
+    pred_keywords = (pred_features or sql_features(pred)).keywords
+    label_keywords = (label_features or sql_features(label)).keywords
+    pred_total = len(pred_keywords)
+    label_total = len(label_keywords)
+    cnt = len(pred_keywords & label_keywords)
+    return label_total, pred_total, cnt
 
-    # like keyword
-    if len([cond_unit for cond_unit in cond_units if cond_unit[1] == WHERE_OPS.index('like')]) > 0:
-        res.add('like')
 
-    return res
+def eval_from_match(pred, label):
+    # the tables (in any order if all joins are inner joins) and the join conditions match
+    if len(label['from']['table_units']) > 0:
+        all_inner_joins = True
+        label_tables = (label['from']['table_units'])
+        pred_tables = (pred['from']['table_units'])
+        for i in label_tables[1::2]:
+            if i != 'join':
+                all_inner_joins = False
 
+        for i in pred_tables[1::2]:
+            if i != 'join':
+                all_inner_joins = False
 
-def eval_keywords(pred, label):
-    pred_keywords = get_keywords(pred)
-    label_keywords = get_keywords(label)
-    pred_total = len(pred_keywords)
-    label_total = len(label_keywords)
-    cnt = 0
+        if all_inner_joins:
+            label_tables = sorted([i for i in label_tables if type(i) == tuple])
+            pred_tables = sorted([i for i in pred_tables if type(i) == tuple])
 
-    for k in pred_keywords:
-        if k in label_keywords:
-            cnt += 1
-    return label_total, pred_total, cnt
+        if not label_tables == pred_tables:
+            return False
+        label_total, pred_total, cnt, cnt_wo_agg = eval_from_where(pred,label)
+        acc, rec, f1 = get_scores(cnt, pred_total, label_total)
+        if f1 != 1:
+            return False
+    return True
 
 
 def count_agg(units):
     return len([unit for unit in units if has_agg(unit)])
 
 
-def count_component1(sql):
-    count = 0
+class SQLFeatures:
+    """What eval_hardness and eval_keywords read from one parsed query (not counting its nested queries)."""
+    __slots__ = ('component1', 'component2', 'others', 'agg_count', 'keywords', 'hardness')
+
+    def __init__(self, component1, component2, others, agg_count, keywords):
+        self.component1 = component1
+        self.component2 = component2
+        self.others = others
+        self.agg_count = agg_count
+        self.keywords = keywords
+        self.hardness = hardness_level(component1, component2, others)
+
+
+def sql_features(sql):
+    """SQLFeatures of a parsed query."""
+    # one pass over the conditions of from, where and having gives the or/like/not/in counts and the
+    # number of nested queries; the rest are clause lengths
+    keywords = set()
+    nested = 0
+    or_count = like_count = 0
+    for conds in (sql['from']['conds'], sql['where'], sql['having']):
+        for i, unit in enumerate(conds):
+            if i % 2:
+                if unit == 'or':
+                    or_count += 1
+                continue
+            if unit[0]:
+                keywords.add('not')
+            if unit[1] == WHERE_OPS.index('in'):
+                keywords.add('in')
+            elif unit[1] == WHERE_OPS.index('like'):
+                like_count += 1
+            if type(unit[3]) is dict:
+                nested += 1
+            if type(unit[4]) is dict:
+                nested += 1
+    if or_count:
+        keywords.add('or')
+    if like_count:
+        keywords.add('like')
+    for key in ('intersect', 'except', 'union'):
+        if sql[key] is not None:
+            nested += 1
+            keywords.add(key)
+
+    component1 = or_count + like_count
     if len(sql['where']) > 0:
-        count += 1
+        component1 += 1
+        keywords.add('where')
     if len(sql['groupBy']) > 0:
-        count += 1
+        component1 += 1
+        keywords.add('group')
+    if len(sql['having']) > 0:
+        keywords.add('having')
     if len(sql['orderBy']) > 0:
-        count += 1
+        component1 += 1
+        keywords.add(sql['orderBy'][0])
+        keywords.add('order')
     if sql['limit'] is not None:
-        count += 1
+        component1 += 1
+        keywords.add('limit')
     if len(sql['from']['table_units']) > 0:  # JOIN
-        count += len(sql['from']['table_units']) - 1
-
-    ao = sql['from']['conds'][1::2] + sql['where'][1::2] + sql['having'][1::2]
-    count += len([token for token in ao if token == 'or'])
-    cond_units = sql['from']['conds'][::2] + sql['where'][::2] + sql['having'][::2]
-    count += len([cond_unit for cond_unit in cond_units if cond_unit[1] == WHERE_OPS.index('like')])
-
-    return count
-
+        component1 += len(sql['from']['table_units']) - 1
 
-def count_component2(sql):
-    nested = get_nestedSQL(sql)
-    return len(nested)
-
-
-def count_others(sql):
-    count = 0
     # number of aggregation
     agg_count = count_agg(sql['select'][1])
     agg_count += count_agg(sql['where'][::2])
@@ -407,22 +420,36 @@ def count_others(sql):
         agg_count += count_agg([unit[1] for unit in sql['orderBy'][1] if unit[1]] +
                             [unit[2] for unit in sql['orderBy'][1] if unit[2]])
     agg_count += count_agg(sql['having'])
-    if agg_count > 1:
-        count += 1
+    # more than one aggregation, select column, where condition or group by clause
+    others = int(agg_count > 1) + int(len(sql['select'][1]) > 1) + int(len(sql['where']) > 1) + int(len(sql['groupBy']) > 1)
 
-    # number of select columns
-    if len(sql['select'][1]) > 1:
-        count += 1
+    return SQLFeatures(component1, nested, others, agg_count, frozenset(keywords))
 
-    # number of where conditions
-    if len(sql['where']) > 1:
-        count += 1
 
-    # number of group by clauses
-    if len(sql['groupBy']) > 1:
-        count += 1
+def count_component1(sql):
+    return sql_features(sql).component1
+
 
-    return count
+def count_component2(sql):
+    return sql_features(sql).component2
+
+
+def count_others(sql):
+    return sql_features(sql).others
+
+
+def hardness_level(count_comp1_, count_comp2_, count_others_):
+    if count_comp1_ <= 1 and count_others_ == 0 and count_comp2_ == 0:
+        return "easy"
+    elif (count_others_ <= 2 and count_comp1_ <= 1 and count_comp2_ == 0) or \
+            (count_comp1_ <= 2 and count_others_ < 2 and count_comp2_ == 0):
+        return "medium"
+    elif (count_others_ > 2 and count_comp1_ <= 2 and count_comp2_ == 0) or \
+            (2 < count_comp1_ <= 3 and count_others_ <= 2 and count_comp2_ == 0) or \
+            (count_comp1_ <= 1 and count_others_ == 0 and count_comp2_ <= 1):
+        return "hard"
+    else:
+        return "extra"
 
 
 class Evaluator:
@@ -430,22 +457,8 @@ class Evaluator:
     def __init__(self):
         self.partial_scores = None
 
-    def eval_hardness(self, sql):
-        count_comp1_ = count_component1(sql)
-        count_comp2_ = count_component2(sql)
-        count_others_ = count_others(sql)
-
-        if count_comp1_ <= 1 and count_others_ == 0 and count_comp2_ == 0:
-            return "easy"
-        elif (count_others_ <= 2 and count_comp1_ <= 1 and count_comp2_ == 0) or \
-                (count_comp1_ <= 2 and count_others_ < 2 and count_comp2_ == 0):
-            return "medium"
-        elif (count_others_ > 2 and count_comp1_ <= 2 and count_comp2_ == 0) or \
-                (2 < count_comp1_ <= 3 and count_others_ <= 2 and count_comp2_ == 0) or \
-                (count_comp1_ <= 1 and count_others_ == 0 and count_comp2_ <= 1):
-            return "hard"
-        else:
-            return "extra"
+    def eval_hardness(self, sql, features=None):
+        return (features or sql_features(sql)).hardness
 
     def eval_exact_match(self, pred, label,DISABLE_DISTINCT):
         partial_scores = self.eval_partial_match(pred, label,DISABLE_DISTINCT)
@@ -454,31 +467,36 @@ class Evaluator:
 
             if score['f1'] != 1:
                 return 0
-        if len(label['from']['table_units']) > 0:
-            all_inner_joins = True
-            label_tables = (label['from']['table_units'])
-            pred_tables = (pred['from']['table_units'])
-            for i in label_tables[1::2]:
-                if i != 'join':
-                    all_inner_joins = False
-
-            for i in pred_tables[1::2]:
-                if i != 'join':
-                    all_inner_joins = False
-
-            if all_inner_joins:
-                label_tables = sorted([i for i in label_tables if type(i) == tuple])
-                pred_tables = sorted([i for i in pred_tables if type(i) == tuple])
-
-            if not label_tables == pred_tables:
-                return 0
-            label_total, pred_total, cnt, cnt_wo_agg = eval_from_where(pred,label)
-            acc, rec, f1 = get_scores(cnt, pred_total, label_total)
-            if f1 != 1:
-                return 0
+        if not eval_from_match(pred, label):
+            return 0
         return 1
 
-    def eval_partial_match(self, pred, label, DISABLE_DISTINCT):
+    def exact_match(self, pred, label, DISABLE_DISTINCT, pred_features=None, label_features=None):
+        # same result as eval_exact_match without computing every partial score (self.partial_scores is not set).
+        # Each component only reads what it alone modifies, so they are checked cheapest and most often
+        # failing first, and the first mismatch decides. Nested queries (IUEN) are checked last.
+        components = [
+            lambda: eval_limit(pred, label),
+            lambda: eval_order(pred, label),
+            lambda: eval_and_or(pred, label),
+            lambda: eval_group(pred, label),
+            lambda: eval_having(pred, label),
+            lambda: eval_sel(pred, label, DISABLE_DISTINCT),
+            lambda: eval_where(pred, label),
+            lambda: eval_keywords(pred, label, pred_features, label_features),
+            lambda: eval_IUEN(pred, label, DISABLE_DISTINCT),
+        ]
+        for component in components:
+            # select and where also count matches without aggregations / operators
+            label_total, pred_total, *counts = component()
+            for cnt in counts:
+                if get_scores(cnt, pred_total, label_total)[2] != 1:
+                    return 0
+        if not eval_from_match(pred, label):
+            return 0
+        return 1
+
+    def eval_partial_match(self, pred, label, DISABLE_DISTINCT, pred_features=None, label_features=None):
         res = {}
 
         label_total, pred_total, cnt, cnt_wo_agg = eval_sel(pred, label, DISABLE_DISTINCT)
@@ -513,7 +531,7 @@ class Evaluator:
         acc, rec, f1 = get_scores(cnt, pred_total, label_total)
         res['IUEN'] = {'acc': acc, 'rec': rec, 'f1': f1,'label_total':label_total,'pred_total':pred_total}
 
-        label_total, pred_total, cnt = eval_keywords(pred, label)
+        label_total, pred_total, cnt = eval_keywords(pred, label, pred_features, label_features)
         acc, rec, f1 = get_scores(cnt, pred_total, label_total)
         res['keywords'] = {'acc': acc, 'rec': rec, 'f1': f1,'label_total':label_total,'pred_total':pred_total}
 
@@ -572,9 +590,296 @@ def print_scores(scores, etype, include_turn_acc=True):
             exec_scores = [scores[turn]['exec'] for turn in turns]
             print_formated_s("execution", exec_scores, '{:<20.3f}')
     print('invalid predictions: ',scores['p_sql_not_valid'])
+    if 'fast_path' in scores:
+        print('fast path matches: ', scores['fast_path'], '/', scores['all']['count'])
+
+
+TURNS = ['turn 1', 'turn 2', 'turn 3', 'turn 4', 'turn > 4']
+LEVELS = ['easy', 'medium', 'hard', 'extra', 'all', 'joint_all']
+PARTIAL_TYPES = ['select', 'select(no AGG)', 'where', 'where(no OP)', 'group(no Having)',
+                 'group', 'order', 'and/or', 'IUEN', 'keywords']
 
 
-def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, progress_bar_for_each_datapoint, DISABLE_VALUE, DISABLE_DISTINCT, active_rules, verbose):
+class PairResult:
+    """Result of evaluating one prediction against its gold query (exec/exact are None when not evaluated)."""
+    __slots__ = ('hardness', 'exact', 'exec', 'partial', 'valid', 'fast_path')
+
+    def __init__(self, hardness, exact=None, exec=None, partial=None, valid=True, fast_path=False):
+        self.hardness = hardness
+        self.exact = exact
+        self.exec = exec
+        self.partial = partial
+        self.valid = valid
+        self.fast_path = fast_path
+
+
+def empty_scores():
+    scores = {'p_sql_not_valid': 0, 'fast_path': 0}
+    for turn in TURNS:
+        scores[turn] = {'count': 0, 'exact': 0., 'exec': 0}
+    for level in LEVELS:
+        scores[level] = {'count': 0, 'partial': {}, 'exact': 0., 'exec': 0}
+        for type_ in PARTIAL_TYPES:
+            scores[level]['partial'][type_] = {'acc': 0., 'rec': 0., 'f1': 0.,'acc_count':0,'rec_count':0}
+    return scores
+
+
+def merge_scores(scores, other):
+    for key, value in other.items():
+        if isinstance(value, dict):
+            merge_scores(scores[key], value)
+        else:
+            scores[key] += value
+
+
+class ScoreAccumulator:
+    """
+    Running totals of evaluate. Results are added one pair at a time, grouped in sessions (the turns of a
+    conversation, or one pair per session). Accumulators of different shards of the data are merged, and
+    finalize gives the scores dict that print_scores reads.
+    """
+    def __init__(self, etype):
+        self.etype = etype
+        self.scores = empty_scores()
+        # exec and exact results of the turns of the open session
+        self.session = None
+
+    def start_session(self):
+        assert self.session is None, "previous session not ended"
+        self.scores['joint_all']['count'] += 1
+        self.session = {'exec': [], 'exact': []}
+
+    def end_session(self):
+        if all(v == 1 for v in self.session['exec']):
+            self.scores['joint_all']['exec'] += 1
+        if all(v == 1 for v in self.session['exact']):
+            self.scores['joint_all']['exact'] += 1
+        self.session = None
+
+    def sessions(self):
+        return self.scores['joint_all']['count']
+
+    def add(self, result, turn=0):
+        """Adds the PairResult of turn (0 for the first) of the open session, or of a session of its own."""
+        if self.session is None:
+            self.start_session()
+            self.add(result, turn)
+            self.end_session()
+            return
+        scores = self.scores
+        turn_id = TURNS[min(turn, len(TURNS) - 1)]
+        hardness = result.hardness
+        scores[turn_id]['count'] += 1
+        scores[hardness]['count'] += 1
+        scores['all']['count'] += 1
+        if result.fast_path:
+            scores['fast_path'] += 1
+        if not result.valid:
+            scores['p_sql_not_valid'] += 1
+        if result.exec is not None:
+            if result.exec:
+                scores[hardness]['exec'] += 1
+                scores[turn_id]['exec'] += 1
+                scores['all']['exec'] += 1
+                self.session['exec'].append(1)
+            else:
+                self.session['exec'].append(0)
+        if result.exact is not None:
+            self.session['exact'].append(0 if result.exact == 0 else 1)
+            scores[turn_id]['exact'] += result.exact
+            scores[hardness]['exact'] += result.exact
+            scores['all']['exact'] += result.exact
+            for type_ in PARTIAL_TYPES:
+                partial = result.partial[type_]
+                for level in (hardness, 'all'):
+                    if partial['pred_total'] > 0:
+                        scores[level]['partial'][type_]['acc'] += partial['acc']
+                        scores[level]['partial'][type_]['acc_count'] += 1
+                    if partial['label_total'] > 0:
+                        scores[level]['partial'][type_]['rec'] += partial['rec']
+                        scores[level]['partial'][type_]['rec_count'] += 1
+                    scores[level]['partial'][type_]['f1'] += partial['f1']
+
+    def merge(self, other):
+        """Adds the totals of another accumulator (with no open session) to this one."""
+        assert self.session is None and other.session is None, "merge with an open session"
+        merge_scores(self.scores, other.scores)
+        return self
+
+    def finalize(self):
+        """Scores dict with accuracies, as print_scores reads it. The accumulator is left unchanged."""
+        etype = self.etype
+        scores = deepcopy(self.scores)
+        for turn in TURNS:
+            if scores[turn]['count'] == 0:
+                continue
+            if etype in ["all", "exec"]:
+                scores[turn]['exec'] /= scores[turn]['count']
+
+            if etype in ["all", "match"]:
+                scores[turn]['exact'] /= scores[turn]['count']
+
+        for level in LEVELS:
+            if scores[level]['count'] == 0:
+                continue
+            if etype in ["all", "exec"]:
+                scores[level]['exec'] /= scores[level]['count']
+
+            if etype in ["all", "match"]:
+
+                scores[level]['exact'] /= scores[level]['count']
+                for type_ in PARTIAL_TYPES:
+                    if scores[level]['partial'][type_]['acc_count'] == 0:
+                        scores[level]['partial'][type_]['acc'] = 0
+                    else:
+                        scores[level]['partial'][type_]['acc'] = scores[level]['partial'][type_]['acc'] / \
+                                                                 scores[level]['partial'][type_]['acc_count'] * 1.0
+                    if scores[level]['partial'][type_]['rec_count'] == 0:
+                        scores[level]['partial'][type_]['rec'] = 0
+                    else:
+                        scores[level]['partial'][type_]['rec'] = scores[level]['partial'][type_]['rec'] / \
+                                                                 scores[level]['partial'][type_]['rec_count'] * 1.0
+                    if scores[level]['partial'][type_]['acc'] == 0 and scores[level]['partial'][type_]['rec'] == 0:
+                        scores[level]['partial'][type_]['f1'] = 1
+                    else:
+                        scores[level]['partial'][type_]['f1'] = \
+                            2.0 * scores[level]['partial'][type_]['acc'] * scores[level]['partial'][type_]['rec'] / (
+                            scores[level]['partial'][type_]['rec'] + scores[level]['partial'][type_]['acc'])
+        return scores
+
+
+class FailureLog:
+    """
+    Pairs that fail both exact set match and execution, written to path as one json record per line:
+    pred, gold, db, hardness and the components that failed. Records are kept in memory and written
+    max_buffer at a time, and by flush(). The file is replaced by the first write of a log, so a log
+    with no records leaves it as it is.
+    A worker of a parallel run logs to path.<worker>; merge_failure_logs joins them into path.
+    """
+    def __init__(self, path, max_buffer=1000, worker=None):
+        self.path = path if worker is None else f"{path}.{worker}"
+        self.max_buffer = max_buffer
+        self.records = []
+        self.count = 0
+        self.started = False
+
+    def add(self, p_str, g_str, db, result):
+        failed = [type_ for type_, score in result.partial.items() if score['f1'] != 1] if result.partial else []
+        if result.exact == 0 and result.partial and not failed:
+            failed.append('from')
+        if result.exec == 0:
+            failed.append('exec')
+        self.records.append({'pred': p_str, 'gold': g_str, 'db': db, 'hardness': result.hardness, 'failed': failed})
+        self.count += 1
+        if len(self.records) >= self.max_buffer:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+        with open(self.path, 'a' if self.started else 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(record) + '\n' for record in self.records)
+        self.records = []
+        self.started = True
+
+
+def merge_failure_logs(path, workers):
+    # joins the logs of the workers, in the given order, into path and removes them
+    with open(path, 'w', encoding='utf-8') as out:
+        for worker in workers:
+            part = f"{path}.{worker}"
+            if os.path.exists(part):
+                with open(part, encoding='utf-8') as f:
+                    out.write(f.read())
+                os.remove(part)
+    return path
+
+
+def parse_query(db, query, active_rules, verbose=False):
+    # get_sql, without the messages of the fixRules unless verbose
+    if verbose:
+        return get_sql(db, query, active_rules)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return get_sql(db, query, active_rules)
+
+
+# parsed gold queries, frozen (sqlnodes), and their features, by (database, modification time, query, rules),
+# so that a gold file evaluated against several prediction files in one process is parsed once
+GOLD_CACHE = {}
+GOLD_CACHE_SIZE = 16384
+
+
+def parse_gold(db, g_str, active_rules):
+    # (parsed gold query, its SQLFeatures)
+    key = (db, os.path.getmtime(db), g_str, tuple(active_rules))
+    cached = GOLD_CACHE.get(key)
+    if cached is None:
+        g_sql = parse_query(db, g_str, active_rules)
+        cached = (freeze(g_sql), sql_features(g_sql))
+        if len(GOLD_CACHE) >= GOLD_CACHE_SIZE:
+            del GOLD_CACHE[next(iter(GOLD_CACHE))]
+        GOLD_CACHE[key] = cached
+    # the eval_* functions read plain dicts, and get a copy of their own
+    return thaw(cached[0]), cached[1]
+
+
+def empty_sql():
+    # an invalid prediction is evaluated as this query
+    return {
+        "except": None,
+        "from": {
+            "conds": [],
+            "table_units": []
+        },
+        "groupBy": [],
+        "having": [],
+        "intersect": None,
+        "limit": None,
+        "orderBy": [],
+        "select": [
+            False,
+            []
+        ],
+        "union": None,
+        "where": []
+    }
+
+
+EVALUATOR = Evaluator()
+
+
+def eval_pair(g_sql, p_sql, etype, DISABLE_VALUE, DISABLE_DISTINCT, exec_score=None, fast_path=False, partial=False, g_features=None, p_features=None):
+    """
+    PairResult of a gold query and a prediction that are already parsed and validated: p_sql is None if
+    the prediction is not valid, exec_score is the execution result if etype includes exec, and a fast
+    path pair (the same query) is a match. The partial scores are only computed when partial is set.
+    g_features and p_features are the SQLFeatures of the two queries, computed here if not given.
+    """
+    if g_features is None:
+        g_features = sql_features(g_sql)
+    if fast_path:
+        p_features = g_features
+    result = PairResult(EVALUATOR.eval_hardness(g_sql, g_features), exec=exec_score, valid=p_sql is not None, fast_path=fast_path)
+    if etype not in ["all", "match"]:
+        return result
+    if p_sql is None:
+        p_sql = empty_sql()
+    g_sql = rebuild_sql_val(g_sql, DISABLE_VALUE)
+    p_sql = rebuild_sql_val(p_sql, DISABLE_VALUE)
+    if partial:
+        result.partial = EVALUATOR.eval_partial_match(p_sql, g_sql, DISABLE_DISTINCT, p_features, g_features)
+        if fast_path:
+            result.exact = 1
+        else:
+            # the same as Evaluator.eval_exact_match
+            result.exact = int(all(score['f1'] == 1 for score in result.partial.values()) and eval_from_match(p_sql, g_sql))
+    else:
+        result.exact = 1 if fast_path else EVALUATOR.exact_match(p_sql, g_sql, DISABLE_DISTINCT, p_features, g_features)
+    return result
+
+
+def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, progress_bar_for_each_datapoint, DISABLE_VALUE, DISABLE_DISTINCT, active_rules, verbose, failure_log=None):
+    # pairs failing both metrics go to failure_log (a FailureLog) if there is one
     with open(gold) as f:
         glist = []
         gseq_one = []
@@ -589,8 +894,6 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
         if len(gseq_one) != 0:
             glist.append(gseq_one)
 
-    include_turn_acc = len(glist) > 1
-
     with open(predict,encoding='utf-8') as f:
         plist = []
         pseq_one = []
@@ -604,29 +907,12 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
             plist.append(pseq_one)
 
     assert len(plist) == len(glist), "number of sessions must equal"
-    evaluator = Evaluator()
-    turns = ['turn 1', 'turn 2', 'turn 3', 'turn 4', 'turn > 4']
-    levels = ['easy', 'medium', 'hard', 'extra', 'all', 'joint_all']
-
-    partial_types = ['select', 'select(no AGG)', 'where', 'where(no OP)', 'group(no Having)',
-                     'group', 'order', 'and/or', 'IUEN', 'keywords']
+    accumulator = ScoreAccumulator(etype)
     entries = []
-    scores = {}
-    scores['p_sql_not_valid'] = 0
-    for turn in turns:
-        scores[turn] = {'count': 0, 'exact': 0.}
-        scores[turn]['exec'] = 0
-
-    for level in levels:
-        scores[level] = {'count': 0, 'partial': {}, 'exact': 0.}
-        scores[level]['exec'] = 0
-        for type_ in partial_types:
-            scores[level]['partial'][type_] = {'acc': 0., 'rec': 0., 'f1': 0.,'acc_count':0,'rec_count':0}
     idx = None
     count = 0
     for i, (p, g) in enumerate(zip(plist, glist)):
-        scores['joint_all']['count'] += 1
-        turn_scores = {"exec": [], "exact": []}
+        accumulator.start_session()
         for idx, pg in enumerate(zip(p, g)):
             count += 1
             # if count % 100 == 0:
@@ -645,9 +931,9 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
                 g_sql2 = get_sql_orig(db, g_str,active_rules)
                 print(g_sql)
                 print(g_sql2)
+                g_features = sql_features(g_sql)
             else:
-                with contextlib.redirect_stdout(open(os.devnull, 'w')):
-                    g_sql = get_sql(db, g_str, active_rules)
+                g_sql, g_features = parse_gold(db, g_str, active_rules)
                     
             # test = get_sql_equivalencies(db, g_str, active_rules)
             # if not test:
@@ -656,216 +942,58 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
             #     print(g_str)
             #     print('here')
             #     exit()
-            hardness = evaluator.eval_hardness(g_sql)
-            idx_act = idx
-            if idx > 3:
-                idx = "> 4"
+            # the same query up to case, whitespace and semicolons: one validity check, then a match under every metric
+            fast = same_query(g_str, p_str) and isValidSQL(p_str, db)
+            if fast:
+                p_sql = g_sql
             else:
-                idx += 1
-            turn_id = "turn " + str(idx)
-            scores[turn_id]['count'] += 1
-            scores[hardness]['count'] += 1
-            scores['all']['count'] += 1
-            # # try both
-            try:
-                if verbose:
-                    print('processing pred sql')
-                    p_sql = get_sql(db, p_str,active_rules)
-                else:
-                    with contextlib.redirect_stdout(open(os.devnull, 'w')):
-                        p_sql = get_sql(db, p_str,active_rules)
-                
-            except:
-                pass
-            # else:
-            #     try:
-            #         p_sql2 = get_sql_orig(db, p_str,active_rules)
-            #     except:
-            #         print("STOP")
-            #         print(db)
-            #         print(p_str)
-            #         exit()
-
-            try:
-                if not isValidSQL(p_str, db):
-                    raise Exception('SQL not valid.')
-                if verbose:
-                    print('processing pred sql')
-                    p_sql = get_sql(db, p_str,active_rules)
-                    # print('2')
-                    # p_sql2 = get_sql_orig(db, p_str,active_rules)
-                else:
-                    with contextlib.redirect_stdout(open(os.devnull, 'w')):
-                        p_sql = get_sql(db, p_str,active_rules)
-
-            except Exception as e:
-                # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
-                if verbose:
-                    print("PREDICT NOT VALID")
-                scores['p_sql_not_valid'] += 1
-                p_sql = {
-                "except": None,
-                "from": {
-                    "conds": [],
-                    "table_units": []
-                },
-                "groupBy": [],
-                "having": [],
-                "intersect": None,
-                "limit": None,
-                "orderBy": [],
-                "select": [
-                    False,
-                    []
-                ],
-                "union": None,
-                "where": []
-                }
-                p_sql2 = p_sql
+                try:
+                    if not isValidSQL(p_str, db):
+                        raise Exception('SQL not valid.')
+                    if verbose:
+                        print('processing pred sql')
+                    p_sql = parse_query(db, p_str, active_rules, verbose)
+
+                except Exception as e:
+                    # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
+                    if verbose:
+                        print("PREDICT NOT VALID")
+                    p_sql = None
+            exec_score = None
             if etype in ["all", "exec"]:
-                exec_score = eval_exec_match(db=db, p_str=p_str, g_str=g_str, plug_value=plug_value,
-                                             keep_distinct=keep_distinct, progress_bar_for_each_datapoint=progress_bar_for_each_datapoint)
+                if fast:
+                    exec_score = 1
+                else:
+                    exec_score = eval_exec_match(db=db, p_str=p_str, g_str=g_str, plug_value=plug_value,
+                                                 keep_distinct=keep_distinct, progress_bar_for_each_datapoint=progress_bar_for_each_datapoint)
                 if verbose:
                     print("evaluated exec score:", exec_score)
-                if exec_score:
-                    scores[hardness]['exec'] += 1
-                    scores[turn_id]['exec'] += 1
-                    scores['all']['exec'] += 1
-                    turn_scores['exec'].append(1)
-
-
-                else:
-                    turn_scores['exec'].append(0)
 
+            result = eval_pair(g_sql, p_sql, etype, DISABLE_VALUE, DISABLE_DISTINCT, exec_score=exec_score,
+                               fast_path=fast, partial=True, g_features=g_features)
+            exact_score = result.exact
             if etype in ["all", "match"]:
-                # rebuild sql for value evaluation
-                kmap = kmaps[db_name]
-                schema = Schema(get_schema(db))
-                g_sql = rebuild_sql_val(g_sql, DISABLE_VALUE)
-                p_sql = rebuild_sql_val(p_sql, DISABLE_VALUE)
-
-                # print("PREDICT:")
-                # print(p_str)
-                # print("GOLD:")
-                # print(g_str)
-                # print("GOLD SQL:")
-                # print(g_sql)
-                # print("PREDICT SQL:")
-                # print(p_sql)
-                # print("GOLD SQL2:")
-                # print(g_sql2)
-                # print("PREDICT SQL2:")
-                # print(p_sql2)
-
-                exact_score = evaluator.eval_exact_match(p_sql, g_sql, DISABLE_DISTINCT)
-
                 if verbose:
                     print("evaluated exact score:", exact_score)
                     print()
-                # g_sql2 = rebuild_sql_val(g_sql2, DISABLE_VALUE)
-                # p_sql2 = rebuild_sql_val(p_sql2, DISABLE_VALUE)
-
-                # exact_score_2 = evaluator.eval_exact_match(p_sql2, g_sql2, DISABLE_DISTINCT)
-
-                # if exact_score != exact_score_2:
-                #     print("ERROR")
-                #     print("EXACT SCORE:",exact_score)
-                #     print("EXACT SCORE 2:",exact_score_2)
-                #     exit()
-                # else:
-                #     print('good, keep going')
-
-
-
-                partial_scores = evaluator.partial_scores
-                if exact_score == 0:
-                    turn_scores['exact'].append(0)
-                else:
-                    turn_scores['exact'].append(1)
-                scores[turn_id]['exact'] += exact_score
-                scores[hardness]['exact'] += exact_score
-                scores['all']['exact'] += exact_score
-                for type_ in partial_types:
-                    if partial_scores[type_]['pred_total'] > 0:
-                        scores[hardness]['partial'][type_]['acc'] += partial_scores[type_]['acc']
-                        scores[hardness]['partial'][type_]['acc_count'] += 1
-                    if partial_scores[type_]['label_total'] > 0:
-                        scores[hardness]['partial'][type_]['rec'] += partial_scores[type_]['rec']
-                        scores[hardness]['partial'][type_]['rec_count'] += 1
-                    scores[hardness]['partial'][type_]['f1'] += partial_scores[type_]['f1']
-                    if partial_scores[type_]['pred_total'] > 0:
-                        scores['all']['partial'][type_]['acc'] += partial_scores[type_]['acc']
-                        scores['all']['partial'][type_]['acc_count'] += 1
-                    if partial_scores[type_]['label_total'] > 0:
-                        scores['all']['partial'][type_]['rec'] += partial_scores[type_]['rec']
-                        scores['all']['partial'][type_]['rec_count'] += 1
-                    scores['all']['partial'][type_]['f1'] += partial_scores[type_]['f1']
-
                 entries.append({
                     'predictSQL': p_str,
                     'goldSQL': g_str,
-                    'hardness': hardness,
+                    'hardness': result.hardness,
                     'exact': exact_score,
-                    'partial': partial_scores
+                    'partial': result.partial
                 })
             if etype == 'all':
-                # if exact_score == 0 and exec_score == 1:
-                #     print('ERROR')
-                #     print('PREDICT:',p_str)
-                #     print('GOLD:',g_str)
-                #     print('PREDICT SQL:',p_sql)
-                #     print('GOLD SQL:',g_sql)
-                #     exit()
-                if exact_score == 0 and exec_score == 0:
-                    with open("error.txt",'a') as f:
-                        f.write('ERROR\n')
-                        f.write('PREDICT:'+p_str+'\n')
-                        f.write('GOLD:'+g_str+'\n')
-                        f.write('DB:'+db+'\n')
-                        f.write('\n')
-
-        if all(v == 1 for v in turn_scores["exec"]):
-            scores['joint_all']['exec'] += 1
-
-        if all(v == 1 for v in turn_scores["exact"]):
-            scores['joint_all']['exact'] += 1
-
-    for turn in turns:
-        if scores[turn]['count'] == 0:
-            continue
-        if etype in ["all", "exec"]:
-            scores[turn]['exec'] /= scores[turn]['count']
+                if exact_score == 0 and exec_score == 0 and failure_log is not None:
+                    failure_log.add(p_str, g_str, db_name, result)
 
-        if etype in ["all", "match"]:
-            scores[turn]['exact'] /= scores[turn]['count']
+            accumulator.add(result, idx)
+        accumulator.end_session()
 
-    for level in levels:
-        if scores[level]['count'] == 0:
-            continue
-        if etype in ["all", "exec"]:
-            scores[level]['exec'] /= scores[level]['count']
-
-        if etype in ["all", "match"]:
-
-            scores[level]['exact'] /= scores[level]['count']
-            for type_ in partial_types:
-                if scores[level]['partial'][type_]['acc_count'] == 0:
-                    scores[level]['partial'][type_]['acc'] = 0
-                else:
-                    scores[level]['partial'][type_]['acc'] = scores[level]['partial'][type_]['acc'] / \
-                                                             scores[level]['partial'][type_]['acc_count'] * 1.0
-                if scores[level]['partial'][type_]['rec_count'] == 0:
-                    scores[level]['partial'][type_]['rec'] = 0
-                else:
-                    scores[level]['partial'][type_]['rec'] = scores[level]['partial'][type_]['rec'] / \
-                                                             scores[level]['partial'][type_]['rec_count'] * 1.0
-                if scores[level]['partial'][type_]['acc'] == 0 and scores[level]['partial'][type_]['rec'] == 0:
-                    scores[level]['partial'][type_]['f1'] = 1
-                else:
-                    scores[level]['partial'][type_]['f1'] = \
-                        2.0 * scores[level]['partial'][type_]['acc'] * scores[level]['partial'][type_]['rec'] / (
-                        scores[level]['partial'][type_]['rec'] + scores[level]['partial'][type_]['acc'])
-    
+    if failure_log is not None and etype == 'all':
+        failure_log.flush()
+    scores = accumulator.finalize()
+    include_turn_acc = accumulator.sessions() > 1
     if verbose:
         print_scores(scores, etype, include_turn_acc=include_turn_acc)
     # return scores['all']['exact']
@@ -1071,83 +1199,40 @@ def build_foreign_key_map(entry):
 
 
 def build_foreign_key_map_from_json(table):
-    with open(table) as f:
-        data = json.load(f)
-    tables = {}
-    for entry in data:
-        tables[entry['db_id']] = build_foreign_key_map(entry)
-    return tables
-def evalquery(gold, predict, db_dir, etype, plug_value, keep_distinct, progress_bar_for_each_datapoint, DISABLE_VALUE, DISABLE_DISTINCT, active_rules, verbose):
-    
-    evaluator = Evaluator()
-    turns = ['turn 1', 'turn 2', 'turn 3', 'turn 4', 'turn > 4']
-    levels = ['easy', 'medium', 'hard', 'extra', 'all', 'joint_all']
-
-    partial_types = ['select', 'select(no AGG)', 'where', 'where(no OP)', 'group(no Having)',
-                     'group', 'order', 'and/or', 'IUEN', 'keywords']
-    entries = []
-    scores = {}
-    scores['p_sql_not_valid'] = 0
-    for turn in turns:
-        scores[turn] = {'count': 0, 'exact': 0.}
-        scores[turn]['exec'] = 0
-
-    for level in levels:
-        scores[level] = {'count': 0, 'partial': {}, 'exact': 0.}
-        scores[level]['exec'] = 0
-        for type_ in partial_types:
-            scores[level]['partial'][type_] = {'acc': 0., 'rec': 0., 'f1': 0.,'acc_count':0,'rec_count':0}
-    idx = None
-    count = 0
+    # the map of a database is built the first time it is looked up
+    entries = load_entries(table)
+    return LazyMap(entries, lambda db_id: build_foreign_key_map(entries[db_id]))
 
+def evalquery(gold, predict, db_dir, etype, plug_value, keep_distinct, progress_bar_for_each_datapoint, DISABLE_VALUE, DISABLE_DISTINCT, active_rules, verbose):
     p_str = predict
     g_str = gold
-    db_name = db_dir.split('/')[-1].split('.sqlite')[0]
     db = db_dir
+    # the same query up to case, whitespace and semicolons: one validity check, then a match under every metric
+    if same_query(g_str, p_str) and isValidSQL(p_str, db):
+        if verbose:
+            print("same query, skipping evaluation")
+        if etype == "all":
+            return 1, 1
+        return 1
+    g_sql = p_sql = exec_score = None
     if etype in ['all', 'match']:
         if verbose:
             print('processing gold sql')
-            g_sql = get_sql(db, g_str,active_rules)
+        g_sql = parse_query(db, g_str, active_rules, verbose)
+        if verbose:
             print(g_sql)
-        else:
-            with contextlib.redirect_stdout(open(os.devnull, 'w')):
-                g_sql = get_sql(db, g_str, active_rules)
-
 
         try:
             if not isValidSQL(p_str, db):
                 raise Exception('SQL not valid.')
             if verbose:
                 print('processing pred sql')
-                p_sql = get_sql(db, p_str,active_rules)
-            else:
-                with contextlib.redirect_stdout(open(os.devnull, 'w')):
-                    p_sql = get_sql(db, p_str,active_rules)
+            p_sql = parse_query(db, p_str, active_rules, verbose)
 
         except Exception as e:
             # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
             if verbose:
                 print("PREDICT NOT VALID")
-            scores['p_sql_not_valid'] += 1
-            p_sql = {
-            "except": None,
-            "from": {
-                "conds": [],
-                "table_units": []
-            },
-            "groupBy": [],
-            "having": [],
-            "intersect": None,
-            "limit": None,
-            "orderBy": [],
-            "select": [
-                False,
-                []
-            ],
-            "union": None,
-            "where": []
-            }
-            p_sql2 = p_sql
     if etype in ["all", "exec"]:
         exec_score = eval_exec_match(db=db, p_str=p_str, g_str=g_str, plug_value=plug_value,
                                         keep_distinct=keep_distinct, progress_bar_for_each_datapoint=progress_bar_for_each_datapoint)
@@ -1156,26 +1241,18 @@ def evalquery(gold, predict, db_dir, etype, plug_value, keep_distinct, progress_
             print()
 
     if etype in ["all", "match"]:
-
-        schema = Schema(get_schema(db))
-        g_sql = rebuild_sql_val(g_sql, DISABLE_VALUE)
-        p_sql = rebuild_sql_val(p_sql, DISABLE_VALUE)
         if verbose:
-            print("p_sql:",p_sql)
+            print("p_sql:",p_sql if p_sql is not None else empty_sql())
             print("g_sql:",g_sql)
-        exact_score = evaluator.eval_exact_match(p_sql, g_sql, DISABLE_DISTINCT)
+        # partial scores are only needed to print them
+        result = eval_pair(g_sql, p_sql, etype, DISABLE_VALUE, DISABLE_DISTINCT, exec_score=exec_score, partial=verbose)
+        exact_score = result.exact
 
         if verbose:
             print("evaluated exact score:", exact_score)
             print()
+            print("Partials:",result.partial)
 
-
-
-        partial_scores = evaluator.partial_scores
-        if verbose:
-            print("Partials:",partial_scores)
-
-    # return scores['all']['exact']
     if etype == "all":
         return exec_score, exact_score
     if etype == "match":
@@ -1201,6 +1278,7 @@ if __name__ == "__main__":
     parser.add_argument('--disable_distinct', dest='DISABLE_DISTINCT', default=False, action='store_true',help='whether to disable distinct in select evaluation')
     parser.add_argument('--disable_rules', dest='disable_rules', default='none', help='whether to disable rules: none, all, or a list of rule numbers to disable separated by comma')
     parser.add_argument('--verbose',default=False, action='store_true')
+    parser.add_argument('--failure_log', dest='failure_log', type=str, default=None, help='json lines file to write the pairs failing both exact match and execution to')
     args = parser.parse_args()
 
     activeRules = [1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20]
@@ -1220,5 +1298,5 @@ if __name__ == "__main__":
     DISABLE_VALUE = args.DISABLE_VALUE
     DISABLE_DISTINCT = args.DISABLE_DISTINCT
     # args.verbose = True
-    print(evaluate(args.gold, args.pred, args.db, args.etype, kmaps, args.plug_value, not DISABLE_DISTINCT, args.progress_bar_for_each_datapoint, DISABLE_VALUE, DISABLE_DISTINCT,activeRules, args.verbose))
+    print(evaluate(args.gold, args.pred, args.db, args.etype, kmaps, args.plug_value, not DISABLE_DISTINCT, args.progress_bar_for_each_datapoint, DISABLE_VALUE, DISABLE_DISTINCT,activeRules, args.verbose, FailureLog(args.failure_log) if args.failure_log else None))
 
@@ -0,0 +1,56 @@
+"""
+Equivalence classes of columns that a query forces to be equal (join conditions a = b).
+Shared by the ESM fix rules (process_sql.fixRule16) and the ETM rules (treeMatch.rule19).
+"""
+
+
+class UnionFind:
+    """
+    Disjoint sets over hashable items (column ids or sqlglot Column nodes)
+    """
+    def __init__(self, items=()):
+        self._parent = {}
+        self._size = {}
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return item in self._parent
+
+    def __len__(self):
+        return len(self._parent)
+
+    def add(self, item):
+        if item not in self._parent:
+            self._parent[item] = item
+            self._size[item] = 1
+        return item
+
+    def find(self, item):
+        # returns the stored representative of item's class, adding item as a singleton if unseen
+        self.add(item)
+        parent = self._parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] += self._size[b]
+        return a
+
+    def same(self, a, b):
+        return a in self and b in self and self.find(a) == self.find(b)
+
+    def classes(self):
+        # every class as a list, members and classes in insertion order
+        groups = {}
+        for item in self._parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return list(groups.values())
@@ -24,7 +24,9 @@ import json
 import sqlite3
 import argparse
 
-from .process_sql import get_schema, Schema, get_sql
+from .process_sql import get_schema, cached_schema, Schema, get_sql
+from .equivalence import UnionFind
+from .tables_index import load_entries
 # from .exec_eval import eval_exec_match
 
 # Flag to disable value evaluation
@@ -501,11 +503,10 @@ def print_scores(scores, etype, include_turn_acc=True):
             print_formated_s("exact match", exact_scores, '{:<20.3f}')
 
 def evalquery(gold, predict, db, table, plug_value, keep_distinct):
-    kmaps = build_foreign_key_map_from_json(table)
     evaluator = Evaluator()
     p_str = predict.replace("value", "1")
     g_str = gold
-    schema = Schema(get_schema(db))
+    schema = Schema(cached_schema(db))
     
     g_sql = get_sql(schema, g_str)
     try:
@@ -532,7 +533,7 @@ def evalquery(gold, predict, db, table, plug_value, keep_distinct):
     # rebuild sql for value evaluation
     #db_name is between / and .sqlite
     db_name = db.split("/")[-1].split(".")[0]
-    kmap = kmaps[db_name]
+    kmap = get_foreign_key_map(table, db_name)
     g_valid_col_units = build_valid_col_units(g_sql['from']['table_units'], schema)
     g_sql = rebuild_sql_val(g_sql)
     g_sql = rebuild_sql_col(g_valid_col_units, g_sql, kmap)
@@ -918,39 +919,49 @@ def build_foreign_key_map(entry):
         else:
             cols.append("__all__")
 
-    def keyset_in_list(k1, k2, k_list):
-        for k_set in k_list:
-            if k1 in k_set or k2 in k_set:
-                return k_set
-        new_k_set = set()
-        k_list.append(new_k_set)
-        return new_k_set
-
-    foreign_key_list = []
-    foreign_keys = entry["foreign_keys"]
-    for fkey in foreign_keys:
-        key1, key2 = fkey
-        key_set = keyset_in_list(key1, key2, foreign_key_list)
-        key_set.add(key1)
-        key_set.add(key2)
+    # columns linked by a chain of foreign keys map to the lowest column of the chain
+    classes = UnionFind()
+    for key1, key2 in entry["foreign_keys"]:
+        classes.union(key1, key2)
 
     foreign_key_map = {}
-    for key_set in foreign_key_list:
-        sorted_list = sorted(list(key_set))
-        midx = sorted_list[0]
-        for idx in sorted_list:
+    for key_set in classes.classes():
+        midx = min(key_set)
+        for idx in key_set:
             foreign_key_map[cols[idx]] = cols[midx]
 
     return foreign_key_map
 
 
+# tables json files read by get_foreign_key_map, keyed by path:
+# {'mtime': ..., 'entries': {db_id: entry}, 'kmaps': {db_id: foreign key map}}
+KMAP_CACHE = {}
+
+
+def load_tables(table):
+    # cache entry of the tables json file table, read again if the file changed
+    mtime = os.path.getmtime(table)
+    cached = KMAP_CACHE.get(table)
+    if cached is None or cached['mtime'] != mtime:
+        cached = {'mtime': mtime, 'entries': load_entries(table), 'kmaps': {}}
+        KMAP_CACHE[table] = cached
+    return cached
+
+
+def get_foreign_key_map(table, db_id):
+    """
+    Foreign key map of db_id in the tables json file table. The file is read once per process (again if
+    it changes) and the map of a database is built the first time it is asked for.
+    """
+    cached = load_tables(table)
+    kmaps = cached['kmaps']
+    if db_id not in kmaps:
+        kmaps[db_id] = build_foreign_key_map(cached['entries'][db_id])
+    return kmaps[db_id]
+
+
 def build_foreign_key_map_from_json(table):
-    with open(table) as f:
-        data = json.load(f)
-    tables = {}
-    for entry in data:
-        tables[entry['db_id']] = build_foreign_key_map(entry)
-    return tables
+    return {db_id: get_foreign_key_map(table, db_id) for db_id in load_tables(table)['entries']}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+"""
+Canonical lexical key of a query, used to skip evaluation of pairs that are the same query.
+Two queries with the same key differ only in whitespace, comments, trailing semicolons and the
+case of keywords and unquoted identifiers, so they match under every metric.
+"""
+from sqlglot.dialects.dialect import Dialect
+from sqlglot.tokens import TokenType
+
+DIALECT = Dialect.get_or_raise('sqlite')
+
+
+def lexical_key(sql):
+    """Tuple of (token type, text) for the tokens of sql, or None if it doesn't tokenize."""
+    try:
+        tokens = DIALECT.tokenize(sql)
+    except Exception:
+        return None
+    while tokens and tokens[-1].token_type == TokenType.SEMICOLON:
+        tokens.pop()
+    key = []
+    for token in tokens:
+        # quoted identifiers are kept as they are: sqlite reads "x" as a string when there is no column x
+        if token.token_type in (TokenType.IDENTIFIER, TokenType.NUMBER) or token.token_type.name.endswith('STRING'):
+            key.append((token.token_type.name, token.text))
+        else:
+            key.append((token.token_type.name, token.text.lower()))
+    return tuple(key)
+
+
+def same_query(gold, pred):
+    key = lexical_key(gold)
+    return key is not None and key == lexical_key(pred)
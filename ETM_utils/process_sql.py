@@ -25,11 +25,12 @@
 # }
 ################################
 
+import os
 import json
+import time
 import sqlite3
-from nltk import word_tokenize
-from copy import deepcopy
-import networkx as nx
+from .equivalence import UnionFind
+from .sqlnodes import freeze
 
 CLAUSE_KEYWORDS = ('select', 'from', 'where', 'group', 'order', 'limit', 'intersect', 'union', 'except', 'partition')
 JOIN_KEYWORDS = ('join', 'on', 'as')
@@ -57,6 +58,7 @@ class Schema:
     def __init__(self, schema):
         self._schema = schema
         self._idMap = self._map(self._schema)
+        self._revMap = {value: key for key, value in self._idMap.items()}
 
     @property
     def schema(self):
@@ -66,6 +68,18 @@ class Schema:
     def idMap(self):
         return self._idMap
 
+    @property
+    def revMap(self):
+        # identifier -> "table.column" / "table" / "*"
+        return self._revMap
+
+    def tableColumn(self, col_id):
+        # identifier -> (table, column), None for '*', tables and unknown identifiers
+        name = self._revMap.get(col_id)
+        if name is None or '.' not in name:
+            return None
+        return tuple(name.split('.', 1))
+
     def _map(self, schema):
         idMap = {'*': "__all__"}
         id = 1
@@ -156,6 +170,60 @@ def get_schema(db):
     return schema
 
 
+# schemas read by cached_schema, keyed by database path: (modification time, schema)
+SCHEMA_CACHE = {}
+
+
+def cached_schema(db):
+    """
+    get_schema(db), reading each database file once (again if it changes).
+    Returns a new dict each time, since fixRule16 adds to the non_null and unique lists of the tables
+    """
+    try:
+        mtime = os.path.getmtime(db)
+    except OSError:
+        return get_schema(db)
+    cached = SCHEMA_CACHE.get(db)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, get_schema(db))
+        SCHEMA_CACHE[db] = cached
+    return {table: dict(info, non_null=list(info['non_null']), unique=list(info['unique']))
+            for table, info in cached[1].items()}
+
+
+def get_schema_from_entry(entry):
+    """
+    Build the same schema dict as get_schema from one tables.json entry,
+    for when the sqlite file itself is not available
+    :param entry: tables.json entry of one database
+    :return: schema dict
+    """
+    table_names = [name.lower() for name in entry['table_names_original']]
+    schema = {table: {'columns': [], 'primary_keys': [], 'foreign_keys': {}} for table in table_names}
+    columns = entry['column_names_original']
+    for table_id, col in columns:
+        if table_id >= 0 and col.lower() not in schema[table_names[table_id]]['columns']:
+            schema[table_names[table_id]]['columns'].append(col.lower())
+
+    primary_keys = []
+    for pk in entry['primary_keys']:
+        primary_keys += pk if isinstance(pk, list) else [pk]
+    for col_id in primary_keys:
+        table_id, col = columns[col_id]
+        schema[table_names[table_id]]['primary_keys'].append(col.lower())
+    for col_id, ref_id in entry['foreign_keys']:
+        table_id, col = columns[col_id]
+        ref_table_id, ref_col = columns[ref_id]
+        schema[table_names[table_id]]['foreign_keys'][col.lower()] = ".".join([table_names[ref_table_id], ref_col.lower()])
+
+    # tables.json has no constraint info beyond keys, so only a single primary key is unique and non null
+    for table in schema.values():
+        table['non_null'] = list(table['primary_keys']) if len(table['primary_keys']) == 1 else []
+        table['unique'] = list(table['non_null'])
+
+    return schema
+
+
 def get_schema_from_json(fpath):
     with open(fpath) as f:
         data = json.load(f)
@@ -196,6 +264,7 @@ def tokenize(string): # this tokenizes the string, accounting for quotes and !=,
         string = string[:qidx1] + key + string[qidx2+1:]
         vals[key] = val
     
+    from nltk import word_tokenize # nltk is slow to import, so it is loaded the first time a query is tokenized
     toks = [word.lower() for word in word_tokenize(string)] # split into individual words/tokens
     # replace with string value token
     for i in range(len(toks)):
@@ -851,9 +920,8 @@ def fixRule7(sql,schema, active_rules):
                 if isDistinct:
                     break
                 if agg_id == 0:
-                    for key, value in schema.idMap.items():
-                        if value == col_id:
-                            col_name = key
+                    if col_id in schema.revMap:
+                        col_name = schema.revMap[col_id]
                     if col_name == "*" or col_name == "__all__":
                         continue
                     table_name = col_name.split(".")[0]
@@ -874,9 +942,8 @@ def fixRule7(sql,schema, active_rules):
             if isDistinct:
                 break
             if agg_id == 3:
-                for key, value in schema.idMap.items():
-                    if value == col_id:
-                        col_name = key
+                if col_id in schema.revMap:
+                    col_name = schema.revMap[col_id]
                 if col_name == "*" or col_name == "__all__":
                     continue
                 table_name = col_name.split(".")[0]
@@ -901,9 +968,8 @@ def fixRule7(sql,schema, active_rules):
             if isDistinct:
                 break
             if agg_id == 3:
-                for key, value in schema.idMap.items():
-                    if value == col_id:
-                        col_name = key
+                if col_id in schema.revMap:
+                    col_name = schema.revMap[col_id]
                 if col_name == "*" or col_name == "__all__":
                     continue
                 table_name = col_name.split(".")[0]
@@ -928,9 +994,8 @@ def fixRule7(sql,schema, active_rules):
                 if isDistinct:
                     break
                 if agg_id == 3:
-                    for key, value in schema.idMap.items():
-                        if value == col_id:
-                            col_name = key
+                    if col_id in schema.revMap:
+                        col_name = schema.revMap[col_id]
                     if col_name == "*" or col_name == "__all__":
                         continue
                     table_name = col_name.split(".")[0]
@@ -973,9 +1038,8 @@ def fixRule3(sql, schema, active_rules):
         if type(col_unit1) != tuple:
             continue
         agg_id, col_id, isDistinct,t = col_unit1
-        for key, value in schema.idMap.items():
-            if value == col_id:
-                col_name = key
+        if col_id in schema.revMap:
+            col_name = schema.revMap[col_id]
         if col_name != '*':
             table_name = col_name.split(".")[0]
             col_name = col_name.split(".")[1]
@@ -1038,9 +1102,8 @@ def fixRule6(sql,schema,active_rules):
     if type(col_unit1) != tuple:
         return
     agg_id, col_id, isDistinct,t = col_unit1
-    for key, value in schema.idMap.items():
-        if value == col_id:
-            col = key
+    if col_id in schema.revMap:
+        col = schema.revMap[col_id]
     table_name = col.split(".")[0]
 
     if col == "*" or col == "__all__":
@@ -1068,10 +1131,8 @@ def fixRule6(sql,schema,active_rules):
         return
     agg_id, col_id, isDistinct,t = col1
 
-    for key, value in schema.idMap.items():
-
-        if value == col_id:
-            wherecol = key
+    if col_id in schema.revMap:
+        wherecol = schema.revMap[col_id]
         
     table_name = wherecol.split(".")[0]
     if wherecol == "*" or wherecol == "__all__":
@@ -1143,9 +1204,8 @@ def fixRule2(sql,schema,active_rules):
             if type(col_unit1) != tuple:
                 continue
             agg_id, col_id, isDistinct,t = col_unit1
-            for key, value in schema.idMap.items():
-                if value == col_id:
-                    col_name = key
+            if col_id in schema.revMap:
+                col_name = schema.revMap[col_id]
             table_name = col_name.split(".")[0]
             col_name = col_name.split(".")[1]
             if col_name in schema.schema[table_name]['unique']:
@@ -1156,9 +1216,8 @@ def fixRule2col(schema,col_id,distinct, active_rules):
     if 2 not in active_rules:
         return distinct
     if distinct:
-        for key, value in schema.idMap.items():
-            if value == col_id:
-                col_name = key
+        if col_id in schema.revMap:
+            col_name = schema.revMap[col_id]
         if col_name == "*" or col_name == "__all__":
             print("Applying Rule 2: 'DISTINCT col' equivalent to 'col' if col is UNIQUE")
             return False
@@ -1201,9 +1260,8 @@ def fixRule4(sql, schema, active_rules):
         if type(col_unit1) != tuple:
             continue
         agg_id, col_id, isDistinct,t = col_unit1
-        for key, value in schema.idMap.items():
-            if value == col_id:
-                col_name = key
+        if col_id in schema.revMap:
+            col_name = schema.revMap[col_id]
         if col_name != '*':
             table_name = col_name.split(".")[0]
             col_name = col_name.split(".")[1]
@@ -1626,9 +1684,8 @@ def fixRule10(sql,schema,active_rules):
     for table in tables:
         if table[0] == 'table_unit':
             table_id = table[1]
-            for key, value in schema.idMap.items():
-                if value == table_id:
-                    table_name = key
+            if table_id in schema.revMap:
+                table_name = schema.revMap[table_id]
             assert table_name in schema.schema, "Table not in schema"
             for col in schema.schema[table_name]['columns']:
                 list_of_all_cols.append(schema.idMap[table_name + "." + col])
@@ -1691,9 +1748,8 @@ def fixRule8(not_op, op_id, val_unit, val1, val2,schema,active_rules):
             agg_id, col_id, isDistinct,t = col1
             if agg_id != 0:
                 return False
-            for key, value in schema.idMap.items():
-                if value == col_id:
-                    col_name = key
+            if col_id in schema.revMap:
+                col_name = schema.revMap[col_id]
             table_name = col_name.split(".")[0]
             col_name = col_name.split(".")[1]
             if col_name in schema.schema[table_name]['non_null']:
@@ -1800,9 +1856,8 @@ def fixRule1(sql, schema, active_rules):
         return
     col_id = sub_col_unit1[1]
     col_name = None
-    for key, value in schema.idMap.items():
-        if value == col_id:
-            col_name = key
+    if col_id in schema.revMap:
+        col_name = schema.revMap[col_id]
     if not col_name:
         return
     if col_name == "*" or col_name == "__all__":
@@ -1821,7 +1876,7 @@ def fixRule16(sql, schema, active_rules):
         return
     # if join exists with = and one of the col_units in the entire query are the ones in joins then replace.
     join_conditions = sql['from']['conds']
-    join_cols = []
+    classes = UnionFind()
 
     if join_conditions:
         for join_condition in join_conditions[::2]:
@@ -1854,50 +1909,17 @@ def fixRule16(sql, schema, active_rules):
             if t:
                 continue
 
-            join_cols.append({col1, col2})
-        #aggregate all the join_cols
-        G = nx.Graph()
-        for s in join_cols:
-            node_list = list(s)
-            if len(node_list)==2:
-                G.add_edge(node_list[0], node_list[1])
-            elif len(node_list) == 1:
-                G.add_node(node_list[0])
-        connected_components = list(nx.connected_components(G))
-        join_cols = [component for component in connected_components]
-
-        join_cols = [sorted(list(i)) for i in join_cols]
-        join_cols = sorted(join_cols)
+            classes.union(col1, col2)
+        join_cols = sorted(sorted(c) for c in classes.classes())
         for j in join_cols:
-            for col in j:
-                for key,value in schema.idMap.items():
-                    if value == col:
-                        col_name = key
-                table_name = col_name.split('.')[0]
-                col_name = col_name.split('.')[1]
-                if col_name in schema.schema[table_name]['non_null']:
-                    # all values in j should be non_null
-                    for col in j:
-                        for key, value in schema.idMap.items():
-                            if value == col:
-                                col_name = key
-                        table_name = col_name.split('.')[0]
-                        col_name = col_name.split('.')[1]
-                        if col_name not in schema.schema[table_name]['non_null']:
-                            schema.schema[table_name]['non_null'].append(col_name)
-                if col_name in schema.schema[table_name]['unique']:
-                    # all values in j should be non_null
-                    for col in j:
-                        for key, value in schema.idMap.items():
-                            if value == col:
-                                col_name = key
-                        table_name = col_name.split('.')[0]
-                        col_name = col_name.split('.')[1]
-                        if col_name not in schema.schema[table_name]['unique']:
-                            schema.schema[table_name]['unique'].append(col_name)
-
+            # if one column of a class is non_null (unique), all of them are
+            names = [schema.tableColumn(col) for col in j]
+            for prop in ('non_null', 'unique'):
+                if any(name and name[1] in schema.schema[name[0]][prop] for name in names):
+                    for name in names:
+                        if name and name[1] not in schema.schema[name[0]][prop]:
+                            schema.schema[name[0]][prop].append(name[1])
 
-        
         def change_select_col_units():
             val_units_with_agg = sql['select'][1]
             for idx, val_unit_with_agg in enumerate(val_units_with_agg):
@@ -2036,22 +2058,132 @@ def fixRule5(sql, schema, active_rules):
 def fixRule18(sql, schema, active_rules):
     if 18 not in active_rules:
         return
+    # frozen queries are compared by hash, without copying them
     if sql['intersect']:
-        sql_copy = deepcopy(sql)
-        sql_copy['intersect'] = None
-        if sql_copy == sql['intersect']:
+        if freeze(dict(sql, intersect=None)) == freeze(sql['intersect']):
             print("Applying Rule 18: Intersect with same query is equivalent to same query")
             sql['intersect'] = None
 
     if sql['union']:
-        sql_copy = deepcopy(sql)
-        sql_copy['union'] = None
-        if sql_copy == sql['union']:
+        if freeze(dict(sql, union=None)) == freeze(sql['union']):
             print("Applying Rule 18: Union with same query is equivalent to same query")
             sql['union'] = None
+# features of a sql block, each needed by some fixRule to change anything
+F_JOIN_CONDS = 1 << 0      # from has join conditions
+F_INTERSECT = 1 << 1
+F_UNION = 1 << 2
+F_WHERE_SUBQUERY = 1 << 3  # a where condition compares with a subquery
+F_BETWEEN = 1 << 4         # a where condition is a between
+F_GROUP = 1 << 5
+F_COUNT = 1 << 6           # count in select, group by, having or order by
+F_DISTINCT = 1 << 7        # select distinct
+F_PLAIN_SELECT = 1 << 8    # select only has columns, without aggregates or operators
+F_TOP1 = 1 << 9            # order by with limit 1
+
+
+def has_count_col(col_unit):
+    return type(col_unit) == tuple and col_unit[0] == 3
+
+
+def block_feature_bits(sql):
+    """Bitmap of the F_* features of a sql block (not of its subqueries)."""
+    try:
+        return block_features(sql)
+    except (TypeError, IndexError, ValueError, KeyError):
+        # a block of an unexpected shape is left to every fixRule
+        return ~0
+
+
+def block_features(sql):
+    features = 0
+    if sql['from']['conds']:
+        features |= F_JOIN_CONDS
+    if sql['intersect'] is not None:
+        features |= F_INTERSECT
+    if sql['union'] is not None:
+        features |= F_UNION
+    for cond in sql['where'][::2]:
+        if type(cond[3]) == dict:
+            features |= F_WHERE_SUBQUERY
+        if cond[1] == 1:
+            features |= F_BETWEEN
+    if sql['groupBy']:
+        features |= F_GROUP
+    is_distinct, val_units = sql['select']
+    if is_distinct:
+        features |= F_DISTINCT
+    plain = True
+    for agg_id, val_unit in val_units:
+        if agg_id == 3:
+            features |= F_COUNT
+        if agg_id != 0 or type(val_unit) != tuple or val_unit[0] != 0 or type(val_unit[1]) != tuple \
+                or val_unit[1][0] != 0 or val_unit[1][3]:
+            plain = False
+    if plain:
+        features |= F_PLAIN_SELECT
+    if any(has_count_col(col_unit) for col_unit in sql['groupBy']):
+        features |= F_COUNT
+    for cond in sql['having'][::2]:
+        if type(cond[2]) != tuple or has_count_col(cond[2][1]):
+            features |= F_COUNT
+    if sql['orderBy']:
+        if any(type(val_unit) != tuple or has_count_col(val_unit[1]) for val_unit in sql['orderBy'][1]):
+            features |= F_COUNT
+        if sql['limit'] == 1:
+            features |= F_TOP1
+    return features
+
+
+# fixRules in the order parse_sql applies them, each with the features it can act on (it is skipped without any)
+FIX_RULES = [
+    (fixRule13, F_JOIN_CONDS),
+    (fixRule16, F_JOIN_CONDS),
+    (fixRule3, F_INTERSECT),
+    (fixRule4, F_UNION),
+    (fixRule1, F_WHERE_SUBQUERY),
+    (fixRule9, F_TOP1),
+    (fixRule10, F_PLAIN_SELECT),
+    (fixRule17, F_WHERE_SUBQUERY),
+    (fixRule7, F_COUNT),
+    (fixRule6, F_WHERE_SUBQUERY),
+    (fixRule2, F_DISTINCT),
+    (fixRule12, F_WHERE_SUBQUERY),
+    (fixRule19, F_BETWEEN),
+    (fixRule5, F_GROUP),
+    (fixRule18, F_INTERSECT | F_UNION),
+]
+# set to False to call every fixRule on every block
+SKIP_FIX_RULES = True
+# calls, skips and seconds spent per fixRule since the last reset
+FIX_RULE_STATS = {}
+
+
+def reset_fix_rule_stats():
+    FIX_RULE_STATS.clear()
+    FIX_RULE_STATS.update({fix.__name__: {'calls': 0, 'skipped': 0, 'time': 0.0} for fix, _ in FIX_RULES})
+
+
+reset_fix_rule_stats()
+
+
+def apply_fix_rules(sql, schema, active_rules):
+    features = block_feature_bits(sql)
+    for fix, trigger in FIX_RULES:
+        stats = FIX_RULE_STATS[fix.__name__]
+        if SKIP_FIX_RULES and not features & trigger:
+            stats['skipped'] += 1
+            continue
+        start = time.perf_counter()
+        fix(sql, schema, active_rules)
+        stats['time'] += time.perf_counter() - start
+        stats['calls'] += 1
+        # a rule can add features for the ones after it (e.g. rule 1 adds order by ... limit 1 for rule 9)
+        features = block_feature_bits(sql)
+
+
 def parse_sql(toks, start_idx, db,active_rules):
     # print(toks)
-    schema = Schema(get_schema(db))
+    schema = Schema(cached_schema(db))
     tables_with_alias = get_tables_with_alias(schema.schema, toks)
 
 
@@ -2104,21 +2236,7 @@ def parse_sql(toks, start_idx, db,active_rules):
         idx += 1
         idx, IUE_sql = parse_sql(toks, idx, db,active_rules)
         sql[sql_op] = IUE_sql
-    fixRule13(sql,schema, active_rules)
-    fixRule16(sql,schema, active_rules)
-    fixRule3(sql,schema, active_rules)
-    fixRule4(sql,schema, active_rules)
-    fixRule1(sql,schema, active_rules)
-    fixRule9(sql,schema, active_rules)
-    fixRule10(sql,schema, active_rules)
-    fixRule17(sql,schema, active_rules)
-    fixRule7(sql,schema, active_rules)
-    fixRule6(sql,schema, active_rules)
-    fixRule2(sql,schema, active_rules)
-    fixRule12(sql,schema, active_rules)
-    fixRule19(sql, schema, active_rules)
-    fixRule5(sql, schema, active_rules)
-    fixRule18(sql, schema, active_rules)
+    apply_fix_rules(sql, schema, active_rules)
 
     return idx, sql
 
@@ -0,0 +1,198 @@
+"""
+Immutable form of the SQL dict built by process_sql.get_sql.
+
+freeze turns every unit of a parsed query into a slotted node that holds its fields and a cached hash.
+Equal nodes are interned, so a frozen query shares its parts with every other frozen query that has the
+same parts, and comparing two frozen queries (or any two of their parts) is almost always an identity or
+hash check. Nodes can be read like the values they were frozen from (tuple units are indexed and unpacked,
+sql and other dicts are looked up by key), and thaw gives back the plain dicts, lists and tuples that the
+eval_* functions of ETM.py expect.
+"""
+import weakref
+
+# one node per distinct value, kept while the value is in use
+_interned = weakref.WeakValueDictionary()
+# the types of the items of a node, shared by every node with the same types
+_types = {}
+
+
+class Node:
+    """Frozen tuple: indexing, len, iteration and unpacking work as on the tuple it was frozen from."""
+    __slots__ = ('_key', '_hash', '__weakref__')
+
+    def __new__(cls, *items):
+        # values such as 1, 1.0 and True are equal, but each keeps its own node so that thaw returns it.
+        # The interning key is also what the node holds, so it is stored once
+        types = tuple(map(type, items))
+        key = (cls, items, _types.setdefault(types, types))
+        node = _interned.get(key)
+        if node is None:
+            node = object.__new__(cls)
+            object.__setattr__(node, '_key', key)
+            object.__setattr__(node, '_hash', hash((cls, items)))
+            _interned[key] = node
+        return node
+
+    @property
+    def _items(self):
+        return self._key[1]
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        return type(self), self._items
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._hash == other._hash and self._items == other._items
+
+    def __getitem__(self, idx):
+        return self._items[idx]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __repr__(self):
+        return type(self).__name__ + repr(self._items)
+
+    def thaw(self):
+        return tuple(thaw(item) for item in self._items)
+
+
+def field(idx):
+    return property(lambda self: self._items[idx])
+
+
+class ColUnit(Node):
+    # (agg_id, col_id, isDistinct(bool)[, time])
+    __slots__ = ()
+    agg_id, col_id, isDistinct = field(0), field(1), field(2)
+
+
+class ValUnit(Node):
+    # (unit_op, col_unit1, col_unit2)
+    __slots__ = ()
+    unit_op, col_unit1, col_unit2 = field(0), field(1), field(2)
+
+
+class CondUnit(Node):
+    # (not_op, op_id, val_unit, val1, val2)
+    __slots__ = ()
+    not_op, op_id, val_unit, val1, val2 = field(0), field(1), field(2), field(3), field(4)
+
+
+class TableUnit(Node):
+    # (table_type, col_unit/sql)
+    __slots__ = ()
+    table_type, table = field(0), field(1)
+
+
+class Tuple(Node):
+    # any other tuple, e.g. (agg_id, val_unit) of a select or (isDistinct, [...]) of the select clause
+    __slots__ = ()
+
+
+class List(Node):
+    # conditions, table units, group by, ...
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'List' + repr(list(self._items))
+
+    def thaw(self):
+        return [thaw(item) for item in self._items]
+
+
+class Map(Node):
+    """Frozen dict of (key, value) pairs sorted by key, read like the dict."""
+    __slots__ = ('_index',)
+
+    def __new__(cls, *items):
+        node = super().__new__(cls, *items)
+        # a new node gets the dict its lookups go through, an interned one already has it
+        if not hasattr(node, '_index'):
+            object.__setattr__(node, '_index', dict(items))
+        return node
+
+    def __getitem__(self, key):
+        return self._index[key]
+
+    def get(self, key, default=None):
+        return self._index.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return (k for k, _ in self._items)
+
+    def keys(self):
+        return [k for k, _ in self._items]
+
+    def values(self):
+        return [value for _, value in self._items]
+
+    def items(self):
+        return list(self._items)
+
+    def __repr__(self):
+        return type(self).__name__ + repr(dict(self._items))
+
+    def thaw(self):
+        # keys in the order the parser adds them
+        ordered = sorted(self._items, key=lambda item: KEY_ORDER.get(item[0], len(KEY_ORDER)))
+        return {k: thaw(value) for k, value in ordered}
+
+
+class SQL(Map):
+    __slots__ = ()
+
+
+KEY_ORDER = {key: i for i, key in enumerate(('from', 'select', 'where', 'groupBy', 'having', 'orderBy', 'limit',
+                                             'intersect', 'union', 'except', 'table_units', 'conds', 'partition', 'order'))}
+
+
+def unit_type(items):
+    # the node type of a tuple unit, from its shape (equal tuples always get the same type)
+    if len(items) == 2 and items[0] in ('table_unit', 'sql'):
+        return TableUnit
+    if len(items) == 5 and type(items[1]) is int and type(items[2]) is ValUnit:
+        return CondUnit
+    if len(items) == 3 and type(items[0]) is int and (type(items[1]) is ColUnit or items[1] is None) \
+            and (type(items[2]) is ColUnit or items[2] is None):
+        return ValUnit
+    if len(items) in (3, 4) and type(items[0]) is int and type(items[1]) is str and type(items[2]) is bool:
+        return ColUnit
+    return Tuple
+
+
+def freeze(value):
+    """Interned node of a parsed query or any part of it, equal to another exactly when the values are."""
+    if isinstance(value, Node):
+        return value
+    if isinstance(value, tuple):
+        items = tuple(freeze(item) for item in value)
+        return unit_type(items)(*items)
+    if isinstance(value, list):
+        return List(*(freeze(item) for item in value))
+    if isinstance(value, dict):
+        items = tuple(sorted(((k, freeze(v)) for k, v in value.items()), key=lambda item: item[0]))
+        return (SQL if 'select' in value else Map)(*items)
+    return value
+
+
+def thaw(value):
+    """Plain (mutable) dicts, lists and tuples of a frozen value, as get_sql returns them."""
+    if isinstance(value, Node):
+        return value.thaw()
+    return value
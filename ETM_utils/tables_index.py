@@ -0,0 +1,215 @@
+"""
+Compiled form of a tables.json file.
+
+json.load on a whole tables.json (200 databases for spider_test) is most of what a tool that needs the
+schema of a few databases spends at startup. compile_tables writes the entries once into an index file
+next to it: a header, the offset of every database's record and its db_id, then one record per database
+holding its table, column, primary key and foreign key arrays. TablesIndex memory maps that file and only
+decodes the record of a db_id when it is asked for, giving back the same entry dict as tables.json.
+
+    python -m ETM_utils.tables_index spider_test/tables.json cosql_dev/tables.json
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+from collections.abc import Mapping
+
+MAGIC = b'ETMT'
+VERSION = 1
+# magic, version, number of databases, mtime (ns) and size of the tables.json it was compiled from
+HEADER = struct.Struct('<4sIIqq')
+# tables, columns, primary keys, primary key columns, foreign keys
+COUNTS = struct.Struct('<5I')
+LENGTH = struct.Struct('<I')
+# string arrays of an entry, stored after its int arrays
+STRING_FIELDS = ('table_names_original', 'table_names', 'column_names_original', 'column_names', 'column_types')
+
+
+def index_path(table):
+    # spider_test/tables.json -> spider_test/tables.idx
+    return os.path.splitext(table)[0] + '.idx'
+
+
+def pack_strings(strings):
+    # NUL separated utf-8, prefixed by its length
+    blob = '\0'.join(strings).encode('utf-8')
+    return LENGTH.pack(len(blob)) + blob
+
+
+def unpack_strings(buf, offset, count):
+    (length,) = LENGTH.unpack_from(buf, offset)
+    offset += LENGTH.size
+    strings = bytes(buf[offset:offset + length]).decode('utf-8').split('\0') if count else []
+    return strings, offset + length
+
+
+def pack_entry(entry):
+    columns = entry['column_names_original']
+    # a primary key is a column id or a list of column ids (composite keys in bird); size 0 marks a single id
+    pk_sizes, pk_ids = [], []
+    for pk in entry['primary_keys']:
+        pk_sizes.append(len(pk) if isinstance(pk, list) else 0)
+        pk_ids += pk if isinstance(pk, list) else [pk]
+    fk_ids = [col_id for pair in entry['foreign_keys'] for col_id in pair]
+
+    record = [COUNTS.pack(len(entry['table_names_original']), len(columns), len(pk_sizes), len(pk_ids), len(entry['foreign_keys']))]
+    # column_names and column_names_original don't always give a column the same table (formula_1 in spider_test)
+    record.append(struct.pack(f'<{len(columns)}i', *(table_id for table_id, _ in columns)))
+    record.append(struct.pack(f'<{len(columns)}i', *(table_id for table_id, _ in entry['column_names'])))
+    record.append(struct.pack(f'<{len(pk_sizes)}I', *pk_sizes))
+    record.append(struct.pack(f'<{len(pk_ids)}I', *pk_ids))
+    record.append(struct.pack(f'<{len(fk_ids)}I', *fk_ids))
+    for field in STRING_FIELDS:
+        record.append(pack_strings(col if isinstance(col, str) else col[1] for col in entry[field]))
+    return b''.join(record)
+
+
+def unpack_entry(buf, offset, db_id):
+    n_tables, n_cols, n_pks, n_pk_ids, n_fks = COUNTS.unpack_from(buf, offset)
+    offset += COUNTS.size
+    table_ids = struct.unpack_from(f'<{n_cols}i', buf, offset)
+    offset += 4 * n_cols
+    name_table_ids = struct.unpack_from(f'<{n_cols}i', buf, offset)
+    offset += 4 * n_cols
+    pk_sizes = struct.unpack_from(f'<{n_pks}I', buf, offset)
+    offset += 4 * n_pks
+    pk_ids = struct.unpack_from(f'<{n_pk_ids}I', buf, offset)
+    offset += 4 * n_pk_ids
+    fk_ids = struct.unpack_from(f'<{2 * n_fks}I', buf, offset)
+    offset += 8 * n_fks
+
+    strings = {}
+    for field, count in zip(STRING_FIELDS, (n_tables, n_tables, n_cols, n_cols, n_cols)):
+        strings[field], offset = unpack_strings(buf, offset, count)
+
+    primary_keys, i = [], 0
+    for size in pk_sizes:
+        primary_keys.append(list(pk_ids[i:i + size]) if size else pk_ids[i])
+        i += size or 1
+
+    return {
+        'column_names': [[table_id, name] for table_id, name in zip(name_table_ids, strings['column_names'])],
+        'column_names_original': [[table_id, name] for table_id, name in zip(table_ids, strings['column_names_original'])],
+        'column_types': strings['column_types'],
+        'db_id': db_id,
+        'foreign_keys': [[fk_ids[i], fk_ids[i + 1]] for i in range(0, len(fk_ids), 2)],
+        'primary_keys': primary_keys,
+        'table_names': strings['table_names'],
+        'table_names_original': strings['table_names_original'],
+    }
+
+
+def compile_tables(table, out=None):
+    """
+    Write the index of the tables json file table to out (default: index_path(table)).
+    :return: path of the index
+    """
+    out = out or index_path(table)
+    with open(table) as f:
+        entries = json.load(f)
+    stat = os.stat(table)
+
+    records = [pack_entry(entry) for entry in entries]
+    db_ids = pack_strings(entry['db_id'] for entry in entries)
+    # records start after the header, the n + 1 record offsets and the db_ids
+    offset = HEADER.size + 8 * (len(records) + 1) + len(db_ids)
+    offsets = []
+    for record in records:
+        offsets.append(offset)
+        offset += len(record)
+    offsets.append(offset)
+
+    tmp = out + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), stat.st_mtime_ns, stat.st_size))
+        f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+        f.write(db_ids)
+        f.writelines(records)
+    os.replace(tmp, out)
+    return out
+
+
+class TablesIndex(Mapping):
+    """Read only {db_id: tables.json entry} over a compiled index; each entry is decoded on first access."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_dbs, self.mtime_ns, self.size = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} tables index")
+        self._offsets = struct.unpack_from(f'<{n_dbs + 1}Q', self._buf, HEADER.size)
+        db_ids, _ = unpack_strings(self._buf, HEADER.size + 8 * (n_dbs + 1), n_dbs)
+        self._positions = {db_id: i for i, db_id in enumerate(db_ids)}
+        self._entries = {}
+
+    def __getitem__(self, db_id):
+        entry = self._entries.get(db_id)
+        if entry is None:
+            i = self._positions[db_id]
+            entry = unpack_entry(self._buf, self._offsets[i], db_id)
+            self._entries[db_id] = entry
+        return entry
+
+    def __contains__(self, db_id):
+        return db_id in self._positions
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def fresh(self, table):
+        # whether the index was compiled from the current version of the tables json file table
+        stat = os.stat(table)
+        return (self.mtime_ns, self.size) == (stat.st_mtime_ns, stat.st_size)
+
+
+class LazyMap(Mapping):
+    """{key: build(key)} over the keys of another mapping, each value built on first access."""
+
+    def __init__(self, keys, build):
+        self._keys = keys
+        self._build = build
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self._keys:
+                raise KeyError(key)
+            self._values[key] = self._build(key)
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def load_entries(table):
+    """
+    {db_id: entry} of the tables json file table, from its compiled index when there is one that is up
+    to date (entries are then decoded lazily), otherwise from the json file itself.
+    """
+    path = index_path(table)
+    if os.path.exists(path):
+        try:
+            index = TablesIndex(path)
+            if index.fresh(table):
+                return index
+        except (OSError, ValueError, struct.error):
+            pass
+    with open(table) as f:
+        return {entry['db_id']: entry for entry in json.load(f)}
+
+
+if __name__ == "__main__":
+    for table in sys.argv[1:]:
+        print(f"{table} -> {compile_tables(table)}")
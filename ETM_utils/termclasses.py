@@ -0,0 +1,39 @@
+"""
+Whole query trees grouped into equivalence classes.
+Terms are added under a structural key, so a term reached from two different starting
+points is stored once, and every rewrite unions the class of its input with the class
+of its output. Two terms are proven equal as soon as they fall into the same class.
+"""
+from .equivalence import UnionFind
+
+
+class TermClasses:
+    def __init__(self):
+        self._ids = {}
+        self._terms = []
+        self._classes = UnionFind()
+
+    def __len__(self):
+        return len(self._terms)
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def add(self, key, term):
+        # returns (node id, whether the term is new)
+        if key in self._ids:
+            return self._ids[key], False
+        node = len(self._terms)
+        self._ids[key] = node
+        self._terms.append(term)
+        self._classes.add(node)
+        return node, True
+
+    def term(self, node):
+        return self._terms[node]
+
+    def union(self, a, b):
+        return self._classes.union(a, b)
+
+    def same(self, a, b):
+        return self._classes.find(a) == self._classes.find(b)
@@ -0,0 +1,70 @@
+"""
+fixRule benchmark: parses the queries of gold/prediction files with process_sql, once calling every fixRule
+on every SQL block and once skipping the fixRules whose trigger features the block doesn't have, and reports
+the calls, skips and time of each fixRule. Both runs must give the same parsed queries.
+
+    python -m benchmarks.fixrules --gold spider_test/gold.txt --pred spider_test/C3.txt,spider_test/DAIL.txt --db spider_test/database/
+"""
+import io
+import os
+import time
+import argparse
+import contextlib
+
+from ETM_utils import process_sql
+
+RULES = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
+
+
+def readQueries(goldfile, predfiles):
+    # (query, db_id) of the gold file and every prediction file
+    with open(goldfile) as f:
+        golds = [line.split('\t') for line in f.read().splitlines() if line.strip()]
+    queries = [(gold[0].strip(), gold[1].strip()) for gold in golds]
+    for predfile in predfiles:
+        with open(predfile) as f:
+            preds = [line for line in f.read().splitlines() if line.strip()]
+        queries += [(pred.strip(), gold[1].strip()) for pred, gold in zip(preds, golds)]
+    return queries
+
+
+def parseAll(queries, db_dir, skip):
+    process_sql.SKIP_FIX_RULES = skip
+    process_sql.reset_fix_rule_stats()
+    parsed = []
+    start = time.perf_counter()
+    for query, db_id in queries:
+        db = os.path.join(db_dir, db_id, db_id + ".sqlite")
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                parsed.append(repr(process_sql.get_sql(db, query, RULES)))
+        except Exception as e:
+            parsed.append(type(e).__name__)
+    elapsed = time.perf_counter() - start
+    process_sql.SKIP_FIX_RULES = True
+    return parsed, elapsed, {name: dict(stats) for name, stats in process_sql.FIX_RULE_STATS.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gold', type=str, default='spider_test/gold.txt', help='file containing the gold data')
+    parser.add_argument('--pred', type=str, default='', help='prediction files, separated by commas')
+    parser.add_argument('--db', type=str, default='spider_test/database/', help='folder containing the database files')
+    args = parser.parse_args()
+
+    queries = readQueries(args.gold, [p for p in args.pred.split(',') if p])
+    # the first pass also warms the schema and tokenizer caches
+    parseAll(queries, args.db, True)
+    every, every_time, every_stats = parseAll(queries, args.db, False)
+    skipped, skip_time, skip_stats = parseAll(queries, args.db, True)
+    first = skip_stats[process_sql.FIX_RULES[0][0].__name__]
+    print(f"queries: {len(queries)}, sql blocks: {first['calls'] + first['skipped']}")
+    print(f"{'fixRule':<10} {'calls (all)':>12} {'calls':>8} {'skipped':>8} {'ms (all)':>10} {'ms':>8}")
+    for name in every_stats:
+        print(f"{name:<10} {every_stats[name]['calls']:>12} {skip_stats[name]['calls']:>8} {skip_stats[name]['skipped']:>8} "
+              f"{every_stats[name]['time'] * 1000:>10.1f} {skip_stats[name]['time'] * 1000:>8.1f}")
+    rule_time = lambda stats: sum(s['time'] for s in stats.values()) * 1000
+    print(f"time in fixRules: {rule_time(every_stats):.1f} ms -> {rule_time(skip_stats):.1f} ms")
+    print(f"parse time: {every_time:.2f}s -> {skip_time:.2f}s")
+    different = sum(a != b for a, b in zip(every, skipped))
+    print(f"queries parsed differently: {different}")
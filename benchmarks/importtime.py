@@ -0,0 +1,90 @@
+"""
+Import-time benchmark: how long a fresh interpreter takes to import a module, from `python -X importtime`.
+
+Every run is a new interpreter, after one untimed run that writes the bytecode caches, and the median over
+the runs is reported for the module and for the packages it imports. With --out the totals are saved, and
+with --baseline they are compared against a previous run so that cold-start regressions show up.
+
+    python -m benchmarks.importtime --module treeMatch --out importtime.json
+    python -m benchmarks.importtime --module treeMatch --baseline importtime.json --budget 150
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importTimes(module, env):
+    # {package: (self us, cumulative us, depth)} of one fresh import of module
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stderr
+    times = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        times[name.strip()] = (int(own), int(cumulative), depth)
+    return times
+
+
+def measure(module, repeat):
+    env = dict(os.environ)
+    # without bytecode caches every run would also time compiling the sources
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    importTimes(module, env)
+    runs = [importTimes(module, env) for _ in range(repeat)]
+    median = lambda xs: sorted(xs)[len(xs) // 2]
+    packages = {}
+    for name in runs[0]:
+        if all(name in run for run in runs):
+            packages[name] = {
+                'self': median([run[name][0] for run in runs]),
+                'cumulative': median([run[name][1] for run in runs]),
+                'depth': runs[0][name][2],
+            }
+    return {'module': module, 'repeat': repeat, 'total': packages[module]['cumulative'], 'packages': packages}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', type=str, default='treeMatch', help='module to import')
+    parser.add_argument('--repeat', type=int, default=5, help='timed imports, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='number of packages to list')
+    parser.add_argument('--out', type=str, default='', help='write the results as json')
+    parser.add_argument('--baseline', type=str, default='', help='results of a previous run to compare against')
+    parser.add_argument('--budget', type=float, default=0, help='exit with an error if the import takes longer than this many ms')
+    args = parser.parse_args()
+
+    result = measure(args.module, args.repeat)
+    packages = result['packages']
+    print(f"import {args.module}: {result['total'] / 1000:.1f} ms (median of {args.repeat})")
+    print()
+    # direct imports of the module show which stage pulls in what
+    print(f"{'direct imports':<40} {'cumulative (ms)':>15}")
+    direct = [name for name, p in packages.items() if p['depth'] == packages[args.module]['depth'] + 1]
+    for name in sorted(direct, key=lambda n: -packages[n]['cumulative'])[:args.top]:
+        print(f"{name:<40} {packages[name]['cumulative'] / 1000:>15.1f}")
+    print()
+    print(f"{'slowest packages':<40} {'self (ms)':>15}")
+    for name in sorted(packages, key=lambda n: -packages[n]['self'])[:args.top]:
+        print(f"{name:<40} {packages[name]['self'] / 1000:>15.1f}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        change = result['total'] - baseline['total']
+        print()
+        print(f"baseline: {baseline['total'] / 1000:.1f} ms, change: {change / 1000:+.1f} ms ({change / baseline['total']:+.1%})")
+        new = [name for name in packages if name not in baseline['packages']]
+        if new:
+            print("newly imported:", ", ".join(sorted(new, key=lambda n: -packages[n]['cumulative'])[:args.top]))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=1)
+    if args.budget and result['total'] / 1000 > args.budget:
+        print(f"import takes longer than the budget of {args.budget} ms")
+        sys.exit(1)
@@ -0,0 +1,289 @@
+"""
+Stress corpus and scaling benchmark for the ETM rule engine.
+
+Generates pathological but valid queries over a database from a tables.json file
+(long IN lists, many-way joins, deeply nested subqueries, long AND chains, many CTEs),
+times how long applyRules takes to normalize each of them and how much memory it peaks at,
+and reports which rules grow superlinearly with the size of the query.
+
+    python -m benchmarks.stress --table spider_dev/tables.json --db_id concert_singer --plot stress.png
+"""
+import os
+import math
+import time
+import json
+import argparse
+import tracemalloc
+import contextlib
+from copy import deepcopy as dc
+
+import treeMatch
+from ETM_utils.process_sql import get_schema_from_entry
+from ETM_utils.tables_index import load_entries
+
+DEFAULT_SIZES = {
+    'in_list': [1, 2, 5, 10, 25, 50, 100, 200],
+    'joins': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
+    'nesting': [1, 2, 3, 4, 5, 6],
+    'and_chain': [1, 2, 4, 8, 16, 32, 64],
+    'ctes': [1, 2, 4, 8, 16],
+}
+# every rule, including those applied outside the fixpoint loop (26 to the WITH clause, 21, 3 and 5 to set operations)
+ALLRULES = treeMatch.ALLRULES
+# growth exponent (log time / log size) above which a rule is reported as superlinear
+SUPERLINEAR = 1.3
+
+
+def pickTable(schema):
+    # the table with the most columns, preferring tables that take part in a foreign key
+    linked = set()
+    for table in schema:
+        for ref in schema[table]['foreign_keys'].values():
+            linked.add(table)
+            linked.add(ref.split('.')[0])
+    return max(schema, key=lambda t: (t in linked, len(schema[t]['columns'])))
+
+
+def quote(name):
+    return f'"{name}"' if not name.replace('_', '').isalnum() or name[0].isdigit() else name
+
+
+def buildInList(schema, size):
+    table = pickTable(schema)
+    cols = schema[table]['columns']
+    values = ", ".join(f"'v{i}'" for i in range(size))
+    return f"SELECT {quote(cols[0])} FROM {quote(table)} WHERE {quote(cols[-1])} IN ({values})"
+
+
+def buildJoins(schema, size):
+    # walk foreign keys (in both directions) from the start table, joining a fresh alias per step;
+    # if the schema runs out of edges we self-join on the first column
+    edges = []
+    for table in schema:
+        for col, ref in schema[table]['foreign_keys'].items():
+            ref_table, ref_col = ref.split('.')
+            if ref_table in schema:
+                edges.append((table, col, ref_table, ref_col))
+                edges.append((ref_table, ref_col, table, col))
+    start = edges[0][0] if edges else pickTable(schema)
+    aliases = [(start, "T1")]
+    joins = []
+    for i in range(1, size):
+        alias = f"T{i + 1}"
+        step = None
+        for k in range(len(edges)):
+            src, src_col, dst, dst_col = edges[(i + k) % len(edges)]
+            prev = [a for t, a in aliases if t == src]
+            if prev:
+                step = (prev[-1], src_col, dst, dst_col)
+                break
+        if step is None:
+            col = schema[start]['columns'][0]
+            step = ("T1", col, start, col)
+        prev_alias, src_col, dst, dst_col = step
+        aliases.append((dst, alias))
+        joins.append(f"JOIN {quote(dst)} AS {alias} ON {prev_alias}.{quote(src_col)} = {alias}.{quote(dst_col)}")
+    col = schema[start]['columns'][0]
+    return f"SELECT T1.{quote(col)} FROM {quote(start)} AS T1 " + " ".join(joins)
+
+
+def buildNesting(schema, size):
+    table = pickTable(schema)
+    cols = schema[table]['columns']
+    query = f"SELECT {quote(cols[0])} FROM {quote(table)} WHERE {quote(cols[-1])} = 'v'"
+    for _ in range(size):
+        query = f"SELECT {quote(cols[0])} FROM {quote(table)} WHERE {quote(cols[0])} IN ({query})"
+    return query
+
+
+def buildAndChain(schema, size):
+    table = pickTable(schema)
+    cols = schema[table]['columns']
+    ops = ['=', '>', '<', '!=', '>=']
+    conds = [f"{quote(cols[i % len(cols)])} {ops[i % len(ops)]} 'v{i}'" for i in range(size)]
+    return f"SELECT {quote(cols[0])} FROM {quote(table)} WHERE " + " AND ".join(conds)
+
+
+def buildCtes(schema, size):
+    table = pickTable(schema)
+    cols = schema[table]['columns']
+    ctes = [f"w{i} AS (SELECT {quote(cols[0])} FROM {quote(table)} WHERE {quote(cols[-1])} = 'v{i}')" for i in range(size)]
+    conds = [f"{quote(cols[0])} IN (SELECT {quote(cols[0])} FROM w{i})" for i in range(size)]
+    return "WITH " + ", ".join(ctes) + f" SELECT {quote(cols[0])} FROM {quote(table)} WHERE " + " OR ".join(conds)
+
+
+FAMILIES = {
+    'in_list': buildInList,
+    'joins': buildJoins,
+    'nesting': buildNesting,
+    'and_chain': buildAndChain,
+    'ctes': buildCtes,
+}
+
+
+def generateCorpus(schema, families=None, sizes=None):
+    """Yield (family, size, query) for every requested family and size."""
+    for family in families or FAMILIES:
+        for size in (sizes or {}).get(family, DEFAULT_SIZES[family]):
+            yield family, size, FAMILIES[family](schema, size)
+
+
+@contextlib.contextmanager
+def ruleTimers(timings):
+    # wrap every rule function in treeMatch so time spent in each rule is added to timings[rule]
+    originals = dict(treeMatch.RULE_FUNCTIONS)
+    for rule in ALLRULES:
+        def timed(tree, schema, db, _rule=rule, _fn=originals[rule]):
+            start = time.perf_counter()
+            try:
+                return _fn(tree, schema, db)
+            finally:
+                timings[_rule] = timings.get(_rule, 0.0) + time.perf_counter() - start
+        treeMatch.RULE_FUNCTIONS[rule] = timed
+    try:
+        yield timings
+    finally:
+        treeMatch.RULE_FUNCTIONS.update(originals)
+
+
+def normalize(query, schema, db, rules):
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        tree = treeMatch.parseTree(treeMatch.preprocess(query, schema))
+        return treeMatch.applyRules(tree, dc(schema), db, rules)
+
+
+def runCase(query, schema, db, rules, repeat):
+    times = []
+    rule_times = {}
+    error = None
+    for _ in range(repeat):
+        timings = {}
+        start = time.perf_counter()
+        try:
+            with ruleTimers(timings):
+                normalize(query, schema, db, rules)
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"
+        times.append(time.perf_counter() - start)
+        for rule, t in timings.items():
+            rule_times.setdefault(rule, []).append(t)
+    tracemalloc.start()
+    try:
+        normalize(query, schema, db, rules)
+    except Exception:
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    median = lambda xs: sorted(xs)[len(xs) // 2]
+    return {
+        'time': median(times),
+        'peak': peak,
+        'rules': {rule: median(ts) for rule, ts in rule_times.items()},
+        'error': error,
+    }
+
+
+def growth(points):
+    # least-squares slope of log(value) against log(size); ~1 is linear, ~2 quadratic
+    points = [(math.log(s), math.log(v)) for s, v in points if s > 0 and v > 0]
+    if len(points) < 2:
+        return None
+    mx = sum(x for x, _ in points) / len(points)
+    my = sum(y for _, y in points) / len(points)
+    var = sum((x - mx) ** 2 for x, _ in points)
+    if var == 0:
+        return None
+    return sum((x - mx) * (y - my) for x, y in points) / var
+
+
+def fitted(results, family):
+    # the cases of a family that normalized without an error; a failed run stops part way, so its times are not fit
+    return [r for r in results if r['family'] == family and not r['error']]
+
+
+def superlinearRules(results, family):
+    rows = fitted(results, family)
+    slopes = {}
+    for rule in ALLRULES:
+        # small sizes are dominated by constant overhead, so fit on the upper half of the sweep
+        points = [(r['size'], r['rules'].get(rule, 0.0)) for r in rows[len(rows) // 2:]]
+        slope = growth(points)
+        if slope is not None and slope > SUPERLINEAR:
+            slopes[rule] = slope
+    return sorted(slopes.items(), key=lambda x: -x[1])
+
+
+def plot(results, path):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed, skipping plot")
+        return
+    fig, (ax_time, ax_mem) = plt.subplots(1, 2, figsize=(12, 5))
+    for family in dict.fromkeys(r['family'] for r in results):
+        rows = fitted(results, family)
+        sizes = [r['size'] for r in rows]
+        ax_time.plot(sizes, [r['time'] * 1000 for r in rows], marker='o', label=family)
+        ax_mem.plot(sizes, [r['peak'] / 1024 for r in rows], marker='o', label=family)
+    for ax, label in ((ax_time, 'normalization time (ms)'), (ax_mem, 'peak memory (KiB)')):
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel('size parameter')
+        ax.set_ylabel(label)
+        ax.legend()
+    fig.tight_layout()
+    fig.savefig(path)
+    print("Saved plot to", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--table', type=str, default='spider_dev/tables.json', help='the tables json file')
+    parser.add_argument('--db_id', type=str, default='', help='database to generate queries over (default: the first one)')
+    parser.add_argument('--families', type=str, default=','.join(FAMILIES), help='comma separated query families')
+    parser.add_argument('--max_size', type=int, default=0, help='drop sizes above this value')
+    parser.add_argument('--budget', type=float, default=60.0, help='stop growing a family once one query takes this many seconds')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per query, the median is reported')
+    parser.add_argument('--out', type=str, default='', help='write the raw results as json')
+    parser.add_argument('--plot', type=str, default='', help='save a time/memory vs size plot (needs matplotlib)')
+    args = parser.parse_args()
+
+    entries = load_entries(args.table)
+    entry = entries[args.db_id] if args.db_id in entries else entries[next(iter(entries))]
+    schema = get_schema_from_entry(entry)
+    db = entry['db_id']
+    rules = ALLRULES
+
+    families = args.families.split(',')
+    sizes = {f: [s for s in DEFAULT_SIZES[f] if not args.max_size or s <= args.max_size] for f in families}
+    results = []
+    skip = set()
+    print(f"{'family':<10} {'size':>5} {'time (ms)':>11} {'peak (KiB)':>11}")
+    for family, size, query in generateCorpus(schema, families, sizes):
+        if family in skip:
+            continue
+        result = runCase(query, schema, db, rules, args.repeat)
+        result.update({'family': family, 'size': size, 'query': query})
+        results.append(result)
+        note = f"  ({result['error']})" if result['error'] else ""
+        print(f"{family:<10} {size:>5} {result['time'] * 1000:>11.1f} {result['peak'] / 1024:>11.1f}{note}")
+        if result['time'] > args.budget:
+            skip.add(family)
+
+    print()
+    print("Growth exponents (time ~ size^k, k > %.1f flagged)" % SUPERLINEAR)
+    for family in families:
+        rows = fitted(results, family)
+        k = growth([(r['size'], r['time']) for r in rows[len(rows) // 2:]])
+        flagged = ", ".join(f"rule{rule} ({slope:.2f})" for rule, slope in superlinearRules(results, family))
+        failed = sum(1 for r in results if r['family'] == family and r['error'])
+        note = f"  ({failed} failed {'size' if failed == 1 else 'sizes'} left out)" if failed else ""
+        print(f"{family:<10} k={k if k is None else round(k, 2)}  superlinear rules: {flagged or '-'}{note}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.plot:
+        plot(results, args.plot)
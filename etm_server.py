@@ -0,0 +1,383 @@
+"""
+Local ETM scoring daemon, so that several processes on one host share warm caches instead of each
+importing the evaluator and normalizing the same gold queries.
+
+Pairs are scored by a pool of worker processes, each holding a treeMatch.Scorer. A pair always goes
+to the worker that owns its gold query, so every gold query is normalized once. Identical
+(gold, pred, db_id) pairs are scored once, even when different clients send them at the same time.
+
+    python etm_server.py serve --db spider_dev/database/ --workers 4
+    python etm_server.py load --gold spider_dev/gold.txt --pred spider_dev/C3.txt --clients 8 --batch 16
+
+Requests are POST /score with {"pairs": [[gold, pred, db_id], ...]}, answered with {"results": [...]}
+holding one Scorer result per pair. GET /stats returns the service counters.
+"""
+import os
+import json
+import time
+import queue
+import socket
+import signal
+import zlib
+import argparse
+import threading
+import http.client
+import http.server
+import socketserver
+import multiprocessing
+from concurrent.futures import Future
+
+
+def errorResult(error: str) -> dict:
+    # result of a pair that could not be scored
+    return {'etm': False, 'exec': None, 'valid': False, 'fast_path': False, 'rejected_by': None, 'error': error, 'cached': False, 'time': 0.0}
+
+
+def worker(db_dir, options, requests, responses):
+    import treeMatch
+    # the parent shuts workers down once it stops serving
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with treeMatch.Scorer(db_dir, **options) as scorer:
+        while True:
+            batch = requests.get()
+            if batch is None:
+                break
+            out = []
+            for pair in batch:
+                try:
+                    out.append((pair, scorer.score(*pair)))
+                except Exception as e:
+                    out.append((pair, errorResult(f"{type(e).__name__}: {e}")))
+            responses.put(out)
+
+
+class ScoringService:
+    """
+    Worker pool behind the daemon. A worker that dies fails the pairs it was scoring with an error result,
+    and the gold queries it owned go to the live workers. A request gets an error result for any pair
+    that isn't scored within timeout seconds.
+    """
+    def __init__(self, db_dir: str, workers: int = 4, cache_size: int = 100000, timeout: float = 300.0, poll: float = 1.0, **options):
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.pending = {}
+        # worker each pending pair was sent to
+        self.owners = {}
+        self.dead = set()
+        self.results = {}
+        self.stats = {'requests': 0, 'pairs': 0, 'coalesced': 0, 'cached': 0, 'scored': 0, 'timeouts': 0, 'dead_workers': 0}
+        self.responses = multiprocessing.Queue()
+        self.queues = []
+        self.workers = []
+        # workers are started before any thread of this process
+        for _ in range(max(1, workers)):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=worker, args=(db_dir, options, queue, self.responses), daemon=True)
+            process.start()
+            self.queues.append(queue)
+            self.workers.append(process)
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def owner(self, gold: str, db_id: str) -> int:
+        # the worker of a gold query, one of the live workers if it died, or None if they all did
+        h = zlib.crc32(f"{db_id}\t{gold}".encode())
+        owner = h % len(self.queues)
+        if owner not in self.dead:
+            return owner
+        live = [i for i in range(len(self.queues)) if i not in self.dead]
+        return live[h % len(live)] if live else None
+
+    def submit(self, pairs: list) -> list:
+        """Futures for the results of (gold, pred, db_id) pairs."""
+        futures = []
+        batches = {}
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['pairs'] += len(pairs)
+            for pair in pairs:
+                key = tuple(pair)
+                if key in self.results:
+                    self.stats['cached'] += 1
+                    future = Future()
+                    future.set_result(self.results[key])
+                elif key in self.pending:
+                    self.stats['coalesced'] += 1
+                    future = self.pending[key]
+                else:
+                    future = Future()
+                    owner = self.owner(key[0], key[2])
+                    if owner is None:
+                        future.set_result(errorResult("no live worker"))
+                    else:
+                        self.pending[key] = future
+                        self.owners[key] = owner
+                        batches.setdefault(owner, []).append(key)
+                futures.append(future)
+        for owner, batch in batches.items():
+            self.queues[owner].put(batch)
+        return futures
+
+    def score_batch(self, pairs: list) -> list:
+        futures = self.submit(pairs)
+        deadline = time.monotonic() + self.timeout
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=max(0.0, deadline - time.monotonic())))
+            except TimeoutError:
+                # the pair stays pending, so a later request for it still gets its result
+                with self.lock:
+                    self.stats['timeouts'] += 1
+                results.append(errorResult(f"not scored within {self.timeout}s"))
+        return results
+
+    def checkWorkers(self):
+        # fail the pending pairs of the workers that died since the last check
+        with self.lock:
+            for i, process in enumerate(self.workers):
+                if i in self.dead or process.is_alive():
+                    continue
+                self.dead.add(i)
+                self.stats['dead_workers'] += 1
+                error = f"worker {i} exited with code {process.exitcode}"
+                for key in [key for key, owner in self.owners.items() if owner == i]:
+                    del self.owners[key]
+                    self.pending.pop(key).set_result(errorResult(error))
+
+    def collect(self):
+        check = time.monotonic() + self.poll
+        while True:
+            try:
+                batch = self.responses.get(timeout=self.poll)
+            except queue.Empty:
+                batch = []
+            if batch is None:
+                break
+            with self.lock:
+                for key, result in batch:
+                    future = self.pending.pop(key, None)
+                    if future is None:
+                        # already failed, when its worker was found dead
+                        continue
+                    del self.owners[key]
+                    self.stats['scored'] += 1
+                    if len(self.results) >= self.cache_size:
+                        self.results.pop(next(iter(self.results)))
+                    self.results[key] = result
+                    future.set_result(result)
+            if time.monotonic() >= check:
+                self.checkWorkers()
+                check = time.monotonic() + self.poll
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.workers:
+            process.join()
+        self.responses.put(None)
+        self.collector.join()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    service = None
+
+    def reply(self, code: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error': 'unknown path'})
+        with self.service.lock:
+            stats = dict(self.service.stats)
+        self.reply(200, stats)
+
+    def do_POST(self):
+        if self.path != '/score':
+            return self.reply(404, {'error': 'unknown path'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            pairs = [(str(gold), str(pred), str(db_id)) for gold, pred, db_id in body['pairs']]
+        except Exception as e:
+            return self.reply(400, {'error': f"bad request: {e}"})
+        self.reply(200, {'results': self.service.score_batch(pairs)})
+
+    def address_string(self):
+        # clients on a unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, None
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class Client:
+    """Client of a running daemon, with the same score/score_batch interface as treeMatch.Scorer."""
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765, socket_path: str = '', timeout: float = None):
+        if socket_path:
+            self.conn = UnixHTTPConnection(socket_path, timeout)
+        else:
+            self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method: str, path: str, body: dict = None) -> dict:
+        data = json.dumps(body).encode() if body is not None else None
+        headers = {'Content-Type': 'application/json'} if data else {}
+        self.conn.request(method, path, body=data, headers=headers)
+        response = self.conn.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(result.get('error', response.status))
+        return result
+
+    def score(self, gold: str, pred: str, db_id: str) -> dict:
+        return self.score_batch([(gold, pred, db_id)])[0]
+
+    def score_batch(self, pairs) -> list:
+        return self.request('POST', '/score', {'pairs': [list(pair) for pair in pairs]})['results']
+
+    def stats(self) -> dict:
+        return self.request('GET', '/stats')
+
+    def close(self):
+        self.conn.close()
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(args):
+    signal.signal(signal.SIGTERM, stop)
+    options = {'execution': args.execution, 'matcher': args.matcher, 'prefilters': not args.no_prefilter}
+    service = ScoringService(args.db, args.workers, timeout=args.timeout, **options)
+    Handler.service = service
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        print("Serving on", args.socket)
+    else:
+        server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+        print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+def readPairs(goldfile: str, predfile: str) -> list:
+    # same files as treeMatch.py, conversation separators are skipped
+    with open(goldfile) as f:
+        golds = [line for line in f.read().splitlines() if line.strip()]
+    with open(predfile) as f:
+        preds = [line for line in f.read().splitlines() if line.strip()]
+    pairs = []
+    for gold, pred in zip(golds, preds):
+        gold, db_id = gold.split('\t')[0].strip(), gold.split('\t')[1].strip()
+        pairs.append((gold, pred.strip(), db_id))
+    return pairs
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def load(args):
+    pairs = readPairs(args.gold, args.pred)
+    batches = [pairs[i:i + args.batch] for i in range(0, len(pairs), args.batch)]
+    batches = batches * max(1, args.repeat)
+    latencies = []
+    scored = [0]
+    errors = []
+    lock = threading.Lock()
+    position = [0]
+
+    def client():
+        conn = Client(args.host, args.port, args.socket)
+        while True:
+            with lock:
+                if position[0] >= len(batches):
+                    break
+                batch = batches[position[0]]
+                position[0] += 1
+            start = time.perf_counter()
+            try:
+                conn.score_batch(batch)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                conn.close()
+                conn = Client(args.host, args.port, args.socket)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                scored[0] += len(batch)
+        conn.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print(f"clients: {args.clients}, batch: {args.batch}, requests: {len(latencies)}, errors: {len(errors)}")
+    if latencies:
+        print("latency (ms): " + ", ".join(f"p{p} {percentile(latencies, p) * 1000:.1f}" for p in (50, 90, 99)) + f", max {max(latencies) * 1000:.1f}")
+    print(f"throughput: {len(latencies) / elapsed:.1f} requests/s, {scored[0] / elapsed:.1f} pairs/s over {elapsed:.2f}s")
+    print("server:", Client(args.host, args.port, args.socket).stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve', 'load'], help='serve: run the daemon, load: benchmark a running daemon')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to serve on or connect to')
+    parser.add_argument('--port', type=int, default=8765, help='port to serve on or connect to')
+    parser.add_argument('--socket', type=str, default='', help='unix socket path, used instead of host and port')
+    parser.add_argument('--db', type=str, default='', help='serve: folder containing the database files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='serve: worker processes')
+    parser.add_argument('--execution', default=False, action='store_true', help='serve: also compare execution results')
+    parser.add_argument('--matcher', type=str, default='rewrite', choices=['rewrite', 'stepwise'], help='serve: tree matcher')
+    parser.add_argument('--no_prefilter', default=False, action='store_true', help='serve: normalize every pair')
+    parser.add_argument('--timeout', type=float, default=300.0, help='serve: seconds a request waits for a pair before it gets an error result')
+    parser.add_argument('--gold', type=str, default='', help='load: file containing the gold data')
+    parser.add_argument('--pred', type=str, default='', help='load: file containing the predictions')
+    parser.add_argument('--clients', type=int, default=8, help='load: concurrent clients')
+    parser.add_argument('--batch', type=int, default=16, help='load: pairs per request')
+    parser.add_argument('--repeat', type=int, default=1, help='load: times to send every batch')
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args)
+    else:
+        load(args)
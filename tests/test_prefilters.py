@@ -0,0 +1,95 @@
+"""
+Soundness of the pre-filters of treeMatch.py: an invariant of a tree is either None (can't tell) or the same
+before and after applyRules. Each query triggers one of the rules an invariant makes an exception for.
+Run from the repository root with python -m pytest tests.
+"""
+import io
+import sqlite3
+import contextlib
+from copy import deepcopy as dc
+
+import pytest
+import sqlglot.expressions
+
+import treeMatch
+from ETM_utils.process_sql import get_schema
+
+# concert.singer_id references singer, so rule14 can drop singer from a join and fixedTables leaves it out
+SCHEMA = """
+CREATE TABLE singer (singer_id INTEGER PRIMARY KEY, name TEXT, country TEXT, age INTEGER, song_release_year TEXT);
+CREATE TABLE concert (concert_id INTEGER PRIMARY KEY, concert_name TEXT, year INTEGER,
+                      singer_id INTEGER REFERENCES singer(singer_id));
+"""
+
+# (rule the query triggers, query). cleanTrues is not a numbered rule, so its queries have None
+QUERIES = [
+    (1, "SELECT concert_name FROM concert WHERE concert_id = (SELECT max(concert_id) FROM concert)"),
+    (1, "SELECT concert_name FROM concert WHERE concert_id = (SELECT max(concert_id) FROM concert) AND concert_name = 'Live'"),
+    (11, "SELECT * FROM singer WHERE country = 'France'"),
+    (11, "SELECT * FROM concert JOIN singer ON concert.singer_id = singer.singer_id WHERE singer.country = 'France'"),
+    (12, "SELECT name FROM singer WHERE age = '30' AND country = 'France'"),
+    (12, "SELECT concert_name FROM concert WHERE year = '2014' LIMIT 5"),
+    (14, "SELECT concert.year FROM singer JOIN concert ON singer.singer_id = concert.singer_id WHERE concert.concert_name = 'Live'"),
+    (15, "SELECT name FROM singer WHERE substr(song_release_year, 1, 2) = '20' AND substr(song_release_year, 3, 2) BETWEEN '10' AND '14'"),
+    (16, "SELECT name FROM singer WHERE name LIKE 'Jo%'"),
+    (26, "WITH s AS (SELECT name, age FROM singer WHERE country = 'France') SELECT name FROM s WHERE age > 20"),
+    (26, "WITH c AS (SELECT concert_name FROM concert) SELECT concert_name FROM c LIMIT 2"),
+    (None, "SELECT concert_name FROM concert WHERE 1 = 1"),
+    (None, "SELECT name FROM singer WHERE 1 = 1 AND country = 'France'"),
+    (None, "SELECT name FROM singer WHERE singer_id IN (SELECT singer_id FROM concert WHERE concert.singer_id = concert.singer_id)"),
+]
+# projectionArity, stringLiterals, fixedTables and limitValue
+INVARIANTS = list(treeMatch.PREFILTERS.values())
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    db = str(tmp_path_factory.mktemp("prefilters") / "concert.sqlite")
+    conn = sqlite3.connect(db)
+    conn.executescript(SCHEMA)
+    conn.close()
+    return db, get_schema(db)
+
+
+@pytest.fixture(scope="module")
+def normalized(database):
+    # {query: (tree, normal form, rules that fired)}
+    db, schema = database
+    trees = {}
+    for _, query in QUERIES:
+        tree = treeMatch.parseTree(treeMatch.preprocess(query, schema))
+        fired = set()
+        with contextlib.redirect_stdout(io.StringIO()):
+            newtree = treeMatch.applyRules(tree, dc(schema), db, treeMatch.ALLRULES, fired=fired)
+        trees[query] = (tree, newtree, fired)
+    return trees
+
+
+def alwaysTrue(tree):
+    # an equality of a value with itself, which cleanTrues drops
+    return any(eq.args.get('this') == eq.args.get('expression') for eq in tree.find_all(sqlglot.expressions.EQ))
+
+
+@pytest.mark.parametrize("rule, query", QUERIES)
+def test_rule_fires(normalized, rule, query):
+    tree, newtree, fired = normalized[query]
+    if rule is None:
+        assert alwaysTrue(tree) and not alwaysTrue(newtree)
+    else:
+        assert rule in fired
+
+
+@pytest.mark.parametrize("invariant", INVARIANTS)
+@pytest.mark.parametrize("rule, query", QUERIES)
+def test_invariant_kept(database, normalized, invariant, rule, query):
+    db, schema = database
+    tree, newtree, _ = normalized[query]
+    before = invariant(tree, schema, db)
+    assert before is None or before == invariant(newtree, schema, db)
+
+
+@pytest.mark.parametrize("invariant", INVARIANTS)
+def test_invariant_decides(database, normalized, invariant):
+    # the queries are not all skipped by an invariant, so test_invariant_kept checks some values
+    db, schema = database
+    assert any(invariant(tree, schema, db) is not None for tree, _, _ in normalized.values())
@@ -1,18 +1,22 @@
 import os
 import json
+import time
 import sqlite3
 import argparse
+import itertools
 import contextlib
+import contextvars
+import collections
 import sqlglot
 import sqlglot.expressions
 from sqlglot.expressions import _to_s, Expression
 from sqlglot import parse_one as parse_sql
-from ETM_utils.ETM import evalquery
-import tqdm
 from copy import deepcopy as dc
 from ETM_utils.process_sql import get_schema
+from ETM_utils.equivalence import UnionFind
+from ETM_utils.termclasses import TermClasses
+from ETM_utils.lexical import same_query
 import re
-from ETM_utils.evaluation import evalquery as ESM
 
 def preprocess(query: str, schema: dict) -> str:
     # Convert ` to "
@@ -37,6 +41,188 @@ def preprocess(query: str, schema: dict) -> str:
 def parseTree(sql: str) -> sqlglot.expressions.Select:
     return parse_sql(sql)
 
+def treeKey(node) -> tuple:
+    # exact structural key of a subtree. Unlike Expression.__eq__, this is case and quote sensitive,
+    # so two subtrees with the same key always normalize to the same tree
+    if isinstance(node, Expression):
+        return (type(node), tuple((key, treeKey(value)) for key, value in node.args.items()), tuple(node.comments or ()))
+    if isinstance(node, list):
+        return tuple(treeKey(value) for value in node)
+    if isinstance(node, dict):
+        return tuple((key, treeKey(value)) for key, value in node.items())
+    return node
+
+# sort keys of the nodes seen in the current sortKeys context (one applyRules call or step-wise comparison):
+# {id(node): [node, args, version, key]}, see nodeVersion
+SORT_KEYS = contextvars.ContextVar('SORT_KEYS', default=None)
+VERSIONS = itertools.count()
+
+@contextlib.contextmanager
+def sortKeys():
+    # cache the sort key of every node sortKey is called on while the context is active
+    token = SORT_KEYS.set({})
+    try:
+        yield
+    finally:
+        SORT_KEYS.reset(token)
+
+def nodeVersion(node: Expression, cache: dict) -> int:
+    # a number that changes whenever node or a node below it changes, computed bottom-up: the args of a node, with
+    # its children replaced by their versions, are compared with those of its cache entry. A changed node gets a
+    # new version and no sort key, so the keys of its ancestors are dropped too, even when the change was first
+    # seen from another parent of a shared subtree
+    args = []
+    for key, value in node.args.items():
+        if isinstance(value, Expression):
+            value = nodeVersion(value, cache)
+        elif isinstance(value, list):
+            value = tuple(nodeVersion(item, cache) if isinstance(item, Expression) else item for item in value)
+        args.append((key, value))
+    args = (tuple(args), tuple(node.comments or ()))
+    entry = cache.get(id(node))
+    if entry is None or entry[0] is not node or entry[1] != args:
+        entry = cache[id(node)] = [node, args, next(VERSIONS), None]
+    return entry[2]
+
+def sortKey(node) -> tuple:
+    # same ordering as sorting by (str(type(x)), str(x)). Inside sortKeys, the sql of a subtree is only generated
+    # again once one of its nodes has changed
+    cache = SORT_KEYS.get()
+    if cache is None or not isinstance(node, Expression):
+        return (str(type(node)), str(node))
+    nodeVersion(node, cache)
+    entry = cache[id(node)]
+    if entry[3] is None:
+        entry[3] = (str(type(node)), str(node))
+    return entry[3]
+
+class InSet(sqlglot.expressions.Func): # c IN (A, B, ...), also the canonical form of c = A OR c = B OR ...
+    # one flat node instead of a chain of ORs, holding only literal or parameter values. Two value sets are equal
+    # if they test the same column against the same values, in any order, so comparing them is linear in the number of values
+    arg_types = {'this': True, 'expressions': True}
+
+    @property
+    def hashable_args(self):
+        # the values as a multiset, so c = 1 OR c = 1 is not equal to c = 1
+        return (self.args['this'], tuple(sorted(hash(value) for value in self.args['expressions'])))
+
+class NotInSet(InSet): # c NOT IN (A, B, ...), also the canonical form of c != A AND c != B AND ...
+    pass
+
+def isValue(node) -> bool:
+    # literal or parameter operand of a comparison; only these are merged into value sets
+    if isinstance(node, sqlglot.expressions.Neg):
+        node = node.args['this']
+    return isinstance(node, (sqlglot.expressions.Literal, sqlglot.expressions.Null, sqlglot.expressions.Boolean, sqlglot.expressions.Placeholder, sqlglot.expressions.Parameter))
+
+def canonicalValues(values: list) -> list:
+    # sorted, so that equal value sets also print the same
+    return sorted(values, key=sortKey)
+
+def valueComparisons(col, values: list, conjunction: bool) -> Expression:
+    # c IN (A, B, ...) (c NOT IN, if conjunction): the literal or parameter values become one InSet (NotInSet),
+    # every other value stays a separate c = X (c != X), all joined by OR (AND)
+    cmp, setType, connective = (sqlglot.expressions.NEQ, NotInSet, sqlglot.expressions.And) if conjunction else (sqlglot.expressions.EQ, InSet, sqlglot.expressions.Or)
+    literals = canonicalValues([value for value in values if isValue(value)])
+    comparisons = [cmp(this=col, expression=value) for value in values if not isValue(value)]
+    if len(literals) > 1:
+        comparisons.append(setType(this=col, expressions=literals))
+    else:
+        comparisons += [cmp(this=col, expression=value) for value in literals]
+    result = comparisons[0]
+    for expr in comparisons[1:]:
+        result = connective(this=result, expression=expr)
+    return result
+
+def valueSets(vals: list, conjunction: bool) -> list:
+    # merge the operands of a flattened OR (AND) that compare the same column with = (!=) against a literal
+    # or parameter value into one InSet (NotInSet). Comparisons against any other operand are left as they are
+    cmp, setType = (sqlglot.expressions.NEQ, NotInSet) if conjunction else (sqlglot.expressions.EQ, InSet)
+    groups = {}
+    rest = []
+    for val in vals:
+        if type(val) is setType:
+            groups.setdefault(val.args['this'], []).append((val, val.args['expressions']))
+        elif isinstance(val, cmp) and isinstance(val.args['this'], sqlglot.expressions.Column) and isValue(val.args['expression']):
+            groups.setdefault(val.args['this'], []).append((val, [val.args['expression']]))
+        elif isinstance(val, cmp) and isinstance(val.args['expression'], sqlglot.expressions.Column) and isValue(val.args['this']):
+            groups.setdefault(val.args['expression'], []).append((val, [val.args['this']]))
+        else:
+            rest.append(val)
+    for col, members in groups.items():
+        if len(members) > 1:
+            rest.append(setType(this=col, expressions=canonicalValues([value for _, values in members for value in values])))
+        else:
+            # a single comparison or value set is left as it is
+            rest.append(members[0][0])
+    return rest
+
+# column name -> tables that have a column with that name, built once per database
+COLUMN_INDEX = {}
+
+def columnIndex(schema: dict, db: str) -> dict:
+    if db not in COLUMN_INDEX:
+        index = {}
+        for table in schema:
+            for col in schema[table]['columns']:
+                index.setdefault(col, set()).add(table)
+        COLUMN_INDEX[db] = index
+    return COLUMN_INDEX[db]
+
+# per table: primary keys, the single column primary key (or None) and foreign key edges in both directions,
+# built once per database. Unique / non null columns are not indexed: rule19 adds to those while normalizing,
+# so rules keep reading them from the schema copy of the comparison
+JOIN_INDEX = {}
+
+def joinIndex(schema: dict, db: str) -> dict:
+    if db not in JOIN_INDEX:
+        index = {}
+        for table in schema:
+            pks = schema[table]['primary_keys']
+            index[table] = {
+                'primary_keys': frozenset(pks),
+                'single_pk': pks[0] if len(pks) == 1 else None,
+                'references': {col: tuple(ref.split('.', 1)) for col, ref in schema[table]['foreign_keys'].items()},
+                'referenced_by': [],
+            }
+        for table in index:
+            for col, (ref_table, ref_col) in index[table]['references'].items():
+                if ref_table in index:
+                    index[ref_table]['referenced_by'].append((table, col, ref_col))
+        JOIN_INDEX[db] = index
+    return JOIN_INDEX[db]
+
+def visibleTables(tree: sqlglot.expressions.Select) -> list:
+    # the tables (and subqueries) a select reads from, in from/join order
+    tables = [tree.args['from'].args['this']]
+    for join in tree.args.get('joins') or []:
+        tables.append(join.args['this'])
+    return tables
+
+def columnRefs(tree: sqlglot.expressions.Select) -> dict:
+    # table name -> names of the columns of that table used by the query, not counting subqueries.
+    # a column without a plain name (t.*) is recorded as None
+    refs = {}
+    stack = [tree]
+    while stack:
+        current_node = stack.pop()
+        for key, value in current_node.args.items():
+            if isinstance(value, list):
+                values = value
+            elif isinstance(value, sqlglot.expressions.Select):
+                continue
+            else:
+                values = [value]
+            for v in values:
+                if isinstance(v, sqlglot.expressions.Column) and 'table' in v.args and 'this' in v.args['table'].args:
+                    table = v.args['table'].args['this']
+                    if isinstance(table, str):
+                        col = v.args['this'].args['this'] if 'this' in v.args['this'].args else None
+                        refs.setdefault(table, set()).add(col)
+                if isinstance(v, Expression):
+                    stack.append(v)
+    return refs
+
 def rule100(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # select a vs select A
     original = dc(tree)
     root = tree
@@ -71,23 +257,22 @@ def rule101(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.
     original = dc(tree)
     if 'from' not in tree.args:
         return tree
+    index = columnIndex(schema, db)
+    tables = visibleTables(tree)
     def get_table(expr):
-        expr = dc(expr)
         if isinstance(expr, sqlglot.expressions.Star):
-            expr = sqlglot.expressions.Column(this=expr)
+            expr = sqlglot.expressions.Column(this=dc(expr))
         if 'table' not in expr.args:
+            tablename = None
             if 'joins' not in tree.args:
                 # selectname = expr.args['table'].args['this']
-                if isinstance(tree.args['from'].args['this'], sqlglot.expressions.Subquery):
+                if isinstance(tables[0], sqlglot.expressions.Subquery):
                     return expr
-                tablename = tree.args['from'].args['this'].args['this'].args['this']
-                expr.args['table'] = sqlglot.expressions.Identifier(this=tablename, quoted=False)
+                tablename = tables[0].args['this'].args['this']
             else:
                 # now, if there are more than one table, and the columns only exist in one of those tables, then add the table name
-                tables = [tree.args['from'].args['this']]
-                for join in tree.args['joins']:
-                    tables.append(join.args['this'])
-                tablename = None
+                name = expr.args['this'].args['this'] if 'this' in expr.args['this'].args else None
+                owners = index.get(name, ()) if isinstance(name, str) else ()
                 for table in tables:
                     if isinstance(table, sqlglot.expressions.Subquery):
                         continue
@@ -95,14 +280,15 @@ def rule101(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.
                         if isinstance(expr.args['this'], sqlglot.expressions.Star):
                             tablename = None
                             break
-                        if expr.args['this'].args['this'] in schema[table.args['this'].args['this']]['columns']:
+                        if table.args['this'].args['this'] in owners:
                             if not tablename:
                                 tablename = table.args['this'].args['this']
                             else:
                                 tablename = None
                                 break
-                if tablename:
-                    expr.args['table'] = sqlglot.expressions.Identifier(this=tablename, quoted=False)
+            if tablename:
+                expr = dc(expr)
+                expr.args['table'] = sqlglot.expressions.Identifier(this=tablename, quoted=False)
 
         return expr
         
@@ -136,52 +322,59 @@ def rule101(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.
 def rule102(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # select a, b from table vs. select b, a from table
     # order the columns in expressions by name
     original = dc(tree)
-    tree.args['expressions'].sort(key=lambda x: (str(type(x)), str(x)))
+    tree.args['expressions'].sort(key=sortKey)
     if tree != original:
         print("Applied Rule 102")
     return tree
 
 def rule103(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # select table.a from table t1 vs. select t1.a from table t1
     # anything that points to a table alias now points to the original
-    original = dc(tree)
-    if 'from' not in tree.args:
+    # first pass: pop the table aliases defined by every query scope (select) of the tree
+    scopes = {}
+    stack = [tree]
+    while stack:
+        current_node = stack.pop()
+        if isinstance(current_node, sqlglot.expressions.Select) and current_node.args.get('from') is not None:
+            tables = [current_node.args['from'].args['this']]
+            for join in current_node.args.get('joins') or []:
+                tables.append(join.args['this'])
+            aliases = {}
+            for table in tables:
+                if table.args.get('alias') is not None:
+                    alias_id = table.args.pop('alias').args['this'] # Identifier
+                    aliases[alias_id] = table.args['this'] # Identifier, or the select of a derived table
+            if aliases:
+                scopes[id(current_node)] = aliases
+        for key, value in current_node.args.items():
+            if isinstance(value, list):
+                stack.extend(v for v in value if isinstance(v, Expression))
+            elif isinstance(value, Expression):
+                stack.append(value)
+    if not scopes:
         return tree
-    tables = [tree.args['from'].args['this']]
-    if 'joins' in tree.args:
-        for join in tree.args['joins']:
-            tables.append(join.args['this'])
-    for table in tables:
-        if 'alias' in table.args:
-            if table.args['alias'] == None:
+
+    # second pass: replace every identifier that names an alias visible from its scope with the table.
+    # a subquery sees the aliases of the queries around it, unless it defines the same alias itself
+    stack = [(tree, {})]
+    while stack:
+        current_node, aliases = stack.pop()
+        if id(current_node) in scopes:
+            aliases = {**aliases, **scopes[id(current_node)]}
+        for key, value in current_node.args.items():
+            if isinstance(value, sqlglot.expressions.TableAlias):
+                # skip
                 continue
-            table_id = table.args['this'] # Identifier
-            alias_id = table.args['alias'].args['this'] # Identifier
-            # remove alias
-            table.args.pop('alias')
-            # loop through entire tree, look for all identifiers. If the identifier is the same as the alias, replace it with the table.
-            root = tree
-            stack = [(root, "")]  # Stack contains tuples of (current_node, path)
-            results = []  # To store the traversal paths and leaf values
-            while stack:
-                current_node, path = stack.pop()
-                for key, value in current_node.args.items():
-                    current_path = f"{path}/{key}" if path else key
-                    if isinstance(value, sqlglot.expressions.TableAlias):
-                        # skip
-                        continue
-                    if isinstance(value, list):
-                        for i in range(len(value)):
-                            stack.append((value[i], f"{current_path}[{i}]")) 
-                    if isinstance(value, Expression):
-                        # If the value is an Expression node, add it to the stack
-                        stack.append((value, current_path))
-                    if isinstance(value, sqlglot.expressions.Identifier):
-                        if value == alias_id:
-                            current_node.args[key] = table_id
-                    
+            if isinstance(value, list):
+                for i in range(len(value)):
+                    if isinstance(value[i], Expression):
+                        stack.append((value[i], aliases))
+            elif isinstance(value, sqlglot.expressions.Identifier):
+                if value in aliases:
+                    current_node.args[key] = aliases[value]
+            elif isinstance(value, Expression):
+                stack.append((value, aliases))
 
-    if tree != original:
-        print("Applied Rule 103")
+    print("Applied Rule 103")
     return tree
 
 def rule104(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # select a from table1 join table2 vs. select a from table2 join table1
@@ -206,8 +399,8 @@ def rule104(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.
     else:
         return tree
 
-    tables.sort(key=lambda x: (str(type(x)), str(x)))
-    ons.sort(key=lambda x: (str(type(x)), str(x)))
+    tables.sort(key=sortKey)
+    ons.sort(key=sortKey)
     
     tree.args['from'].args['this'] = tables[0]
     # combine ons into one big and statement
@@ -241,6 +434,8 @@ def rule105(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.
     results = []  # To store the traversal paths and leaf values
 
     def sort(node):
+        if isinstance(node, InSet):
+            node.args['expressions'] = canonicalValues(node.args['expressions'])
         if isinstance(node, sqlglot.expressions.EQ) or isinstance(node, sqlglot.expressions.And) or isinstance(node, sqlglot.expressions.Or):
             vals = [node.args['this'],node.args['expression']]
             # first, ensure the children are not of the same type
@@ -249,8 +444,10 @@ def rule105(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.
                     if isinstance(vals[i], type(node)):
                         vals[i] = [vals[i].args['this'], vals[i].args['expression']]
                         vals = vals[0:i] + vals[i] + vals[i+1:]
+            if not isinstance(node, sqlglot.expressions.EQ):
+                vals = valueSets(vals, isinstance(node, sqlglot.expressions.And))
             
-            vals.sort(key=lambda x: (str(type(x)), str(x)))
+            vals.sort(key=sortKey)
             # REBUILD
             it = iter(vals)
             result = next(it)  # Start with the first element
@@ -284,58 +481,59 @@ def rule105(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.
 
 def rule106(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # select a as b vs. select a
 # all Aliases are removed (and their references are replaced with the original)
-    original = dc(tree)
-    def removeAlias(alias: sqlglot.expressions.Alias):
-        alias_id = alias.args['alias']
-        alias = alias.args['this']
-
-        # loop through entire tree, look for all identifiers. If the identifier is the same as the alias, replace it with the table.
-        root = tree
-        stack = [(root, "")]
-        results = []
-        while stack:
-            current_node, path = stack.pop()
-            for key, value in current_node.args.items():
-                current_path = f"{path}/{key}" if path else key
-                if isinstance(value, sqlglot.expressions.Alias):
-                    if value.args['this'] == alias:
-                        value = value.args['this']
-                    continue
-                if isinstance(value, list):
-                    for i in range(len(value)):
-                        if isinstance(value[i], sqlglot.expressions.Alias):
-                            if value[i].args['this'] == alias:
-                                value[i] = value[i].args['this']
-                            current_node.args[key][i] = value[i]
-                        else:
-                            stack.append((value[i], f"{current_path}[{i}]")) 
-                if isinstance(value, Expression):
-                    # If the value is an Expression node, add it to the stack
-                    stack.append((value, current_path))
-                if isinstance(value, sqlglot.expressions.Identifier):
-                    if value == alias_id:
-                        current_node.args[key] = alias
-    root = tree
-    stack = [(root, "")]  # Stack contains tuples of (current_node, path)
-    results = []  # To store the traversal paths and leaf values
+    # first pass: collect the aliases defined by every query scope (select) and unwrap the ones in lists
+    scopes = {}
+    bodies = {} # aliased expression -> its own alias, which it can't refer to
+    kept = set() # aliases outside of lists stay, and nothing inside them is replaced
+    changed = False
+    stack = [(tree, id(tree))]
     while stack:
-        current_node, path = stack.pop()
+        current_node, scope = stack.pop()
+        if isinstance(current_node, sqlglot.expressions.Select):
+            scope = id(current_node)
         for key, value in current_node.args.items():
-            current_path = f"{path}/{key}" if path else key
             if isinstance(value, list):
                 for i in range(len(value)):
                     if isinstance(value[i], sqlglot.expressions.Alias):
-                        # remove it
-                        removeAlias(value[i])
-                    stack.append((value[i], f"{current_path}[{i}]")) 
-            if isinstance(value, sqlglot.expressions.Alias):
-                # remove it
-                removeAlias(value)
-            if isinstance(value, Expression):
-                # If the value is an Expression node, add it to the stack
-                stack.append((value, current_path))
-            
-    if tree != original:
+                        alias_id, value[i] = value[i].args['alias'], value[i].args['this']
+                        scopes.setdefault(scope, {})[alias_id] = value[i]
+                        bodies[id(value[i])] = alias_id
+                        changed = True
+                    if isinstance(value[i], Expression):
+                        stack.append((value[i], scope))
+            elif isinstance(value, sqlglot.expressions.Alias):
+                scopes.setdefault(scope, {})[value.args['alias']] = value.args['this']
+                kept.add(id(value))
+                stack.append((value, scope))
+            elif isinstance(value, Expression):
+                stack.append((value, scope))
+    if not scopes:
+        return tree
+
+    # second pass: replace every identifier that names an alias visible from its scope with the aliased expression.
+    # a subquery sees the aliases of the queries around it, unless it defines the same alias itself
+    stack = [(tree, {})]
+    while stack:
+        current_node, aliases = stack.pop()
+        if id(current_node) in scopes:
+            aliases = {**aliases, **scopes[id(current_node)]}
+        if id(current_node) in bodies:
+            aliases = {k: v for k, v in aliases.items() if k is not bodies[id(current_node)]}
+        for key, value in current_node.args.items():
+            if id(value) in kept:
+                continue
+            if isinstance(value, list):
+                for i in range(len(value)):
+                    if isinstance(value[i], Expression):
+                        stack.append((value[i], aliases))
+            elif isinstance(value, sqlglot.expressions.Identifier):
+                if value in aliases:
+                    current_node.args[key] = aliases[value]
+                    changed = True
+            elif isinstance(value, Expression):
+                stack.append((value, aliases))
+
+    if changed:
         print("Applied Rule 106")
     return tree
 def rule107(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # (a) vs. a
@@ -868,9 +1066,7 @@ def rule11(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.e
                         new_expressions.append(new_ex)
                 else:
                     # in this case, add all columns from any tables being joined
-                    tables = [tree.args['from'].args['this']]
-                    for join in tree.args['joins']:
-                        tables.append(join.args['this'])
+                    tables = visibleTables(tree)
                     for table in tables:
                         table_name = table.args['this'].args['this']
                         for col in schema[table_name]['columns']:
@@ -902,15 +1098,17 @@ def rule12(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.e
             if isinstance(value, Expression):
                 # If the value is an Expression node, add it to the stack
                 stack.append((value, current_path))
-            if isinstance(value, sqlglot.expressions.Literal):
-                # try to convert to real
-                try:
-                    if value.args['this'][0] != '0':
-                        value.args['this'] = str(float(value.args['this']))
-                        value.args['is_string'] = False
-                        current_node.args[key] = value
-                except:
-                    pass
+            # the values of a value set are compared with the column just like the right side of an =
+            values = value if isinstance(current_node, InSet) and key == 'expressions' else [value]
+            for value in values:
+                if isinstance(value, sqlglot.expressions.Literal):
+                    # try to convert to real
+                    try:
+                        if value.args['this'][0] != '0':
+                            value.args['this'] = str(float(value.args['this']))
+                            value.args['is_string'] = False
+                    except:
+                        pass
 
     if tree != original:
         print("Applied Rule 12")
@@ -995,13 +1193,13 @@ def rule13(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.e
         return tree
     inner_col_name = inner_col.args['this'].args['this']
     # check if col is pk of table
-    if inner_col_name not in schema[inner_table_name]['primary_keys']:
+    keys = joinIndex(schema, db)
+    if inner_col_name not in keys[inner_table_name]['primary_keys']:
         return tree
     outer_table_name = outer_table.args['this'].args['this']
     outer_col_name = outer_col.args['this'].args['this']
-    if outer_col_name not in schema[outer_table_name]['foreign_keys']:
-        return tree
-    if schema[outer_table_name]['foreign_keys'][outer_col_name] != f"{inner_table_name}.{inner_col_name}":
+    # and the outer column references it
+    if keys[outer_table_name]['references'].get(outer_col_name) != (inner_table_name, inner_col_name):
         return tree
     if 'where' in select.args:
         where = select.args['where'].args['this']
@@ -1065,6 +1263,8 @@ def rule14(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.e
             else:
                 eqs.append(on)
     remove = []
+    refs = None
+    keys = joinIndex(schema, db)
     for eq in eqs:
         if 'this' not in eq.args:
             continue
@@ -1099,68 +1299,32 @@ def rule14(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.e
         col1 = val1.args['this'].args['this']
         col2 = val2.args['this'].args['this']
         pair = False
-        if col1 in schema[table1]['primary_keys']:
-            if col2 in schema[table2]['foreign_keys']:        
-                if schema[table2]['foreign_keys'][col2] == f"{table1}.{col1}":
-                    foreign_table = table2
-                    foreign_col = col2
-                    primary_table = table1
-                    primary_col = col1
-                    pair = True
+        if col1 in keys[table1]['primary_keys']:
+            if keys[table2]['references'].get(col2) == (table1, col1):
+                foreign_table = table2
+                foreign_col = col2
+                primary_table = table1
+                primary_col = col1
+                pair = True
         if not pair:
             
-            if col2 in schema[table2]['primary_keys']:         
-                if col1 in schema[table1]['foreign_keys']:
-                    if schema[table1]['foreign_keys'][col1] == f"{table2}.{col2}":
-                        foreign_table = table1
-                        foreign_col = col1
-                        primary_table = table2
-                        primary_col = col2
-                        pair = True
+            if col2 in keys[table2]['primary_keys']:
+                if keys[table1]['references'].get(col1) == (table2, col2):
+                    foreign_table = table1
+                    foreign_col = col1
+                    primary_table = table2
+                    primary_col = col2
+                    pair = True
         
         if not pair:
             continue
         # now, check if pk is non-composite
-        if len(schema[primary_table]['primary_keys']) > 1:
+        if keys[primary_table]['single_pk'] is None:
             continue
         # Now, we need to check the tree. If it contain columns from the primary table besides the primary key, we can't apply the rule
-        def isValid(tree: sqlglot.expressions.Expression, pktable: str, pkcol: str) -> bool:
-            # given a tree, does it contain any columns from the primary table besides the primary key?
-            root = tree
-            stack = [(root, "")]  # Stack contains tuples of (current_node, path)
-            results = []  # To store the traversal paths and leaf values
-            while stack:
-                current_node, path = stack.pop()
-                for key, value in current_node.args.items():
-                    current_path = f"{path}/{key}" if path else key
-                    if isinstance(value, sqlglot.expressions.Select):
-                        continue
-                    if isinstance(value, list):
-                        for i in range(len(value)):
-                            if isinstance(value[i], sqlglot.expressions.Column):
-                                if 'table' in value[i].args:
-                                    if 'this' in value[i].args['table'].args:
-                                        if value[i].args['table'].args['this'] == pktable:
-                                            if 'this' in value[i].args['this'].args:
-                                                if value[i].args['this'].args['this'] != pkcol:
-                                                    return False
-                                            else:
-                                                return False
-                            stack.append((value[i], f"{current_path}[{i}]")) 
-                    if isinstance(value, Expression):
-                        # If the value is an Expression node, add it to the stack
-                        stack.append((value, current_path))
-                    if isinstance(value, sqlglot.expressions.Column):
-                        if 'table' in value.args:
-                            if 'this' in value.args['table'].args:
-                                if value.args['table'].args['this'] == pktable:
-                                    if 'this' in value.args['this'].args:
-                                        if value.args['this'].args['this'] != pkcol:
-                                            return False
-                                    else:
-                                        return False
-            return True
-        if not isValid(tree, primary_table, primary_col):
+        if refs is None:
+            refs = columnRefs(tree)
+        if not refs.get(primary_table, set()) <= {primary_col}:
             continue
         # Now, we can apply the rule
         # First, note which table and eq to remove
@@ -1410,7 +1574,7 @@ def rule17(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.e
         print("Applied Rule 17")
     return tree
     
-def rule18(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # c in (A, B) -> c = A or c = B, c not in (A, B) -> c != A and c != B 
+def rule18(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # c in (A, B) vs. c = A or c = B, c not in (A, B) vs. c != A and c != B: both become a value set
     original = dc(tree)
     root = tree
     stack = [(root, "")]  # Stack contains tuples of (current_node, path)
@@ -1429,26 +1593,11 @@ def rule18(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.e
                 if isinstance(value.args['this'], sqlglot.expressions.In):
                     if 'expressions' in value.args['this'].args:
                         col = value.args['this'].args['this']
-                        exprs = value.args['this'].args['expressions']
-                        eqs = [sqlglot.expressions.NEQ(this=col,expression = i) for i in exprs]
-                        it = iter(eqs)
-                        result = next(it)  # Start with the first element
-                        
-                        for expr in it:
-                            result = sqlglot.expressions.And(this=result, expression=expr)
-                        current_node.args[key] = result
+                        current_node.args[key] = valueComparisons(col, value.args['this'].args['expressions'], True)
             if isinstance(value, sqlglot.expressions.In):
                 if 'expressions' in value.args:
                     col = value.args['this']
-                    exprs = value.args['expressions']
-
-                    eqs = [sqlglot.expressions.EQ(this=col,expression = i) for i in exprs]
-                    it = iter(eqs)
-                    result = next(it)  # Start with the first element
-                    
-                    for expr in it:
-                        result = sqlglot.expressions.Or(this=result, expression=expr)
-                    current_node.args[key] = result
+                    current_node.args[key] = valueComparisons(col, value.args['expressions'], False)
                 
                 
                 
@@ -1458,95 +1607,89 @@ def rule18(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.e
 
 
 
+def joinEquivalences(tree) -> tuple:
+    # the equalities in the ON clause of every inner join in tree, and the classes of expressions they make equal
+    eqs = []
+    stack = [tree]
+    while stack:
+        current_node = stack.pop()
+        for key, value in current_node.args.items():
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, sqlglot.expressions.Join) and 'on' in item.args and 'side' not in item.args:
+                        on = item.args['on']
+                        if isinstance(on, sqlglot.expressions.EQ):
+                            eqs.append(on)
+                        elif isinstance(on, sqlglot.expressions.And):
+                            conds = [on]
+                            while conds:
+                                current = conds.pop()
+                                if isinstance(current, sqlglot.expressions.EQ):
+                                    eqs.append(current)
+                                elif isinstance(current, sqlglot.expressions.And):
+                                    conds.append(current.args['this'])
+                                    conds.append(current.args['expression'])
+                    stack.append(item)
+            if isinstance(value, Expression):
+                stack.append(value)
+    classes = UnionFind()
+    for eq in eqs:
+        classes.union(eq.args['this'], eq.args['expression'])
+    return eqs, classes
+
+def schemaColumn(node) -> tuple:
+    # (table, column) of a column qualified by a plain table name, None otherwise
+    if not isinstance(node, sqlglot.expressions.Column):
+        return None
+    table = node.args.get('table')
+    if not isinstance(table, Expression) or 'this' not in table.args or isinstance(table.args['this'], sqlglot.expressions.Select):
+        return None
+    return table.args['this'], node.args['this'].args['this']
+
 def rule19(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # a from t join t2 on a = b vs. b from t join t2 on a = b
     original = dc(tree)
-    def replace(t,on):
-        if isinstance(on, sqlglot.expressions.And):
-            eqs = []  # List to store EQ expressions
-            stack = [on]  # Stack to manage traversal
-
-            while stack:
-                current = stack.pop()
-                if isinstance(current, sqlglot.expressions.EQ):
-                    eqs.append(current)  # Add EQ to the result list
-                elif isinstance(current, sqlglot.expressions.And):
-                    # Push children of AND onto the stack
-                    stack.append(current.args['this'])
-                    stack.append(current.args['expression'])
-        else:
-            eqs = [on]
-        for eq in eqs:
-            # if one of the values is unique, the other is too. if one is non_null, the other is too
-            val1 = eq.args['this']
-            val2 = eq.args['expression']
-            if isinstance(val1, sqlglot.expressions.Column) and isinstance(val2, sqlglot.expressions.Column):
-                if 'table' in val1.args and 'table' in val2.args:
-                    if 'this' in val1.args['table'].args and 'this' in val2.args['table'].args:
-                        col_table_name1 = val1.args['table'].args['this']
-                        col_name1 = val1.args['this'].args['this']
-                        col_table_name2 = val2.args['table'].args['this']
-                        col_name2 = val2.args['this'].args['this']
-                        if not isinstance(col_table_name1, sqlglot.expressions.Select) and not isinstance(col_table_name2, sqlglot.expressions.Select):
-                            if col_name1 in schema[col_table_name1]['unique']:
-                                if col_name2 not in schema[col_table_name2]['unique']:
-                                    schema[col_table_name2]['unique'].append(col_name2)
-                            if col_name2 in schema[col_table_name2]['unique']:
-                                if col_name1 not in schema[col_table_name1]['unique']:
-                                    schema[col_table_name1]['unique'].append(col_name1)
-                            if col_name1 in schema[col_table_name1]['non_null']:
-                                if col_name2 not in schema[col_table_name2]['non_null']:
-                                    schema[col_table_name2]['non_null'].append(col_name2)
-                            if col_name2 in schema[col_table_name2]['non_null']:
-                                if col_name1 not in schema[col_table_name1]['non_null']:
-                                    schema[col_table_name1]['non_null'].append(col_name1)
-            root = t
-            stack = [(root, "")]
-            results = []  # To store the traversal paths and leaf values
-            while stack:
-                current_node, path = stack.pop()
-                for key, value in current_node.args.items():
-                    current_path = f"{path}/{key}" if path else key
-                    if isinstance(value, list):
-                        for i in range(len(value)):
-                            if isinstance(value[i], sqlglot.expressions.Column):
-                                if value[i] == eq.args['expression']:
-                                    value[i] = eq.args['this']
-                            stack.append((value[i], f"{current_path}[{i}]")) 
-                    if isinstance(value, sqlglot.expressions.Select):
-                        continue
-                    if isinstance(value, Expression):
-                        # If the value is an Expression node, add it to the stack
-                        stack.append((value, current_path))
-                    if isinstance(value, sqlglot.expressions.Column):
-                        if current_node in eqs:
-                            continue
-                        if value == eq.args['expression']:
-                            current_node.args[key] = eq.args['this']
-        return t
-    root = tree
-    stack = [(root, "")]  # Stack contains tuples of (current_node, path)
-    results = []  # To store the traversal paths and leaf values
+    eqs, classes = joinEquivalences(tree)
+    if not eqs:
+        return tree
+    eqs = set(eqs)
+    # every column of a class is replaced by its smallest column, the one rule105 puts first in an equality between them
+    replacements = {}
+    for members in classes.classes():
+        # if one column of a class is unique, all of them are. if one is non_null, all of them are
+        columns = [c for c in map(schemaColumn, members) if c]
+        for prop in ('unique', 'non_null'):
+            if any(col in schema[table][prop] for table, col in columns):
+                for table, col in columns:
+                    if col not in schema[table][prop]:
+                        schema[table][prop].append(col)
+        # only columns are replaced, so the representative is the smallest column of the class, never a cast
+        # or a function call the columns are compared with
+        candidates = [member for member in members if isinstance(member, sqlglot.expressions.Column)]
+        if not candidates:
+            continue
+        representative = min(candidates, key=sortKey)
+        for member in members:
+            if member is not representative:
+                replacements[member] = representative
+    stack = [tree]
     while stack:
-        current_node, path = stack.pop()
+        current_node = stack.pop()
         for key, value in current_node.args.items():
-            current_path = f"{path}/{key}" if path else key
             if isinstance(value, list):
                 for i in range(len(value)):
-                    if isinstance(value[i], sqlglot.expressions.Join):
-                        if 'on' in value[i].args and 'side' not in value[i].args:
-                            on = value[i].args['on']
-                            if isinstance(on, sqlglot.expressions.EQ):
-                                # replace everything on 1 side of eq with the other, except here
-                                replace(tree,on)
-                            elif isinstance(on, sqlglot.expressions.And):
-                                replace(tree,on)
-                    stack.append((value[i], f"{current_path}[{i}]")) 
+                    if isinstance(value[i], sqlglot.expressions.Column) and value[i] in replacements:
+                        value[i] = replacements[value[i]]
+                    stack.append(value[i])
+            if isinstance(value, sqlglot.expressions.Select):
+                continue
             if isinstance(value, Expression):
-                # If the value is an Expression node, add it to the stack
-                stack.append((value, current_path))
-                
-                
-                
+                stack.append(value)
+            if isinstance(value, sqlglot.expressions.Column):
+                # the join conditions themselves are kept
+                if current_node in eqs:
+                    continue
+                if value in replacements:
+                    current_node.args[key] = replacements[value]
     if tree != original:
         print("Applied Rule 19")
     return tree
@@ -1803,6 +1946,124 @@ def rule25(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.e
     return tree
 
 
+def rule26(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # with a as (q) ... a ... vs. ... (q) ...: every CTE is inlined where its alias is used
+    if 'with' not in tree.args:
+        return tree
+    withExp = tree.args['with']
+    if 'expressions' in withExp.args:
+        exps = withExp.args['expressions']
+        for exp in exps:
+            if isinstance(exp, sqlglot.expressions.CTE):
+                cte = exp
+                subq = cte.args['this']
+                alias = cte.args['alias']
+                # Now, loop through the main query and replace all instances of the alias with the subquery
+                root = tree
+                stack = [(root, "")]  # Stack contains tuples of (current_node, path)
+                while stack:
+                    current_node, path = stack.pop()
+                    for key, value in current_node.args.items():
+                        current_path = f"{path}/{key}" if path else key
+                        if isinstance(value, list):
+                            for i in range(len(value)):
+                                if isinstance(value[i], sqlglot.expressions.Column):
+                                    if 'table' in value[i].args:
+                                        if 'this' in value[i].args['table'].args:
+                                            if value[i].args['table'].args['this'] == alias:
+                                                value[i] = subq
+                                stack.append((value[i], f"{current_path}[{i}]")) 
+                        if isinstance(value, Expression):
+                            # If the value is an Expression node, add it to the stack
+                            stack.append((value, current_path))
+                        if isinstance(value, sqlglot.expressions.Identifier):
+                            if value == alias.args['this'] and current_node != alias:
+                                newq = sqlglot.expressions.Subquery()
+                                newq.args['this'] = subq
+                                current_node.args[key] = newq
+    tree.args.pop('with')
+    print("Applied Rule 26")
+    return tree
+
+def rule21(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # q intersect q vs. q, q union q vs. q
+    if isinstance(tree, sqlglot.expressions.Intersect) or isinstance(tree, sqlglot.expressions.Union):
+        if(tree.args['this']==tree.args['expression']):
+            print("Applied Rule 21")
+            tree = dc(tree.args['this'])
+    return tree
+
+def rule3(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # intersect (union) of two selections of a unique column vs. one selection with and (or)
+    if isinstance(tree, sqlglot.expressions.Intersect): # c1 from t where a intersect c1 from t where b vs. c1 from t where a and b: only if c1 is unique
+        original = dc(tree)
+        sub1 = tree.args['this']
+        sub2 = tree.args['expression']
+        if 'expressions' in sub1.args and 'expressions' in sub2.args:
+            if len(sub1.args['expressions']) == 1 and len(sub2.args['expressions']) == 1:
+                if sub1.args['expressions'] == sub2.args['expressions']:
+                    if isinstance(sub1.args['expressions'][0], sqlglot.expressions.Column):
+                        if 'table' in sub1.args['expressions'][0].args:
+                            col_table_name = sub1.args['expressions'][0].args['table'].args['this']
+                            if not isinstance(sub1.args['expressions'][0].args['this'], sqlglot.expressions.Star):
+                                col_name = sub1.args['expressions'][0].args['this'].args['this']
+                                if col_name in schema[col_table_name]['unique']:
+                                    if sub1.args['from'] == sub2.args['from']:
+                                        if 'where' in sub1.args and 'where' in sub2.args:
+                                            newwhere = sqlglot.expressions.And(this=sub1.args['where'].args['this'], expression=sub2.args['where'].args['this'])
+                                            sub1.args['where'].args['this'] = newwhere
+                                            tree = dc(sub1)
+
+        if tree != original:
+            print("Applied Rule 3")
+
+    elif isinstance(tree, sqlglot.expressions.Union): # c1 from t where a union c1 from t where b vs. c1 from t where a or b: only if c1 is unique
+        original = dc(tree)
+        sub1 = tree.args['this']
+        sub2 = tree.args['expression']
+        if 'expressions' in sub1.args and 'expressions' in sub2.args:
+            if len(sub1.args['expressions']) == 1 and len(sub2.args['expressions']) == 1:
+                if sub1.args['expressions'] == sub2.args['expressions']:
+                    if isinstance(sub1.args['expressions'][0], sqlglot.expressions.Column):
+                        if 'table' in sub1.args['expressions'][0].args:
+                            col_table_name = sub1.args['expressions'][0].args['table'].args['this']
+                            if not isinstance(sub1.args['expressions'][0].args['this'], sqlglot.expressions.Star):
+                                col_name = sub1.args['expressions'][0].args['this'].args['this']
+                                if col_name in schema[col_table_name]['unique']:
+                                    if sub1.args['from'] == sub2.args['from']:
+                                        if 'where' in sub1.args and 'where' in sub2.args:
+                                            newwhere = sqlglot.expressions.Or(this=sub1.args['where'].args['this'], expression=sub2.args['where'].args['this'])
+                                            sub1.args['where'] = newwhere
+                                            tree = dc(sub1)
+
+        if tree != original:
+            print("Applied Rule 3")
+    return tree
+
+def rule5(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # c1 from t except (q1) vs. c1 from t where c1 not in (q1): only if c1 is unique and non_null
+    if isinstance(tree, sqlglot.expressions.Except):
+        original = dc(tree)
+        outer = tree.args['this']
+        inner = tree.args['expression']
+        if 'expressions' in outer.args:
+            if len(outer.args['expressions']) == 1:
+                column = outer.args['expressions'][0]
+                if isinstance(column, sqlglot.expressions.Column):
+                    if 'table' in column.args:
+                        col_table_name = column.args['table'].args['this']
+                        if not isinstance(column.args['this'], sqlglot.expressions.Star):
+                            col_name = column.args['this'].args['this']
+                            if col_name in schema[col_table_name]['unique'] and col_name in schema[col_table_name]['non_null']:
+                                # conditions are met for rule 6
+                                t = dc(outer)
+                                if 'where' in t.args:
+
+                                    t.args['where'] = sqlglot.expressions.Where(this=sqlglot.expressions.And(this=sqlglot.expressions.Not(this=sqlglot.expressions.In(this=column, query=sqlglot.expressions.Subquery(this=inner))), expression=t.args['where'].args['this']))
+                                else:
+                                    t.args['where'] = sqlglot.expressions.Where(this=sqlglot.expressions.Not(this=sqlglot.expressions.In(this=column, query=sqlglot.expressions.Subquery(this=inner))))
+                                tree = dc(t)
+
+        if tree != original:
+            print("Applied Rule 5")
+    return tree
+
 def cleanTrues(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlglot.expressions.Select: # cleans up any 1=1s.
     original = dc(tree)
     root = tree
@@ -1850,50 +2111,60 @@ def cleanTrues(tree: sqlglot.expressions.Select, schema: dict, db: str) -> sqlgl
     return tree
 
 
-def applyRules(tree: sqlglot.expressions.Select, schema: dict, db: str, rules: list) -> sqlglot.expressions.Select:
+# rules of the fixpoint loop in applyRules, in order (26 runs before the subqueries are normalized, 21, 3 and 5 on the
+# set operation at the root after). The step-wise matcher also applies them one at a time
+LOOP_RULES = [100,101,102,103,104,105,106,107,108,1,2,4,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,22,23,24,25]
+# every caller looks rules up here, so replacing an entry (benchmarks.stress times the rules that way) changes them everywhere
+RULE_FUNCTIONS = {
+    100: rule100, 101: rule101, 102: rule102, 103: rule103, 104: rule104, 105: rule105, 106: rule106, 107: rule107, 108: rule108,
+    1: rule1, 2: rule2, 4: rule4, 6: rule6, 7: rule7, 8: rule8, 9: rule9, 10: rule10, 11: rule11, 12: rule12,
+    13: rule13, 14: rule14, 15: rule15, 16: rule16, 17: rule17, 18: rule18, 19: rule19, 20: rule20, 22: rule22, 23: rule23, 24: rule24, 25: rule25,
+    26: rule26, 21: rule21, 3: rule3, 5: rule5,
+}
+# what a rule raises when the tree is not in the shape it expects, e.g. a table alias that is not in the schema
+RULE_ERRORS = (KeyError, AttributeError, TypeError, IndexError, ValueError)
+
+def schemaSize(schema: dict) -> int:
+    # rules only ever add to the schema (rule19), so its size tells whether a rule changed it
+    return sum(len(value) for table in schema.values() for value in table.values())
+
+def applyRule(rule: int, tree: sqlglot.expressions.Select, schema: dict, db: str, fired: set, key: tuple = None) -> tuple:
+    # (tree after the rule, its treeKey). Unless fired is None, the rule is added to fired if it changes the tree or
+    # the schema. key is the treeKey of tree when the caller already has it, and the returned key is None if it
+    # wasn't computed
+    if fired is None or rule in fired:
+        return RULE_FUNCTIONS[rule](tree, schema, db), None
+    before = key if key is not None else treeKey(tree)
+    size = schemaSize(schema)
+    tree = RULE_FUNCTIONS[rule](tree, schema, db)
+    key = treeKey(tree)
+    if key != before or schemaSize(schema) != size:
+        fired.add(rule)
+    return tree, key
+
+def schemaState(schema: dict) -> tuple:
+    # the part of the schema that rules change: rule19 adds to the unique and non_null columns of a table
+    return tuple((table, tuple(info['unique']), tuple(info['non_null'])) for table, info in schema.items())
+
+def normalizeSubquery(tree: sqlglot.expressions.Select, schema: dict, db: str, rules: list, memo: dict, fired: set = None) -> sqlglot.expressions.Select:
+    # subqueries that were already normalized (earlier in this tree, or in the other tree of the pair) with the
+    # same rules and schema are reused
+    key = (treeKey(tree), tuple(rules), schemaState(schema))
+    if key not in memo:
+        memo[key] = applyRules(tree, schema, db, rules, memo, fired)
+    return dc(memo[key])
+
+def normalizationSteps(tree: sqlglot.expressions.Select, schema: dict, db: str, rules: list, memo: dict, fired: set = None) -> sqlglot.expressions.Select:
+    # yields the tree after every stage and every pass of the fixpoint loop, the last tree yielded is the normal form.
+    # If fired is a set, every rule that changes the tree or the schema on the way (in subqueries too) is added to it
     newtree = dc(tree)
-    if not tree:
-        return
+    yield newtree
     
     # before processing all subqueries, if the main query has a with clause, process it first
-    if 26 in rules:
-        if 'with' in newtree.args:
-            withExp = newtree.args['with']
-            if 'expressions' in withExp.args:
-                exps = withExp.args['expressions']
-                for exp in exps:
-                    if isinstance(exp, sqlglot.expressions.CTE):
-                        cte = exp
-                        subq = cte.args['this']
-                        alias = cte.args['alias']
-                        # Now, loop through the main query and replace all instances of the alias with the subquery
-                        root = newtree
-                        stack = [(root, "")]  # Stack contains tuples of (current_node, path)
-                        while stack:
-                            current_node, path = stack.pop()
-                            for key, value in current_node.args.items():
-                                current_path = f"{path}/{key}" if path else key
-                                if isinstance(value, list):
-                                    for i in range(len(value)):
-                                        if isinstance(value[i], sqlglot.expressions.Column):
-                                            if 'table' in value[i].args:
-                                                if 'this' in value[i].args['table'].args:
-                                                    if value[i].args['table'].args['this'] == alias:
-                                                        value[i] = subq
-                                        stack.append((value[i], f"{current_path}[{i}]")) 
-                                if isinstance(value, Expression):
-                                    # If the value is an Expression node, add it to the stack
-                                    stack.append((value, current_path))
-                                if isinstance(value, sqlglot.expressions.Identifier):
-                                    if value == alias.args['this'] and current_node != alias:
-                                        newq = sqlglot.expressions.Subquery()
-                                        newq.args['this'] = subq
-                                        current_node.args[key] = newq
-            newtree.args.pop('with')
-            print("Applied Rule 26")
-                            
+    if 26 in rules and 'with' in newtree.args:
+        newtree, _ = applyRule(26, newtree, schema, db, fired)
+        yield newtree
 
-        
     # process all subqueries
     root = newtree
     stack = [(root, "")]  # Stack contains tuples of (current_node, path)
@@ -1905,171 +2176,204 @@ def applyRules(tree: sqlglot.expressions.Select, schema: dict, db: str, rules: l
             if isinstance(value, list):
                 for i in range(len(value)):
                     if isinstance(value[i], sqlglot.expressions.Select):
-                        print('processing subquery')
-                        value[i] = applyRules(value[i], schema, db, rules)
-                    current_node.args[key][i] = value[i]
-                    stack.append((value[i], f"{current_path}[{i}]")) 
-            if isinstance(value, sqlglot.expressions.Select):
-
-                print('processing subquery')
-                current_node.args[key] = applyRules(value, schema, db, rules)
-            if isinstance(value, Expression):
+                        # a normalized subquery has already processed its own subqueries, so don't descend into it
+                        value[i] = normalizeSubquery(value[i], schema, db, rules, memo, fired)
+                    else:
+                        stack.append((value[i], f"{current_path}[{i}]"))
+            elif isinstance(value, sqlglot.expressions.Select):
+                current_node.args[key] = normalizeSubquery(value, schema, db, rules, memo, fired)
+            elif isinstance(value, Expression):
                 # If the value is an Expression node, add it to the stack
                 stack.append((value, current_path))
-    if 21 in rules:
-        if isinstance(newtree, sqlglot.expressions.Intersect) or isinstance(newtree, sqlglot.expressions.Union):
-            if(newtree.args['this']==newtree.args['expression']):
-                print("Applied Rule 21")
-                newtree = dc(newtree.args['this'])
-    if 3 in rules:
-        if isinstance(newtree, sqlglot.expressions.Intersect): # c1 from t where a intersect c1 from t where b vs. c1 from t where a and b: only if c1 is unique
-            original = dc(newtree)
-            sub1 = newtree.args['this']
-            sub2 = newtree.args['expression']
-            if 'expressions' in sub1.args and 'expressions' in sub2.args:
-                if len(sub1.args['expressions']) == 1 and len(sub2.args['expressions']) == 1:
-                    if sub1.args['expressions'] == sub2.args['expressions']:
-                        if isinstance(sub1.args['expressions'][0], sqlglot.expressions.Column):
-                            if 'table' in sub1.args['expressions'][0].args:
-                                col_table_name = sub1.args['expressions'][0].args['table'].args['this']
-                                if not isinstance(sub1.args['expressions'][0].args['this'], sqlglot.expressions.Star):
-                                    col_name = sub1.args['expressions'][0].args['this'].args['this']
-                                    if col_name in schema[col_table_name]['unique']:
-                                        if sub1.args['from'] == sub2.args['from']:
-                                            if 'where' in sub1.args and 'where' in sub2.args:
-                                                newwhere = sqlglot.expressions.And(this=sub1.args['where'].args['this'], expression=sub2.args['where'].args['this'])
-                                                sub1.args['where'].args['this'] = newwhere
-                                                newtree = dc(sub1)
-
-            if newtree != original:
-                print("Applied Rule 3")
-        
-        if isinstance(newtree, sqlglot.expressions.Union): # c1 from t where a union c1 from t where b vs. c1 from t where a or b: only if c1 is unique
-            original = dc(newtree)
-            sub1 = newtree.args['this']
-            sub2 = newtree.args['expression']
-            if 'expressions' in sub1.args and 'expressions' in sub2.args:
-                if len(sub1.args['expressions']) == 1 and len(sub2.args['expressions']) == 1:
-                    if sub1.args['expressions'] == sub2.args['expressions']:
-                        if isinstance(sub1.args['expressions'][0], sqlglot.expressions.Column):
-                            if 'table' in sub1.args['expressions'][0].args:
-                                col_table_name = sub1.args['expressions'][0].args['table'].args['this']
-                                if not isinstance(sub1.args['expressions'][0].args['this'], sqlglot.expressions.Star):
-                                    col_name = sub1.args['expressions'][0].args['this'].args['this']
-                                    if col_name in schema[col_table_name]['unique']:
-                                        if sub1.args['from'] == sub2.args['from']:
-                                            if 'where' in sub1.args and 'where' in sub2.args:
-                                                newwhere = sqlglot.expressions.Or(this=sub1.args['where'].args['this'], expression=sub2.args['where'].args['this'])
-                                                sub1.args['where'] = newwhere
-                                                newtree = dc(sub1)
-
-            if newtree != original:
-                print("Applied Rule 3")
-    
-    if 5 in rules:
-        if isinstance(newtree, sqlglot.expressions.Except): # c1 from t except (q1) vs. c1 from t where c1 not in (q1): only if c1 is unique and non_null
-            original = dc(newtree)
-            outer = newtree.args['this']
-            inner = newtree.args['expression']
-            if 'expressions' in outer.args:
-                if len(outer.args['expressions']) == 1:
-                    column = outer.args['expressions'][0]
-                    if isinstance(column, sqlglot.expressions.Column):
-                        if 'table' in column.args:
-                            col_table_name = column.args['table'].args['this']
-                            if not isinstance(column.args['this'], sqlglot.expressions.Star):
-                                col_name = column.args['this'].args['this']
-                                if col_name in schema[col_table_name]['unique'] and col_name in schema[col_table_name]['non_null']:
-                                    # conditions are met for rule 6
-                                    t = dc(outer)
-                                    if 'where' in t.args:
-                                        
-                                        t.args['where'] = sqlglot.expressions.Where(this=sqlglot.expressions.And(this=sqlglot.expressions.Not(this=sqlglot.expressions.In(this=column, query=sqlglot.expressions.Subquery(this=inner))), expression=t.args['where'].args['this']))
-                                    else:
-                                        t.args['where'] = sqlglot.expressions.Where(this=sqlglot.expressions.Not(this=sqlglot.expressions.In(this=column, query=sqlglot.expressions.Subquery(this=inner))))
-                                    newtree = dc(t)
-
-            if newtree != original:
-                print("Applied Rule 5")
+    yield newtree
+    # rules on the set operation at the root of the query
+    for rule in (21, 3, 5):
+        if rule in rules:
+            settree, _ = applyRule(rule, newtree, schema, db, fired)
+            if settree is not newtree:
+                newtree = settree
+                yield newtree
     if isinstance(newtree, sqlglot.expressions.Select):
         oldtree = None
+        # no rule introduces aliases, so they are resolved (for every scope at once) in the first pass only
+        resolveAliases = True
         while newtree != oldtree:
             oldtree = dc(newtree)
-            if 100 in rules:
-                newtree = rule100(newtree, schema, db)
-            if 101 in rules:
-                newtree = rule101(newtree, schema, db)
-            if 102 in rules:
-                newtree = rule102(newtree, schema, db)
-            if 103 in rules:
-                newtree = rule103(newtree, schema, db)
-            if 104 in rules:
-                newtree = rule104(newtree, schema, db)
-            if 105 in rules:
-                newtree = rule105(newtree, schema, db)
-            if 106 in rules:
-                newtree = rule106(newtree, schema, db)
-            if 107 in rules:
-                newtree = rule107(newtree, schema, db)  
-            if 108 in rules:
-                newtree = rule108(newtree, schema, db)
-            if 1 in rules:
-                newtree = rule1(newtree, schema, db)
-            if 2 in rules:
-                newtree = rule2(newtree, schema, db)
-            if 4 in rules:
-                newtree = rule4(newtree, schema, db)
-            if 6 in rules:
-                newtree = rule6(newtree, schema, db)
-            if 7 in rules:
-                newtree = rule7(newtree, schema, db)
-            if 8 in rules:
-                newtree = rule8(newtree, schema, db)
-            if 9 in rules:
-                newtree = rule9(newtree, schema, db)
-            if 10 in rules:
-                newtree = rule10(newtree, schema, db)
-            if 11 in rules:
-                newtree = rule11(newtree, schema, db)
-            if 12 in rules:
-                newtree = rule12(newtree, schema, db)
-            if 13 in rules:
-                newtree = rule13(newtree, schema, db)
-            if 14 in rules:
-                newtree = rule14(newtree, schema, db)
-            if 15 in rules:
-                newtree = rule15(newtree, schema, db)
-            if 16 in rules:
-                newtree = rule16(newtree, schema, db)
-            if 17 in rules:
-                newtree = rule17(newtree, schema, db)
-            if 18 in rules:
-                newtree = rule18(newtree, schema, db)
-            if 19 in rules:
-                newtree = rule19(newtree, schema, db)
-            if 20 in rules:
-                newtree = rule20(newtree, schema, db)
-            if 22 in rules:
-                newtree = rule22(newtree, schema, db)
-            if 23 in rules:
-                newtree = rule23(newtree, schema, db)
-            if 24 in rules:
-                newtree = rule24(newtree, schema, db)
-            if 25 in rules:
-                newtree = rule25(newtree, schema, db)
+            # the rules of a pass hand the tree on to each other, so the key after one rule is the key before the next
+            key = None
+            for rule in LOOP_RULES:
+                if rule in rules and (resolveAliases or rule not in (103, 106)):
+                    newtree, key = applyRule(rule, newtree, schema, db, fired, key)
+            resolveAliases = False
             
             newtree = cleanTrues(newtree, schema, db)
-        
-    return newtree
+            yield newtree
 
-def compareTrees(tree1: sqlglot.expressions.Select, tree2: sqlglot.expressions.Select, schema: dict, db: str, rules: list) -> bool:
+def applyRules(tree: sqlglot.expressions.Select, schema: dict, db: str, rules: list, memo: dict = None, fired: set = None) -> sqlglot.expressions.Select:
+    if not tree:
+        return
+    if memo is None:
+        memo = {}
+    with sortKeys():
+        for newtree in normalizationSteps(tree, schema, db, rules, memo, fired):
+            pass
+    return newtree
 
-    
+# Pre-filters: invariants of a tree that no rule changes, so two trees whose invariants differ can never
+# normalize to the same tree and are rejected without running applyRules. An invariant returns None when it
+# can't tell (the tree contains something a rule could use to change it), and then the filter is skipped.
+# checkPrefilters verifies them against the rule set (treeMatch.py --check_prefilters).
+def projectionArity(tree: Expression, schema: dict, db: str) -> int:
+    # number of selected expressions. Only rule11 changes it, by expanding a star
+    while isinstance(tree, (sqlglot.expressions.Union, sqlglot.expressions.Intersect, sqlglot.expressions.Except)):
+        tree = tree.args['this']
+    if not isinstance(tree, sqlglot.expressions.Select):
+        return None
+    expressions = tree.args.get('expressions') or []
+    for ex in expressions:
+        if isinstance(ex, sqlglot.expressions.Star) or isinstance(ex, sqlglot.expressions.Column) and isinstance(ex.args.get('this'), sqlglot.expressions.Star):
+            return None
+    return len(expressions)
+
+def unsafeForValues(node: Expression, root: Expression) -> bool:
+    # constructs a rule can drop or rewrite whole conditions with: CTEs (rule26 drops unused ones), a column
+    # compared with a subquery (rule1), like / substr (rule15, rule16), always true equalities (cleanTrues),
+    # and subqueries whose WHERE only equates columns: once those become always true, cleanTrues drops the
+    # WHERE of the outer query
+    if isinstance(node, (sqlglot.expressions.With, sqlglot.expressions.Like, sqlglot.expressions.Substring)):
+        return True
+    if isinstance(node, sqlglot.expressions.EQ):
+        if isinstance(node.args.get('this'), sqlglot.expressions.Subquery) or isinstance(node.args.get('expression'), sqlglot.expressions.Subquery):
+            return True
+        if node.args.get('this') == node.args.get('expression'):
+            return True
+    if isinstance(node, sqlglot.expressions.Select) and node is not root and isinstance(node.args.get('where'), sqlglot.expressions.Where):
+        conds = [node.args['where'].args.get('this')]
+        while conds:
+            cond = conds.pop()
+            if isinstance(cond, sqlglot.expressions.And):
+                conds.extend([cond.args.get('this'), cond.args.get('expression')])
+            elif not (isinstance(cond, sqlglot.expressions.EQ) and isinstance(cond.args.get('this'), sqlglot.expressions.Column) and isinstance(cond.args.get('expression'), sqlglot.expressions.Column)):
+                return False
+        return True
+    return False
+
+def stringLiterals(tree: Expression, schema: dict, db: str) -> frozenset:
+    # string values, except those rule12 turns into numbers and those in join conditions (rule14 drops those)
+    values = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if unsafeForValues(node, tree):
+            return None
+        if isinstance(node, sqlglot.expressions.Literal) and node.args.get('is_string'):
+            try:
+                float(node.args['this'])
+            except (ValueError, TypeError):
+                values.add(node.args['this'])
+        for key, value in node.args.items():
+            if isinstance(node, sqlglot.expressions.Join) and key == 'on':
+                continue
+            for value in (value if isinstance(value, list) else [value]):
+                if isinstance(value, Expression):
+                    stack.append(value)
+    return frozenset(values)
+
+def fixedTables(tree: Expression, schema: dict, db: str) -> frozenset:
+    # tables used anywhere in the query, except those rule14 can remove (referenced by a foreign key).
+    # rule20 can unnest IN subqueries, dropping their tables
+    keys = joinIndex(schema, db)
+    names = {table.lower(): table for table in keys}
+    tables = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if unsafeForValues(node, tree) or isinstance(node, sqlglot.expressions.In) and node.args.get('query') is not None:
+            return None
+        if isinstance(node, sqlglot.expressions.Table) and isinstance(node.args.get('this'), sqlglot.expressions.Identifier):
+            table = names.get(str(node.args['this'].args['this']).lower())
+            if table is not None and not keys[table]['referenced_by']:
+                tables.add(table)
+        for value in node.args.values():
+            for value in (value if isinstance(value, list) else [value]):
+                if isinstance(value, Expression):
+                    stack.append(value)
+    return frozenset(tables)
+
+def limitValue(tree: Expression, schema: dict, db: str) -> float:
+    # the LIMIT of the outer query. rule1 and rule10 add and remove LIMIT 1 only, so no limit counts as 1
+    if not isinstance(tree, sqlglot.expressions.Select):
+        return None
+    limit = tree.args.get('limit')
+    if limit is None:
+        return 1.0
+    value = limit.args.get('expression')
+    if not isinstance(value, sqlglot.expressions.Literal):
+        return None
+    try:
+        return float(value.args['this'])
+    except (ValueError, TypeError):
+        return None
+
+PREFILTERS = {
+    'arity': projectionArity,
+    'literals': stringLiterals,
+    'tables': fixedTables,
+    'limit': limitValue,
+}
+PREFILTER_STATS = {'pairs': 0, 'rejected': 0, **{name: 0 for name in PREFILTERS}}
+
+def prefilter(tree1: Expression, tree2: Expression, schema: dict, db: str) -> str:
+    # name of the first invariant the trees differ on, None if the pair has to be normalized
+    PREFILTER_STATS['pairs'] += 1
+    if not tree1 or not tree2:
+        return None
+    for name, invariant in PREFILTERS.items():
+        value1 = invariant(tree1, schema, db)
+        if value1 is None:
+            continue
+        value2 = invariant(tree2, schema, db)
+        if value2 is not None and value1 != value2:
+            PREFILTER_STATS['rejected'] += 1
+            PREFILTER_STATS[name] += 1
+            return name
+    return None
+
+def checkPrefilters(tree1: Expression, tree2: Expression, schema: dict, db: str, rules: list) -> tuple:
+    # runs the full comparison and reports pre-filter problems: a rejected pair that matches, and
+    # invariants that differ between a tree and its normal form
+    rejected = prefilter(tree1, tree2, schema, db)
+    problems = []
+    memo = {}
+    normalized = []
+    for tree in (tree1, tree2):
+        newtree = applyRules(tree, schema, db, rules, memo)
+        normalized.append(newtree)
+        if not tree or not newtree:
+            continue
+        for name, invariant in PREFILTERS.items():
+            before = invariant(tree, schema, db)
+            after = invariant(newtree, schema, db)
+            if before is not None and after is not None and before != after:
+                problems.append(f"{name} changed by normalization: {before} -> {after}")
+    matched = normalized[0] == normalized[1]
+    if matched and rejected:
+        problems.append(f"matching pair rejected by {rejected}")
+    return matched, problems
+
+def compareTrees(tree1: sqlglot.expressions.Select, tree2: sqlglot.expressions.Select, schema: dict, db: str, rules: list, prefilters: bool = True) -> bool:
+    if prefilters:
+        rejected = prefilter(tree1, tree2, schema, db)
+        if rejected:
+            print("Rejected by pre-filter:", rejected)
+            return False
+    # both trees share one memo, so subqueries common to gold and pred are only normalized once
+    memo = {}
     print('tree1rules')
-    tree1 = applyRules(tree1,schema, db, rules)
+    tree1 = applyRules(tree1,schema, db, rules, memo)
     print()
     print('tree2rules')
-    tree2 = applyRules(tree2,schema, db, rules)
+    tree2 = applyRules(tree2,schema, db, rules, memo)
 
 
 
@@ -2081,22 +2385,276 @@ def compareTrees(tree1: sqlglot.expressions.Select, tree2: sqlglot.expressions.S
     print("Gold after applying rules:",tree2)
     return tree1 == tree2
 
-if __name__ == "__main__":
-
-    ALLRULES = [100,101,102,103,104,105,106,107,108,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26]
-    data = []
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--pred', type=str, default='', help='file containing the predictions')
-    parser.add_argument('--gold', type=str, default='', help='file containing the gold data')
-    parser.add_argument('--db', type=str, default='', help='folder containing the database files')
-    parser.add_argument('--table', type=str, default='', help='the tables json file')
-    parser.add_argument('--etype', type=str, default='all',help='exe, treematch, or all')
-    parser.add_argument('--verbose', default=False,action='store_true', help='Whether to print verbose output')
-    args = parser.parse_args()
-
-    predfile = args.pred
-    goldfile = args.gold
-    tablefile = args.table
+ALLRULES = [100,101,102,103,104,105,106,107,108,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26]
+# pairs compared, matched while normalizing, matched only by exploring other rule orders, stopped by the budget,
+# terms created, and rule applications skipped while exploring because the rule raised one of RULE_ERRORS
+STEPWISE_STATS = {'pairs': 0, 'matched': 0, 'normalizing': 0, 'explored': 0, 'budget': 0, 'terms': 0, 'errors': 0}
+
+@sortKeys()
+def compareTreesStepwise(tree1: sqlglot.expressions.Select, tree2: sqlglot.expressions.Select, schema: dict, db: str, rules: list, max_nodes: int = 0, timeout: float = 5.0, prefilters: bool = True) -> bool:
+    # every normalization step of either tree (see normalizationSteps) is added to one set of term classes,
+    # each step in the class of the step before it, so the trees match as soon as their roots fall into the
+    # same class instead of once both are fully normalized. Terms are whole trees: this is an early exit
+    # over the rewrite path, not equality saturation over operators.
+    # tree1 is normalized first, like in compareTrees, and both normalizations always run (they are not
+    # budgeted), so this matches at least every pair compareTrees matches. If max_nodes > 0, up to that many
+    # more terms are then added by rewriting every term with each rule on its own, which finds matches that
+    # need another rule order. That is expensive on pairs that do not match, so it is off by default.
+    if prefilters:
+        rejected = prefilter(tree1, tree2, schema, db)
+        if rejected:
+            print("Rejected by pre-filter:", rejected)
+            return False
+    start = time.perf_counter()
+    classes = TermClasses()
+    memo = {}
+    # terms are keyed by a copy of themselves: the same equality compareTrees uses
+    roots = []
+    for tree in (tree1, tree2):
+        tree = dc(tree)
+        roots.append(classes.add(tree, tree)[0])
+    STEPWISE_STATS['pairs'] += 1
+
+    def finish(matched, stat=None):
+        STEPWISE_STATS['terms'] += len(classes)
+        if matched:
+            STEPWISE_STATS['matched'] += 1
+        if stat:
+            STEPWISE_STATS[stat] += 1
+        return matched
+
+    for side, tree in enumerate((tree1, tree2)):
+        if not tree:
+            continue
+        last = roots[side]
+        for term in normalizationSteps(tree, schema, db, rules, memo):
+            if term not in classes:
+                term = dc(term)
+            node = classes.add(term, term)[0]
+            classes.union(last, node)
+            last = node
+            if classes.same(*roots):
+                print("Matched after", len(classes), "terms")
+                return finish(True, 'normalizing')
+
+    normalized = len(classes)
+    node = 0
+    while node < len(classes):
+        for rule in LOOP_RULES:
+            if rule not in rules:
+                continue
+            if len(classes) - normalized >= max_nodes or time.perf_counter() - start > timeout:
+                return finish(False, 'budget' if max_nodes else None)
+            try:
+                term = cleanTrues(RULE_FUNCTIONS[rule](dc(classes.term(node)), schema, db), schema, db)
+            except RULE_ERRORS:
+                # the rule doesn't apply to a term in the shape another rule order left it in
+                STEPWISE_STATS['errors'] += 1
+                continue
+            classes.union(node, classes.add(term, term)[0])
+            if classes.same(*roots):
+                print("Matched after", len(classes), "terms")
+                return finish(True, 'explored')
+        node += 1
+    return finish(False)
+
+class Scorer:
+    """
+    ETM scorer that keeps its state warm between calls, for long-lived processes (e.g. as a reward in training).
+    Schemas, database connections, gold validity, gold normalizations and gold execution results are cached,
+    so scoring a pair only parses and normalizes the prediction once its gold has been seen.
+    Not thread safe: use one Scorer per thread or process. close() (or leaving a with block) closes its connections.
+
+        with Scorer('spider_dev/database/') as scorer:
+            scorer.score("SELECT count(*) FROM singer", "SELECT COUNT(*) FROM singer;", 'concert_singer')
+    """
+    def __init__(self, db_dir: str, rules: list = None, execution: bool = False, matcher: str = 'rewrite', prefilters: bool = True, cache_size: int = 10000, timeout: float = 30.0):
+        self.db_dir = db_dir
+        self.rules = list(rules) if rules is not None else ALLRULES
+        self.execution = execution
+        self.matcher = matcher
+        self.prefilters = prefilters
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.schemas = {}
+        self.connections = {}
+        self.golds = {}
+        self.results = {}
+        self.stats = {'pairs': 0, 'cached': 0, 'fast_path': 0, 'gold_hits': 0, 'gold_misses': 0}
+        self._sink = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    @property
+    def _devnull(self):
+        # where the trace the rules print goes, opened on first use
+        if self._sink is None:
+            self._sink = open(os.devnull, 'w')
+        return self._sink
+
+    def dbPath(self, db_id: str) -> str:
+        return os.path.join(self.db_dir, db_id, db_id + ".sqlite")
+
+    def schema(self, db_id: str) -> dict:
+        if db_id not in self.schemas:
+            self.schemas[db_id] = get_schema(self.dbPath(db_id))
+        return self.schemas[db_id]
+
+    def connection(self, db_id: str) -> sqlite3.Connection:
+        if db_id not in self.connections:
+            self.connections[db_id] = sqlite3.connect(f"file:{self.dbPath(db_id)}?mode=ro", uri=True)
+        return self.connections[db_id]
+
+    def _remember(self, cache: dict, key, value):
+        if len(cache) >= self.cache_size:
+            cache.pop(next(iter(cache)))
+        cache[key] = value
+        return value
+
+    def isValid(self, sql: str, db_id: str) -> bool:
+        try:
+            self.connection(db_id).execute("EXPLAIN QUERY PLAN " + sql)
+        except Exception:
+            return False
+        return True
+
+    def execute(self, sql: str, db_id: str) -> list:
+        conn = self.connection(db_id)
+        deadline = time.perf_counter() + self.timeout
+        conn.set_progress_handler(lambda: time.perf_counter() > deadline, 10000)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.set_progress_handler(None, 0)
+
+    def gold(self, gold: str, db_id: str) -> dict:
+        # everything about a gold query that doesn't depend on the prediction: its validity, its tree, and the
+        # state compareTrees has after normalizing it (the normal form, the schema rule19 may have extended,
+        # and the normalized subqueries), so the prediction is normalized exactly as in compareTrees
+        key = (gold, db_id)
+        if key in self.golds:
+            self.stats['gold_hits'] += 1
+            return self.golds[key]
+        self.stats['gold_misses'] += 1
+        schema = self.schema(db_id)
+        db = self.dbPath(db_id)
+        entry = {'sql': preprocess(gold, schema), 'tree': None, 'normalized': None, 'schema': None, 'memo': None, 'rows': None, 'error': None}
+        entry['valid'] = self.isValid(entry['sql'], db_id)
+        if entry['valid']:
+            try:
+                with contextlib.redirect_stdout(self._devnull):
+                    entry['tree'] = parseTree(entry['sql'])
+                    entry['schema'] = dc(schema)
+                    entry['memo'] = {}
+                    entry['normalized'] = applyRules(dc(entry['tree']), entry['schema'], db, self.rules, entry['memo'])
+            except Exception as e:
+                entry['error'] = f"{type(e).__name__}: {e}"
+            if self.execution:
+                try:
+                    entry['rows'] = self.execute(entry['sql'], db_id)
+                except Exception as e:
+                    entry['error'] = entry['error'] or f"{type(e).__name__}: {e}"
+        return self._remember(self.golds, key, entry)
+
+    def score(self, gold: str, pred: str, db_id: str) -> dict:
+        """Score one pair. Returns a dict with the ETM result ('etm'), the execution result ('exec', None unless
+        the scorer executes queries), whether both queries are valid, whether the pair took the fast path,
+        the pre-filter that rejected it, any error, whether the result was cached from an earlier call with the
+        same pair, and the time taken."""
+        key = (gold, pred, db_id)
+        start = time.perf_counter()
+        self.stats['pairs'] += 1
+        if key in self.results:
+            # a pair scored before: its result, with the time of this call
+            self.stats['cached'] += 1
+            result = dict(self.results[key], cached=True)
+            result['time'] = time.perf_counter() - start
+            return result
+        result = {'etm': False, 'exec': None, 'valid': False, 'fast_path': False, 'rejected_by': None, 'error': None, 'cached': False}
+        entry = self.gold(gold, db_id)
+        pred = preprocess(pred, self.schema(db_id))
+        result['valid'] = entry['valid'] and self.isValid(pred, db_id)
+        if not result['valid']:
+            result['exec'] = False if self.execution else None
+        elif same_query(entry['sql'], pred):
+            # the same query up to case, whitespace and semicolons matches under ETM, and under execution
+            # unless the gold query failed or timed out when it was executed
+            self.stats['fast_path'] += 1
+            result.update({'etm': True, 'fast_path': True})
+            if self.execution:
+                result['exec'] = entry['rows'] is not None
+        else:
+            result['etm'] = self._match(entry, pred, db_id, result)
+            if self.execution:
+                result['exec'] = self._execMatch(entry, pred, db_id, result)
+        result['time'] = time.perf_counter() - start
+        self._remember(self.results, key, result)
+        return dict(result)
+
+    def score_batch(self, pairs) -> list:
+        """Score (gold, pred, db_id) triples, returning results in the same order. Pairs are scored grouped by
+        gold so that each gold query is normalized once even if the cache is smaller than the batch."""
+        pairs = list(pairs)
+        results = [None] * len(pairs)
+        order = sorted(range(len(pairs)), key=lambda i: (pairs[i][2], pairs[i][0]))
+        for i in order:
+            results[i] = self.score(*pairs[i])
+        return results
+
+    def _match(self, entry: dict, pred: str, db_id: str, result: dict) -> bool:
+        if entry['error'] or entry['normalized'] is None:
+            result['error'] = entry['error']
+            return False
+        try:
+            with contextlib.redirect_stdout(self._devnull):
+                treepred = parseTree(pred)
+        except Exception:
+            treepred = None
+        db = self.dbPath(db_id)
+        try:
+            with contextlib.redirect_stdout(self._devnull):
+                if self.prefilters:
+                    result['rejected_by'] = prefilter(entry['tree'], treepred, self.schema(db_id), db)
+                    if result['rejected_by']:
+                        return False
+                if self.matcher == 'stepwise':
+                    return compareTreesStepwise(dc(entry['tree']), treepred, dc(self.schema(db_id)), db, self.rules, prefilters=False)
+                # the memo's subqueries are copied when used, so a shallow copy keeps the cached one intact
+                normalized = applyRules(treepred, dc(entry['schema']), db, self.rules, dict(entry['memo']))
+                return entry['normalized'] == normalized
+        except Exception as e:
+            result['error'] = f"{type(e).__name__}: {e}"
+            return False
+
+    def _execMatch(self, entry: dict, pred: str, db_id: str, result: dict) -> bool:
+        # rows are compared as multisets, or as lists when the gold query orders them
+        if entry['rows'] is None:
+            return False
+        try:
+            rows = self.execute(pred, db_id)
+        except Exception as e:
+            result['error'] = result['error'] or f"{type(e).__name__}: {e}"
+            return False
+        # only an ORDER BY of the outermost query orders the rows (not one in a subquery or a string)
+        tree = entry['tree']
+        if tree is not None and tree.args.get('order') is not None:
+            return rows == entry['rows']
+        return collections.Counter(rows) == collections.Counter(entry['rows'])
+
+def readData(goldfile: str, predfile: str) -> tuple:
+    # gold and pred lines, grouped into conversations
     with open(predfile, 'r') as f:
         preds = f.readlines()
     with open(goldfile, 'r') as f:
@@ -2121,11 +2679,210 @@ if __name__ == "__main__":
     if c < len(preds):
         data_preds.append(preds[c:])
         data_golds.append(golds[c:])
+    return data_golds, data_preds
+
+def ruleSubsets(spec: str, rules: list) -> list:
+    # [(name, rules)] for a --sweep spec: subsets separated by ';', each one of 'all', 'loo' (all rules and every
+    # leave-one-out subset), rules to keep ('1,2,100') or rules to leave out ('-19,-20')
+    subsets = {}
+    for part in spec.split(';'):
+        part = part.strip()
+        if part in ('all', 'loo'):
+            subsets['all'] = list(rules)
+            if part == 'loo':
+                for rule in rules:
+                    subsets[f"-{rule}"] = [r for r in rules if r != rule]
+        elif part:
+            items = [int(item) for item in part.split(',') if item.strip()]
+            unknown = [item for item in items if abs(item) not in rules]
+            if unknown or not items or (min(items) < 0 < max(items)):
+                raise ValueError(f"bad rule subset: {part}")
+            if items[0] < 0:
+                subsets[part] = [r for r in rules if -r not in items]
+            else:
+                subsets[part] = [r for r in rules if r in items]
+    return list(subsets.items())
+
+class RuleSweep:
+    """
+    ETM under many rule subsets in one run (treeMatch.py --sweep). Every pair is parsed, validated and
+    pre-filtered once. A normalization under one set of rules records the rules that changed the tree on
+    the way; every subset that keeps those rules and is contained in that set takes exactly the same steps,
+    so its result is reused instead of normalizing again. Gold normalizations are shared across models.
+    """
+    def __init__(self, db_dir: str, subsets: list, prefilters: bool = True):
+        self.scorer = Scorer(db_dir, prefilters=prefilters)
+        self.subsets = [(name, [r for r in ALLRULES if r in rules]) for name, rules in subsets]
+        # larger subsets first, so that smaller ones can reuse their runs
+        self.order = sorted(range(len(self.subsets)), key=lambda i: -len(self.subsets[i][1]))
+        self.prefilters = prefilters
+        self.golds = {}
+        self.stats = {'pairs': 0, 'fast_path': 0, 'rejected': 0, 'normalized': 0, 'reused': 0}
+
+    def reusable(self, runs: list, rules: frozenset) -> dict:
+        for run in runs:
+            if run['fired'] <= rules <= run['rules']:
+                self.stats['reused'] += 1
+                return run
+        return None
+
+    def normalize(self, tree, schema: dict, db: str, rules: list, memo: dict) -> tuple:
+        # (normal form, rules that changed something), every rule counts as used if normalizing fails
+        self.stats['normalized'] += 1
+        fired = set()
+        try:
+            with contextlib.redirect_stdout(self.scorer._devnull):
+                tree = applyRules(tree, schema, db, rules, memo, fired)
+        except Exception:
+            return None, frozenset(rules)
+        return tree, frozenset(fired)
+
+    def gold(self, gold: str, db_id: str) -> dict:
+        key = (gold, db_id)
+        if key not in self.golds:
+            sql = preprocess(gold, self.scorer.schema(db_id))
+            entry = {'sql': sql, 'valid': self.scorer.isValid(sql, db_id), 'tree': None, 'runs': []}
+            if entry['valid']:
+                with contextlib.redirect_stdout(self.scorer._devnull):
+                    entry['tree'] = parseTree(sql)
+            self.golds[key] = entry
+        return self.golds[key]
+
+    def goldRun(self, entry: dict, db_id: str, rules: list) -> dict:
+        run = self.reusable(entry['runs'], frozenset(rules))
+        if run is None:
+            schema, memo = dc(self.scorer.schema(db_id)), {}
+            tree, fired = self.normalize(entry['tree'], schema, self.scorer.dbPath(db_id), rules, memo)
+            run = {'rules': frozenset(rules), 'fired': fired, 'tree': tree, 'schema': schema, 'memo': memo}
+            entry['runs'].append(run)
+        return run
+
+    def score(self, gold: str, pred: str, db_id: str) -> list:
+        """Whether the pair matches under each subset, in the order of the subsets."""
+        self.stats['pairs'] += 1
+        entry = self.gold(gold, db_id)
+        schema = self.scorer.schema(db_id)
+        db = self.scorer.dbPath(db_id)
+        pred = preprocess(pred, schema)
+        if not entry['valid'] or not self.scorer.isValid(pred, db_id):
+            return [False] * len(self.subsets)
+        if same_query(entry['sql'], pred):
+            self.stats['fast_path'] += 1
+            return [True] * len(self.subsets)
+        try:
+            with contextlib.redirect_stdout(self.scorer._devnull):
+                treepred = parseTree(pred)
+        except Exception:
+            return [False] * len(self.subsets)
+        # no rule changes a pre-filter invariant, so a rejection holds under every subset
+        if self.prefilters:
+            with contextlib.redirect_stdout(self.scorer._devnull):
+                if prefilter(entry['tree'], treepred, schema, db):
+                    self.stats['rejected'] += 1
+                    return [False] * len(self.subsets)
+        results = [False] * len(self.subsets)
+        runs = []
+        for i in self.order:
+            rules = self.subsets[i][1]
+            run = self.reusable(runs, frozenset(rules))
+            if run is None:
+                goldrun = self.goldRun(entry, db_id, rules)
+                match, fired = False, frozenset(rules)
+                if goldrun['tree'] is not None:
+                    # the gold run may come from a larger set, its memo is valid for these rules too
+                    memo = {(key[0], tuple(rules), key[2]): tree for key, tree in goldrun['memo'].items()}
+                    tree, fired = self.normalize(treepred, dc(goldrun['schema']), db, rules, memo)
+                    match = tree is not None and goldrun['tree'] == tree
+                    fired = fired | goldrun['fired']
+                run = {'rules': frozenset(rules), 'fired': fired, 'match': match}
+                runs.append(run)
+            results[i] = run['match']
+        return results
+
+def runSweep(args, subsets: list, prefilters: bool):
+    import tqdm
+    sweep = RuleSweep(args.db, subsets, prefilters)
+    models = [path for path in args.pred.split(',') if path]
+    matrix = {}
+    for predfile in models:
+        data_golds, data_preds = readData(args.gold, predfile)
+        counts = [0] * len(subsets)
+        total = 0
+        for i in tqdm.tqdm(range(len(data_preds))):
+            for j in range(len(data_preds[i])):
+                gold, db = data_golds[i][j].split('\t')[0].strip(), data_golds[i][j].split('\t')[1].strip()
+                for k, match in enumerate(sweep.score(gold, data_preds[i][j].strip(), db)):
+                    counts[k] += match
+                total += 1
+        matrix[os.path.splitext(os.path.basename(predfile))[0]] = [count / total if total else 0.0 for count in counts]
+    # subset x model accuracy, leave-one-out rows also show the change from using all rules
+    names = [name for name, _ in subsets]
+    full = names.index('all') if 'all' in names else None
+    width = max(len(name) for name in names + ['subset'])
+    print("RESULTS")
+    print(f"{'subset':<{width}}  " + "  ".join(f"{model:>16}" for model in matrix))
+    for k, name in enumerate(names):
+        cells = []
+        for model, scores in matrix.items():
+            cell = f"{scores[k]:.4f}"
+            if full is not None and k != full:
+                cell += f" ({scores[k] - scores[full]:+.4f})"
+            cells.append(f"{cell:>16}")
+        print(f"{name:<{width}}  " + "  ".join(cells))
+    print("Sweep: ", sweep.stats)
+    if args.sweep_out:
+        with open(args.sweep_out, 'w') as f:
+            json.dump({'subsets': dict(subsets), 'accuracy': matrix, 'stats': sweep.stats}, f, indent=1)
+    sweep.scorer.close()
+
+if __name__ == "__main__":
+
+    data = []
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pred', type=str, default='', help='file containing the predictions')
+    parser.add_argument('--gold', type=str, default='', help='file containing the gold data')
+    parser.add_argument('--db', type=str, default='', help='folder containing the database files')
+    parser.add_argument('--table', type=str, default='', help='the tables json file')
+    parser.add_argument('--etype', type=str, default='all',help='exe, treematch, or all')
+    parser.add_argument('--verbose', default=False,action='store_true', help='Whether to print verbose output')
+    parser.add_argument('--matcher', type=str, default='rewrite', choices=['rewrite', 'stepwise'], help='rewrite: normalize both trees and compare, stepwise: compare after every rewrite step and stop at the first match')
+    parser.add_argument('--explore_nodes', type=int, default=0, help='stepwise matcher: terms per pair to spend exploring other rule orders (0: off)')
+    parser.add_argument('--explore_timeout', type=float, default=5.0, help='stepwise matcher: time budget per pair in seconds')
+    parser.add_argument('--no_prefilter', default=False, action='store_true', help='normalize every pair, even those the pre-filters reject')
+    parser.add_argument('--sweep', type=str, default='', help="ETM under several rule subsets in one run, e.g. 'loo' (all rules and every leave-one-out) or 'all;-19,-20;100,101'. --pred may list several files, separated by commas")
+    parser.add_argument('--sweep_out', type=str, default='', help='sweep: write the subset x model accuracy matrix as json')
+    parser.add_argument('--check_prefilters', default=False, action='store_true', help='normalize every pair and report pre-filter rejections of matching pairs')
+    args = parser.parse_args()
+    prefilters = not args.no_prefilter
+    # only the CLI needs these, and ETM only when execution results are reported
+    import tqdm
+    if args.etype != 'treematch':
+        from ETM_utils.ETM import evalquery
+    problems = []
+    if args.check_prefilters:
+        def compare(t1, t2, schema, db, rules):
+            matched, found = checkPrefilters(t1, t2, schema, db, rules)
+            problems.extend((t1.sql(), t2.sql() if t2 else None, problem) for problem in found)
+            return matched
+    elif args.matcher == 'stepwise':
+        compare = lambda t1, t2, schema, db, rules: compareTreesStepwise(t1, t2, schema, db, rules, args.explore_nodes, args.explore_timeout, prefilters)
+    else:
+        compare = lambda t1, t2, schema, db, rules: compareTrees(t1, t2, schema, db, rules, prefilters)
+
+    if args.sweep:
+        runSweep(args, ruleSubsets(args.sweep, ALLRULES), prefilters)
+        raise SystemExit
+
+    predfile = args.pred
+    goldfile = args.gold
+    tablefile = args.table
+    data_golds, data_preds = readData(goldfile, predfile)
     # tqdm
     schemas = {}
     total = 0
     count_exec = 0
     count_treematch = 0
+    fast_path = 0
 
     for i in tqdm.tqdm(range(len(data_preds))):
         if args.verbose:
@@ -2161,7 +2918,12 @@ if __name__ == "__main__":
             except:
                 bad = True
             rules = ALLRULES
-            if not bad:
+            # the same query up to case, whitespace and semicolons matches under every metric
+            fast = not bad and same_query(gold, pred)
+            if fast:
+                fast_path += 1
+                treecomp = True
+            elif not bad:
                 if args.verbose:
                     treegold = parseTree(gold)
                 else:
@@ -2177,15 +2939,20 @@ if __name__ == "__main__":
                     treepred = None
                 try:
                     if args.verbose:
-                        treecomp = compareTrees(treegold,treepred,dc(schemas[db]), db, rules)
+                        treecomp = compare(treegold,treepred,dc(schemas[db]), db, rules)
                     else:
                         with contextlib.redirect_stdout(open(os.devnull, 'w')):
-                            treecomp = compareTrees(treegold,treepred,dc(schemas[db]), db, rules)
+                            treecomp = compare(treegold,treepred,dc(schemas[db]), db, rules)
                 except:
                     treecomp = False
             else:
                 treecomp = False
-            execcomp = evalquery(gold,pred,db,'exec',False,True,False,False,False,[1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20],False)
+            if fast:
+                execcomp = True
+            elif args.etype == 'treematch':
+                execcomp = False
+            else:
+                execcomp = evalquery(gold,pred,db,'exec',False,True,False,False,False,[1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20],False)
             if treecomp:
                 count_treematch += 1
             if execcomp:
@@ -2196,4 +2963,15 @@ if __name__ == "__main__":
     if args.etype == 'all' or args.etype == 'treematch':
         print("ETM: ", count_treematch/total)
     if args.etype == 'all' or args.etype == 'exe':
-        print("EXE: ", count_exec/total)
\ No newline at end of file
+        print("EXE: ", count_exec/total)
+    print("Fast path: ", f"{fast_path}/{total} ({fast_path/total:.1%})")
+    if args.matcher == 'stepwise':
+        print("Step-wise: ", STEPWISE_STATS)
+    if prefilters:
+        print("Pre-filters: ", PREFILTER_STATS)
+    if args.check_prefilters:
+        print("Pre-filter problems: ", len(problems))
+        for gold, pred, problem in problems:
+            print(problem)
+            print("  gold:", gold)
+            print("  pred:", pred)
\ No newline at end of file